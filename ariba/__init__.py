@@ -7,6 +7,7 @@ except:
 
 
 __all__ = [
+    'aligner',
     'aln_to_metadata',
     'assembly',
     'assembly_compare',
@@ -15,12 +16,15 @@ __all__ = [
     'card_record',
     'cdhit',
     'cluster',
+    'cluster_result',
+    'cluster_scheduler',
     'clusters',
     'common',
     'external_progs',
     'faidx',
     'flag',
     'histogram',
+    'interval_index',
     'link',
     'mapping',
     'megares_data_finder',
@@ -44,11 +48,13 @@ __all__ = [
     'samtools_variants',
     'sequence_metadata',
     'sequence_variant',
+    'streamed_output',
     'summary',
     'summary_cluster',
     'summary_cluster_variant',
     'summary_sample',
     'tasks',
+    'thread_tokens',
     'versions',
     'vfdb_parser',
 ]
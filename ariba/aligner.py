@@ -0,0 +1,118 @@
+import os
+import pymummer
+import minimap_ariba
+
+class Error (Exception): pass
+
+aligners = ['nucmer', 'minimap']
+
+
+class Runner:
+    '''Aligns query sequences to reference sequences, writing a coords file
+       (and optionally a snps file) in the same format as pymummer.nucmer.Runner.
+       aligner='nucmer' runs nucmer. aligner='minimap' aligns in this
+       process, by finding seeds with minimap and extending them with banded
+       alignment. This avoids running nucmer, delta-filter, show-coords and
+       show-snps for every comparison'''
+    def __init__(self,
+      ref,
+      query,
+      outfile,
+      min_id=None,
+      min_length=None,
+      breaklen=None,
+      maxmatch=False,
+      show_snps=False,
+      show_snps_C=True,
+      aligner='nucmer',
+    ):
+        if aligner not in aligners:
+            raise Error('Aligner "' + str(aligner) + '" not recognised. Must be one of: ' + ','.join(aligners) + '. Cannot continue')
+
+        self.ref = os.path.abspath(ref)
+        self.query = os.path.abspath(query)
+        self.outfile = os.path.abspath(outfile)
+        self.min_id = min_id
+        self.min_length = min_length
+        self.breaklen = breaklen
+        self.maxmatch = maxmatch
+        self.show_snps = show_snps
+        self.show_snps_C = show_snps_C
+        self.aligner = aligner
+
+
+    @staticmethod
+    def _coords_line(hit):
+        '''Returns line of show-coords -dTlro output, from one hit made by minimap_ariba.align_sequences'''
+        ref_start, ref_end, qry_start, qry_end, len_ref, len_qry, pc_id, ref_length, qry_length, frame, ref_name, qry_name = hit[:12]
+        return '\t'.join([str(x) for x in [ref_start, ref_end, qry_start, qry_end, len_ref, len_qry, '{:.2f}'.format(pc_id), ref_length, qry_length, 1, frame, ref_name, qry_name]])
+
+
+    @staticmethod
+    def _snp_lines(hit, show_snps_C=True):
+        '''Returns list of lines of show-snps -Tlr output (or -TClr if show_snps_C is True),
+           from one hit made by minimap_ariba.align_sequences. As in show-snps, the
+           [R] and [Q] columns are only there without -C'''
+        ref_length, qry_length, frame, ref_name, qry_name = hit[7:12]
+        lines = []
+        for ref_pos, ref_base, qry_base, qry_pos, buff, dist in hit[12]:
+            fields = [ref_pos, ref_base, qry_base, qry_pos, buff, dist]
+            if not show_snps_C:
+                fields.extend([0, 0])
+            fields.extend([ref_length, qry_length, 1, frame, ref_name, qry_name])
+            lines.append((ref_name, ref_pos, qry_name, '\t'.join([str(x) for x in fields])))
+        return lines
+
+
+    def _run_minimap(self):
+        got, hits = minimap_ariba.align_sequences(self.ref, self.query, float(0 if self.min_id is None else self.min_id), int(0 if self.min_length is None else self.min_length))
+        if got != 0:
+            raise Error('Error aligning ' + self.query + ' to ' + self.ref + '. Cannot continue')
+
+        with open(self.outfile, 'w') as f:
+            print(self.ref, self.query, file=f)
+            print('NUCMER', file=f)
+            print(file=f)
+            print('[S1]', '[E1]', '[S2]', '[E2]', '[LEN 1]', '[LEN 2]', '[% IDY]', '[LEN R]', '[LEN Q]', '[FRM]', '[TAGS]', sep='\t', file=f)
+            for hit in hits:
+                print(Runner._coords_line(hit), file=f)
+
+        if self.show_snps:
+            # snps are sorted by reference position, as in show-snps -r. The sort is
+            # stable, so indels within one hit stay in the order they are in the alignment
+            snp_lines = []
+            for hit in hits:
+                snp_lines.extend(Runner._snp_lines(hit, show_snps_C=self.show_snps_C))
+            ref_order = {}
+            for hit in hits:
+                ref_order.setdefault(hit[10], len(ref_order))
+            snp_lines.sort(key=lambda x: (ref_order[x[0]], x[1], x[2]))
+
+            with open(self.outfile + '.snps', 'w') as f:
+                print(self.ref, self.query, file=f)
+                print('NUCMER', file=f)
+                print(file=f)
+                header = ['[P1]', '[SUB]', '[SUB]', '[P2]', '[BUFF]', '[DIST]']
+                if not self.show_snps_C:
+                    header.extend(['[R]', '[Q]'])
+                header.extend(['[LEN R]', '[LEN Q]', '[FRM]', '[TAGS]'])
+                print(*header, sep='\t', file=f)
+                for x in snp_lines:
+                    print(x[3], file=f)
+
+
+    def run(self):
+        if self.aligner == 'nucmer':
+            pymummer.nucmer.Runner(
+                self.ref,
+                self.query,
+                self.outfile,
+                min_id=self.min_id,
+                min_length=self.min_length,
+                breaklen=self.breaklen,
+                maxmatch=self.maxmatch,
+                show_snps=self.show_snps,
+                show_snps_C=self.show_snps_C,
+            ).run()
+        else:
+            self._run_minimap()
@@ -4,10 +4,14 @@ import pyfastaq
 import pymummer
 import fermilite_ariba
 from ariba import common, mapping, bam_parse, external_progs, ref_seq_chooser
+from ariba import aligner as ariba_aligner
 import shlex
 
 class Error (Exception): pass
 
+# (overlap, min count) pairs that fermilite assembles with, in the default order
+fermilite_grid = [(6, 4), (6, 17), (6, 30), (15, 4), (15, 17), (15, 30)]
+
 class Assembly:
     def __init__(self,
       reads1,
@@ -27,11 +31,22 @@ class Assembly:
       nucmer_min_id=90,
       nucmer_min_len=20,
       nucmer_breaklen=200,
+      aligner='nucmer',
+      read_mapper='bowtie2',
       extern_progs=None,
       clean=True,
       spades_mode="wgs",
       spades_options=None,
-      threads=1
+      threads=1,
+      ref_scores=None,
+      max_cluster_refs=0,
+      all_reference_index=None,
+      fermilite_grid_mode='full',
+      fermilite_grid_wins=None,
+      assembled_threshold=0.95,
+      reads_packed=None,
+      final_assembly_nucmer_coords=None,
+      bowtie2_index_cache_dir=None,
     ):
         self.reads1 = os.path.abspath(reads1)
         self.reads2 = os.path.abspath(reads2)
@@ -52,10 +67,30 @@ class Assembly:
         self.nucmer_min_id = nucmer_min_id
         self.nucmer_min_len = nucmer_min_len
         self.nucmer_breaklen = nucmer_breaklen
+        self.aligner = aligner
+        self.read_mapper = read_mapper
         self.clean = clean
         self.spades_mode = spades_mode
         self.spades_options = spades_options
         self.threads = threads
+        self.ref_scores = ref_scores
+        self.max_cluster_refs = max_cluster_refs
+        self.all_reference_index = all_reference_index
+        self.fermilite_grid_mode = fermilite_grid_mode
+        self.fermilite_grid_wins = fermilite_grid_wins
+        self.assembled_threshold = assembled_threshold
+        self.fermilite_grid_point = None
+        self.reads_packed = reads_packed
+        self.final_assembly_nucmer_coords = None if final_assembly_nucmer_coords is None else os.path.abspath(final_assembly_nucmer_coords)
+        # Set to True when the nucmer files are written to final_assembly_nucmer_coords,
+        # so that AssemblyCompare does not need to run nucmer again
+        self.final_assembly_nucmer_coords_written = False
+        # If bowtie2_index_cache_dir is given, the bowtie2 index of the final assembly
+        # is kept there, so that the caller can map more reads without indexing again
+        self.bowtie2_index_cache_dir = None if bowtie2_index_cache_dir is None else os.path.abspath(bowtie2_index_cache_dir)
+
+        if self.fermilite_grid_mode not in {'full', 'adaptive'}:
+            raise Error('Fermilite grid mode must be "full" or "adaptive". Got "' + str(self.fermilite_grid_mode) + '". Cannot continue')
 
         if extern_progs is None:
             self.extern_progs = external_progs.ExternalProgs(using_spades=self.assembler == 'spades')
@@ -74,8 +109,129 @@ class Assembly:
 
 
     @staticmethod
-    def _run_fermilite(reads_in, fasta_out, log_out, name_prefix):
-        return fermilite_ariba.fermilite_ariba(reads_in, fasta_out, log_out, name_prefix)
+    def _run_fermilite(reads_in, fasta_out, log_out, name_prefix, threads=1, grid=None):
+        return fermilite_ariba.fermilite_ariba(reads_in, fasta_out, log_out, name_prefix, threads, grid)
+
+
+    @staticmethod
+    def _packed_reads(reads1, reads2):
+        '''Returns bytes of the read pairs in the fastq files reads1 and reads2,
+        in the format that fermilite takes instead of a filename.
+        One line per pair: seq1 TAB qual1 TAB seq2 TAB qual2'''
+        lines = []
+        f1 = pyfastaq.utils.open_file_read(reads1)
+        f2 = pyfastaq.utils.open_file_read(reads2)
+
+        for i, (line1, line2) in enumerate(zip(f1, f2)):
+            if i % 4 == 1:
+                seqs = line1.rstrip(), line2.rstrip()
+            elif i % 4 == 3:
+                lines.append('\t'.join([seqs[0], line1.rstrip(), seqs[1], line2.rstrip()]) + '\n')
+
+        different_lengths = next(f1, None) is not None or next(f2, None) is not None
+        pyfastaq.utils.close(f1)
+        pyfastaq.utils.close(f2)
+        if different_lengths:
+            raise Error('Different number of reads in files ' + reads1 + ' and ' + reads2 + '. Cannot continue')
+        return ''.join(lines).encode()
+
+
+    @staticmethod
+    def _fermilite_grid_order(grid_wins):
+        '''Returns the fermilite grid, most winning (overlap, min count) first.
+        Ties are kept in the default grid order'''
+        if grid_wins is None:
+            grid_wins = {}
+        return sorted(fermilite_grid, key=lambda x: -grid_wins.get(x, 0))
+
+
+    @staticmethod
+    def _ref_proportion_covered_by_kmers(ref_seq, kmers, kmer_length):
+        '''Returns proportion of positions in ref_seq that are in at least one kmer in kmers'''
+        covered = 0
+        covered_end = 0
+        for i in range(len(ref_seq) - kmer_length + 1):
+            if ref_seq[i:i + kmer_length] in kmers:
+                covered += i + kmer_length - max(i, covered_end)
+                covered_end = i + kmer_length
+
+        return covered / len(ref_seq) if len(ref_seq) else 0
+
+
+    @classmethod
+    def _assembly_covers_a_ref(cls, contigs, ref_seqs, threshold, kmer_length=15):
+        '''Cheap check of an assembly, without running nucmer. Returns True
+        iff there is exactly one contig and it shares kmers with at least the
+        threshold proportion of the positions of one of the ref sequences'''
+        if len(contigs) != 1:
+            return False
+
+        contig = pyfastaq.sequences.Fasta('x', contigs[0].upper())
+        kmers = set()
+        for strand in range(2):
+            kmers.update(contig.seq[i:i + kmer_length] for i in range(len(contig) - kmer_length + 1))
+            contig.revcomp()
+
+        return any(cls._ref_proportion_covered_by_kmers(ref_seq.upper(), kmers, kmer_length) >= threshold for ref_seq in ref_seqs)
+
+
+    def _run_fermilite_adaptive(self, reads_in, fasta_out, log_out):
+        '''Runs fermilite on the grid points, most winning first, self.threads
+        points at a time. Stops as soon as an assembly passes the cheap
+        check against the cluster refs, and then only that assembly is written
+        to fasta_out. Otherwise, the whole grid is written'''
+        ref_seqs = {}
+        pyfastaq.tasks.file_to_dict(self.ref_fastas, ref_seqs)
+        ref_seqs = [x.seq for x in ref_seqs.values()]
+        grid = self._fermilite_grid_order(self.fermilite_grid_wins)
+        batch_size = max(1, self.threads)
+        tmp_fasta = fasta_out + '.tmp.fa'
+        tmp_log = log_out + '.tmp'
+        contigs = {}
+        winner = None
+
+        with open(log_out, 'w') as f_log:
+            print('Fermilite grid order:', ' '.join(['l' + str(x[0]) + '.c' + str(x[1]) for x in grid]), file=f_log)
+
+            for i in range(0, len(grid), batch_size):
+                batch = grid[i:i + batch_size]
+                got_from_fermilite = self._run_fermilite(reads_in, tmp_fasta, tmp_log, self.contig_name_prefix, threads=self.threads, grid=batch)
+                if os.path.exists(tmp_log):
+                    with open(tmp_log) as f:
+                        for line in f:
+                            if i == 0 or not (line.startswith('Fermilite assembly stats') or line.startswith('Overlap')):
+                                print(line, end='', file=f_log)
+                    os.unlink(tmp_log)
+
+                if got_from_fermilite == 0:
+                    for seq in pyfastaq.sequences.file_reader(tmp_fasta):
+                        point = ref_seq_chooser.RefSeqChooser._l_and_c_from_contig_name(seq.id)
+                        contigs.setdefault(point, []).append(pyfastaq.sequences.Fasta(seq.id, seq.seq))
+                    os.unlink(tmp_fasta)
+
+                for point in batch:
+                    if self._assembly_covers_a_ref([x.seq for x in contigs.get(point, [])], ref_seqs, self.assembled_threshold):
+                        winner = point
+                        break
+
+                if winner is not None:
+                    print('Assembly l' + str(winner[0]) + '.c' + str(winner[1]), 'covers a cluster ref. Not running the rest of the grid', file=f_log)
+                    break
+
+        if winner is None:
+            to_write = [point for point in fermilite_grid if point in contigs]
+        else:
+            to_write = [winner]
+
+        if len(to_write) == 0:
+            return 1
+
+        with open(fasta_out, 'w') as f:
+            for point in to_write:
+                for seq in contigs[point]:
+                    print(seq, file=f)
+
+        return 0
 
 
     def _assemble_with_fermilite(self):
@@ -85,11 +241,17 @@ class Assembly:
         except:
             raise Error('Error chdir ' + self.working_dir)
 
-        interleaved_reads = 'reads.fq'
-        pyfastaq.tasks.interleave(self.reads1, self.reads2, interleaved_reads)
+        if self.reads_packed is None:
+            reads_packed = self._packed_reads(self.reads1, self.reads2)
+        else:
+            reads_packed = self.reads_packed
         fermilite_log = self.all_assembly_contigs_fa + '.log'
-        got_from_fermilite = self._run_fermilite(interleaved_reads, self.all_assembly_contigs_fa, fermilite_log, self.contig_name_prefix)
-        os.unlink(interleaved_reads)
+        if self.fermilite_grid_mode == 'adaptive':
+            got_from_fermilite = self._run_fermilite_adaptive(reads_packed, self.all_assembly_contigs_fa, fermilite_log)
+        else:
+            got_from_fermilite = self._run_fermilite(reads_packed, self.all_assembly_contigs_fa, fermilite_log, self.contig_name_prefix, threads=self.threads)
+        # don't keep the reads in memory (or pickle them with this object)
+        self.reads_packed = None
         if os.path.exists(fermilite_log):
             with open(fermilite_log) as f:
                 for line in f:
@@ -202,14 +364,51 @@ class Assembly:
 
 
     @staticmethod
-    def _fix_contig_orientation(contigs_fa, ref_fa, outfile, min_id=90, min_length=20, breaklen=200):
+    def _reverse_queries_in_nucmer_line(line, qry_names, qry_name_column, qry_length_column, qry_position_columns, qry_frame_column):
+        '''Changes a tab-delimited line of show-coords or show-snps output as if the query had been
+           reverse complemented, if the query is in qry_names. Bases in show-snps output are
+           already as aligned, so are not changed.'''
+        if line.startswith('[') or '\t' not in line:
+            return line
+
+        fields = line.rstrip('\n').split('\t')
+        if fields[qry_name_column] not in qry_names:
+            return line
+
+        qry_length = int(fields[qry_length_column])
+        for i in qry_position_columns:
+            fields[i] = str(qry_length - int(fields[i]) + 1)
+        fields[qry_frame_column] = '1' if fields[qry_frame_column] == '-1' else '-1'
+        return '\t'.join(fields) + '\n'
+
+
+    @classmethod
+    def _reverse_queries_in_nucmer_files(cls, coords_in, coords_out, qry_names):
+        '''Writes coords_in and its show-snps file coords_in.snps to coords_out and coords_out.snps,
+           changing coordinates as if each query in qry_names had been reverse complemented'''
+        with open(coords_in) as f_in, open(coords_out, 'w') as f_out:
+            for line in f_in:
+                print(cls._reverse_queries_in_nucmer_line(line, qry_names, 12, 8, [2, 3], 10), end='', file=f_out)
+
+        # show-snps only has the [R] and [Q] columns without -C, so count the
+        # columns after them from the end of the line, like pymummer.snp.Snp does
+        with open(coords_in + '.snps') as f_in, open(coords_out + '.snps', 'w') as f_out:
+            for line in f_in:
+                print(cls._reverse_queries_in_nucmer_line(line, qry_names, -1, -5, [3], -3), end='', file=f_out)
+
+
+    @classmethod
+    def _fix_contig_orientation(cls, contigs_fa, ref_fa, outfile, min_id=90, min_length=20, breaklen=200, nucmer_outfile=None, aligner='nucmer'):
         '''Changes orientation of each contig to match the reference, when possible.
-           Returns a set of names of contigs that had hits in both orientations to the reference'''
+           Returns a set of names of contigs that had hits in both orientations to the reference.
+           If nucmer_outfile is given, also writes the nucmer coords and snps files of the reference
+           against the reoriented contigs to nucmer_outfile and nucmer_outfile.snps, as made by
+           AssemblyCompare. This means nucmer only needs to be run once.'''
         if not os.path.exists(contigs_fa):
             raise Error('Cannot fix orientation of assembly contigs because file not found: ' + contigs_fa)
 
         tmp_coords = os.path.join(outfile + '.tmp.rename.coords')
-        pymummer.nucmer.Runner(
+        ariba_aligner.Runner(
             ref_fa,
             contigs_fa,
             tmp_coords,
@@ -217,6 +416,9 @@ class Assembly:
             min_length=min_length,
             breaklen=breaklen,
             maxmatch=True,
+            show_snps=nucmer_outfile is not None,
+            show_snps_C=False,
+            aligner=aligner,
         ).run()
 
         to_revcomp = set()
@@ -228,9 +430,13 @@ class Assembly:
             else:
                 to_revcomp.add(hit.qry_name)
 
-        os.unlink(tmp_coords)
         in_both = to_revcomp.intersection(not_revcomp)
 
+        if nucmer_outfile is not None:
+            cls._reverse_queries_in_nucmer_files(tmp_coords, nucmer_outfile, to_revcomp.difference(in_both))
+            os.unlink(tmp_coords + '.snps')
+        os.unlink(tmp_coords)
+
         f = pyfastaq.utils.open_file_write(outfile)
         seq_reader = pyfastaq.sequences.file_reader(contigs_fa)
         for seq in seq_reader:
@@ -281,6 +487,10 @@ class Assembly:
                 nucmer_min_id=self.nucmer_min_id,
                 nucmer_min_len=self.nucmer_min_len,
                 nucmer_breaklen=self.nucmer_breaklen,
+                aligner=self.aligner,
+                ref_scores=self.ref_scores,
+                max_cluster_refs=self.max_cluster_refs,
+                all_refs_index=self.all_reference_index,
             )
             ref_chooser.run()
 
@@ -300,6 +510,11 @@ class Assembly:
 
             print('Closest reference sequence:', self.ref_seq_name, file=self.log_fh)
 
+            if self.assembler == 'fermilite':
+                for seq in pyfastaq.sequences.file_reader(self.best_assembly_fa):
+                    self.fermilite_grid_point = ref_seq_chooser.RefSeqChooser._l_and_c_from_contig_name(seq.id)
+                    break
+
             file_reader = pyfastaq.sequences.file_reader(self.ref_fastas)
             for ref_seq in file_reader:
                 if self.ref_seq_name == ref_seq.id:
@@ -308,11 +523,13 @@ class Assembly:
                     pyfastaq.utils.close(f_out)
                     break
 
-            contigs_both_strands = self._fix_contig_orientation(self.best_assembly_fa, self.ref_fasta, self.final_assembly_fa, min_id=self.nucmer_min_id, min_length=self.nucmer_min_len, breaklen=self.nucmer_breaklen)
+            contigs_both_strands = self._fix_contig_orientation(self.best_assembly_fa, self.ref_fasta, self.final_assembly_fa, min_id=self.nucmer_min_id, min_length=self.nucmer_min_len, breaklen=self.nucmer_breaklen, nucmer_outfile=self.final_assembly_nucmer_coords, aligner=self.aligner)
+            self.final_assembly_nucmer_coords_written = self.final_assembly_nucmer_coords is not None
             self.has_contigs_on_both_strands = len(contigs_both_strands) > 0
             pyfastaq.tasks.file_to_dict(self.final_assembly_fa, self.sequences)
 
-            mapping.run_bowtie2(
+            mapping.run_read_mapper(
+                self.read_mapper,
                 self.reads1,
                 self.reads2,
                 self.final_assembly_fa,
@@ -322,7 +539,8 @@ class Assembly:
                 bowtie2=self.extern_progs.exe('bowtie2'),
                 bowtie2_version=self.extern_progs.version('bowtie2'),
                 verbose=True,
-                verbose_filehandle=self.log_fh
+                verbose_filehandle=self.log_fh,
+                index_cache_dir=self.bowtie2_index_cache_dir,
             )
 
             self.scaff_graph_ok = self._parse_bam(self.sequences, self.final_assembly_bam, self.min_scaff_depth, self.max_insert)
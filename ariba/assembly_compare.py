@@ -2,6 +2,8 @@ import os
 import copy
 import pyfastaq
 import pymummer
+from ariba import interval_index
+from ariba import aligner as ariba_aligner
 
 class Error (Exception): pass
 
@@ -16,9 +18,11 @@ class AssemblyCompare:
       nucmer_min_id=90,
       nucmer_min_len=20,
       nucmer_breaklen=200,
+      aligner='nucmer',
       assembled_threshold=0.95,
       unique_threshold=0.03,
       max_gene_nt_extend=30,
+      run_nucmer=True,
     ):
         self.assembly_fa = os.path.abspath(assembly_fa)
         self.assembly_sequences = assembly_sequences
@@ -30,6 +34,7 @@ class AssemblyCompare:
         self.nucmer_min_id = nucmer_min_id
         self.nucmer_min_len = nucmer_min_len
         self.nucmer_breaklen = nucmer_breaklen
+        self.aligner = aligner
         self.assembled_threshold = assembled_threshold
         self.unique_threshold = unique_threshold
         self.max_gene_nt_extend = max_gene_nt_extend
@@ -41,10 +46,13 @@ class AssemblyCompare:
 
         self.nucmer_coords_file = self.outprefix + '.nucmer.coords'
         self.nucmer_snps_file = self.nucmer_coords_file + '.snps'
+        # Use run_nucmer=False if the nucmer coords and snps files have already
+        # been made, eg by Assembly when fixing the contig orientation
+        self.run_nucmer = run_nucmer
 
 
     def _run_nucmer(self):
-        pymummer.nucmer.Runner(
+        ariba_aligner.Runner(
             self.ref_fa,
             self.assembly_fa,
             self.nucmer_coords_file,
@@ -54,6 +62,7 @@ class AssemblyCompare:
             maxmatch=True,
             show_snps=True,
             show_snps_C=False,
+            aligner=self.aligner,
         ).run()
 
 
@@ -243,12 +252,8 @@ class AssemblyCompare:
         if len(covered) <= 1:
             return False
 
-        coverage = {}
-        for i in covered:
-            for j in range(i.start, i.end + 1):
-                coverage[j] = coverage.get(j, 0) + 1
-
-        bases_depth_at_least_two = len([1 for x in coverage.values() if x > 1])
+        index = interval_index.IntervalIndex([(x.start, x.end, None) for x in covered])
+        bases_depth_at_least_two = index.bases_with_depth_at_least(2)
         return bases_depth_at_least_two / len(ref_seq) >= threshold
 
 
@@ -381,21 +386,60 @@ class AssemblyCompare:
 
 
     @staticmethod
-    def nucmer_hit_containing_reference_position(nucmer_hits, ref_name, ref_position, qry_name=None):
+    def nucmer_hits_ref_index(nucmer_hits):
+        '''Input is hits made by self._parse_nucmer_coords_file.
+           Returns dictionary. Key = reference name. Value = IntervalIndex of the
+           reference coords of the hits, with the hits as values'''
+        intervals = {}
+        for contig_name in nucmer_hits:
+            for hit in nucmer_hits[contig_name]:
+                coords = hit.ref_coords()
+                intervals.setdefault(hit.ref_name, []).append((coords.start, coords.end, hit))
+        return {x: interval_index.IntervalIndex(intervals[x]) for x in intervals}
+
+
+    @staticmethod
+    def nucmer_hits_qry_index(nucmer_hits):
+        '''Input is hits made by self._parse_nucmer_coords_file.
+           Returns dictionary. Key = contig name. Value = IntervalIndex of the
+           contig coords of the hits, with the hits as values'''
+        intervals = {}
+        for contig_name in nucmer_hits:
+            for hit in nucmer_hits[contig_name]:
+                coords = hit.qry_coords()
+                intervals.setdefault(hit.qry_name, []).append((coords.start, coords.end, hit))
+        return {x: interval_index.IntervalIndex(intervals[x]) for x in intervals}
+
+
+    @staticmethod
+    def nucmer_hit_containing_reference_position(nucmer_hits, ref_name, ref_position, qry_name=None, ref_index=None):
         '''Returns the first nucmer match found that contains the given
            reference location. nucmer_hits = hits made by self._parse_nucmer_coords_file.
+           ref_index = made by nucmer_hits_ref_index(nucmer_hits). It is made if not given,
+           so pass it in when calling this many times on the same hits.
            Returns None if no matching hit found'''
-        for contig_name in nucmer_hits:
-            for hit in nucmer_hits[contig_name]:
-                if hit.ref_name == ref_name and (qry_name is None or qry_name == hit.qry_name) and hit.ref_coords().distance_to_point(ref_position) == 0:
-                    return hit
+        if ref_index is None:
+            ref_index = AssemblyCompare.nucmer_hits_ref_index(nucmer_hits)
+
+        if ref_name not in ref_index:
+            return None
+
+        for hit in ref_index[ref_name].containing(ref_position):
+            if qry_name is None or qry_name == hit.qry_name:
+                return hit
 
         return None
 
 
     def run(self):
-        self._run_nucmer()
+        if self.run_nucmer:
+            self._run_nucmer()
+        elif not (os.path.exists(self.nucmer_coords_file) and os.path.exists(self.nucmer_snps_file)):
+            raise Error('Nucmer files not found: ' + self.nucmer_coords_file + ' ' + self.nucmer_snps_file + '. Cannot continue')
+
         self.nucmer_hits = self._parse_nucmer_coords_file(self.nucmer_coords_file, self.ref_sequence.id)
+        self.nucmer_hits_ref_idx = self.nucmer_hits_ref_index(self.nucmer_hits)
+        self.nucmer_hits_qry_idx = self.nucmer_hits_qry_index(self.nucmer_hits)
         self.percent_identities = self._nucmer_hits_to_percent_identity(self.nucmer_hits)
         self.assembled_reference_sequences = self._get_assembled_reference_sequences(self.nucmer_hits, self.ref_sequence, self.assembly_sequences)
         ref_seq_type, is_variant_only = self.refdata.sequence_type(self.ref_sequence.id)
@@ -2,11 +2,10 @@ import signal
 import traceback
 import os
 import atexit
-import random
 import math
 import sys
 import pyfastaq
-from ariba import assembly, assembly_compare, assembly_variants, common, external_progs, flag, mapping, report, samtools_variants
+from ariba import assembly, assembly_compare, assembly_variants, common, external_progs, flag, mapping, read_store, report, samtools_variants
 
 class Error (Exception): pass
 
@@ -18,6 +17,7 @@ class Cluster:
       name,
       refdata,
       all_ref_seqs_fasta=None,
+      all_ref_seqs_index=None,
       total_reads=None,
       total_reads_bases=None,
       fail_file=None,
@@ -32,6 +32,9 @@ class Cluster:
       nucmer_min_id=90,
       nucmer_min_len=20,
       nucmer_breaklen=200,
+      aligner='nucmer',
+      read_mapper='bowtie2',
+      pileup='mpileup',
       reads_insert=500,
       sspace_k=20,
       sspace_sd=0.4,
@@ -47,7 +50,10 @@ class Cluster:
       clean=True,
       extern_progs=None,
       random_seed=42,
-      threads_total=1
+      threads_total=1,
+      ref_scores=None,
+      max_cluster_refs=0,
+      fermilite_grid_mode='full'
     ):
         self.root_dir = os.path.abspath(root_dir)
         self.read_store = read_store
@@ -63,8 +69,13 @@ class Cluster:
         if os.path.exists(self.root_dir):
             self._input_files_exist()
 
+        # total_reads and total_reads_bases are of all reads that mapped to the
+        # cluster. The read store can have fewer reads than this, if it
+        # only kept a sample of the reads (see Clusters max_reads_cov)
         self.total_reads = total_reads
         self.total_reads_bases = total_reads_bases
+        self.stored_reads = total_reads
+        self.stored_reads_bases = total_reads_bases
         self.logfile = logfile
         self.assembly_coverage = assembly_coverage
         self.assembly_kmer = assembly_kmer
@@ -86,6 +97,9 @@ class Cluster:
         self.nucmer_min_id = nucmer_min_id
         self.nucmer_min_len = nucmer_min_len
         self.nucmer_breaklen = nucmer_breaklen
+        self.aligner = aligner
+        self.read_mapper = read_mapper
+        self.pileup = pileup
 
         self.min_var_read_depth = min_var_read_depth
         self.min_second_var_read_depth = min_second_var_read_depth
@@ -99,7 +113,13 @@ class Cluster:
         self.clean = clean
 
         self.threads_total = threads_total
-        self.remaining_clusters = None
+        self.thread_tokens = None
+        self.held_thread_tokens = 0
+        self.fermilite_grid_wins = None
+        self.fermilite_grid_wins_lock = None
+        self.ref_scores = ref_scores
+        self.max_cluster_refs = max_cluster_refs
+        self.fermilite_grid_mode = fermilite_grid_mode
 
         self.assembly_dir = os.path.join(self.root_dir, 'Assembly')
         self.final_assembly_fa = os.path.join(self.root_dir, 'assembly.fa')
@@ -110,6 +130,9 @@ class Cluster:
         self.assembly_compare = None
         self.variants_from_samtools = {}
         self.assembly_compare_prefix = os.path.join(self.root_dir, 'assembly_compare')
+        # bowtie2 index of the final assembly, made when the assembly maps its reads
+        # and reused when mapping all the cluster reads. Deleted when the cluster is finished
+        self.bowtie2_index_cache_dir = os.path.join(self.root_dir, 'assembly.bowtie2_index')
 
         self.mummer_variants = {}
         self.variant_depths = {}
@@ -135,33 +158,60 @@ class Cluster:
 
         if all_ref_seqs_fasta is None:
             self.all_refs_fasta = self.references_fa
+            self.all_refs_index = None
         else:
             self.all_refs_fasta = os.path.abspath(all_ref_seqs_fasta)
+            self.all_refs_index = None if all_ref_seqs_index is None else os.path.abspath(all_ref_seqs_index)
 
         self.random_seed = random_seed
         wanted_signals = [signal.SIGABRT, signal.SIGINT, signal.SIGSEGV, signal.SIGTERM]
         for s in wanted_signals:
             signal.signal(s, self._receive_signal)
 
-    def _update_threads(self):
-        """Update available thread count post-construction.
-        To be called any number of times from run() method"""
-        if self.remaining_clusters is not None:
-            self.threads = max(1,self.threads_total//self.remaining_clusters.value)
+    def _take_threads(self, step, max_threads=None):
+        """Before a multithreaded step, take as many free thread tokens as
+        possible, up to threads_total or max_threads (the most that the step
+        can use), and set self.threads to the number held. Extra tokens are
+        only taken when no clusters are waiting to start, so that they get
+        the threads first. Call _give_back_threads when the step is finished"""
+        if self.thread_tokens is not None:
+            wanted = self.threads_total if max_threads is None else min(self.threads_total, max_threads)
+            if wanted > self.held_thread_tokens and not self.thread_tokens.clusters_waiting():
+                self.held_thread_tokens += self.thread_tokens.acquire(wanted - self.held_thread_tokens, block=False)
+            self.threads = self.held_thread_tokens
         #otherwise just keep the current (initial) value
-        print("{} detected {} threads available to it".format(self.name,self.threads), file = self.log_fh)
+        print("{} using {} thread(s) for {}".format(self.name, self.threads, step), file=self.log_fh, flush=True)
+
+    def _give_back_threads(self):
+        """After a multithreaded step, give back all thread tokens except
+        the one that this cluster holds while it is running"""
+        if self.thread_tokens is not None and self.held_thread_tokens > 1:
+            self.thread_tokens.release(self.held_thread_tokens - 1)
+            self.held_thread_tokens = 1
+            self.threads = 1
 
     def _report_completion(self):
-        """Update shared counters to signal that we are done with this cluster.
+        """Give back all thread tokens and drop the shared objects.
         Call just before exiting run() method (in a finally clause)"""
-        rem_clust = self.remaining_clusters
-        if rem_clust is not None:
-            # -= is non-atomic, need to acquire a lock
-            with self.remaining_clusters_lock:
-                rem_clust.value -= 1
+        if self.thread_tokens is not None:
+            self.thread_tokens.release(self.held_thread_tokens)
+            self.held_thread_tokens = 0
             # we do not need this object anymore
-            self.remaining_clusters = None
-            print("{} reported completion".format(self.name), file=self.log_fh)
+            self.thread_tokens = None
+        self.fermilite_grid_wins = None
+        self.fermilite_grid_wins_lock = None
+
+    def _record_fermilite_grid_win(self):
+        """Count the fermilite (overlap, min count) that made the best assembly,
+        so that later clusters try it first when using the adaptive grid"""
+        point = self.assembly.fermilite_grid_point
+        if self.fermilite_grid_wins is None or point is None:
+            return
+        if self.fermilite_grid_wins_lock is None:
+            self.fermilite_grid_wins[point] = self.fermilite_grid_wins.get(point, 0) + 1
+        else:
+            with self.fermilite_grid_wins_lock:
+                self.fermilite_grid_wins[point] = self.fermilite_grid_wins.get(point, 0) + 1
 
     def _atexit(self):
         if self.log_fh is not None:
@@ -204,7 +254,9 @@ class Cluster:
 
             self.refdata.write_seqs_to_fasta(self.references_fa, self.reference_names)
             self.log_fh = pyfastaq.utils.open_file_write(self.logfile)
-            self.total_reads, self.total_reads_bases = self.read_store.get_reads(self.name, self.all_reads1, self.all_reads2, log_fh=self.log_fh)
+            self.stored_reads, self.stored_reads_bases = self.read_store.get_reads(self.name, self.all_reads1, self.all_reads2, log_fh=self.log_fh)
+            if self.total_reads is None:
+                self.total_reads, self.total_reads_bases = self.stored_reads, self.stored_reads_bases
             self.refdata.write_seqs_to_fasta(self.references_fa, self.reference_names)
 
         self.longest_ref_length = max([len(self.refdata.sequence(name)) for name in self.reference_names])
@@ -246,6 +298,10 @@ class Cluster:
             if os.path.exists(filename):
                 self._clean_file(filename)
 
+        if os.path.exists(self.bowtie2_index_cache_dir):
+            print('Deleting directory', self.bowtie2_index_cache_dir, file=self.log_fh, flush=True)
+            common.rmtree(self.bowtie2_index_cache_dir)
+
 
     @staticmethod
     def _number_of_reads_for_assembly(ref_length, insert_size, total_bases, total_reads, coverage):
@@ -259,47 +315,63 @@ class Cluster:
 
 
     @staticmethod
-    def _make_reads_for_assembly(number_of_wanted_reads, total_reads, reads_in1, reads_in2, reads_out1, reads_out2, random_seed=None):
+    def _make_reads_for_assembly(number_of_wanted_reads, total_reads, reads_in1, reads_in2, reads_out1, reads_out2, random_seed=None, packed_reads=None):
         '''Makes fastq files that are random subset of input files. Returns total number of reads in output files.
            If the number of wanted reads is >= total reads, then just makes symlinks instead of making
-           new copies of the input files.'''
-        random.seed(random_seed)
-
+           new copies of the input files. Pairs are chosen with read_store.ReadStore.pair_is_in_sample,
+           so the same pairs are chosen as ReadStore.get_reads(..., sample_fraction=...) would choose.
+           Input files must have 4 lines per read.
+           If packed_reads is a list, the pairs that are used are also appended to it,
+           in the format of assembly.Assembly._packed_reads (join them to give to fermilite).'''
         if number_of_wanted_reads < total_reads:
             reads_written = 0
-            percent_wanted = 100 * number_of_wanted_reads / total_reads
-            file_reader1 = pyfastaq.sequences.file_reader(reads_in1)
-            file_reader2 = pyfastaq.sequences.file_reader(reads_in2)
+            fraction_wanted = number_of_wanted_reads / total_reads
+            f_in1 = pyfastaq.utils.open_file_read(reads_in1)
+            f_in2 = pyfastaq.utils.open_file_read(reads_in2)
             out1 = pyfastaq.utils.open_file_write(reads_out1)
             out2 = pyfastaq.utils.open_file_write(reads_out2)
-
-            for read1 in file_reader1:
-                try:
-                    read2 = next(file_reader2)
-                except StopIteration:
-                    pyfastaq.utils.close(out1)
-                    pyfastaq.utils.close(out2)
-                    raise Error('Error subsetting reads. No mate found for read ' + read1.id)
-
-                if random.randint(0, 100) <= percent_wanted:
-                    print(read1, file=out1)
-                    print(read2, file=out2)
-                    reads_written += 2
-
+            keep_pair = False
+
+            for i, (line1, line2) in enumerate(zip(f_in1, f_in2)):
+                if i % 4 == 0:
+                    keep_pair = read_store.ReadStore.pair_is_in_sample(i // 4 + 1, fraction_wanted, random_seed=random_seed)
+                    if keep_pair:
+                        reads_written += 2
+
+                if keep_pair:
+                    out1.write(line1)
+                    out2.write(line2)
+                    if packed_reads is not None:
+                        if i % 4 == 1:
+                            seqs = line1.rstrip(), line2.rstrip()
+                        elif i % 4 == 3:
+                            packed_reads.append('\t'.join([seqs[0], line1.rstrip(), seqs[1], line2.rstrip()]) + '\n')
+
+            different_lengths = next(f_in1, None) is not None or next(f_in2, None) is not None
+            pyfastaq.utils.close(f_in1)
+            pyfastaq.utils.close(f_in2)
             pyfastaq.utils.close(out1)
             pyfastaq.utils.close(out2)
+            if different_lengths:
+                raise Error('Error subsetting reads. Different number of reads in ' + reads_in1 + ' and ' + reads_in2)
             return reads_written
         else:
             os.symlink(reads_in1, reads_out1)
             os.symlink(reads_in2, reads_out2)
+            if packed_reads is not None:
+                packed_reads.append(assembly.Assembly._packed_reads(reads_in1, reads_in2).decode())
             return total_reads
 
 
-    def run(self,remaining_clusters=None,remaining_clusters_lock=None):
+    def run(self,thread_tokens=None,fermilite_grid_wins=None,fermilite_grid_wins_lock=None):
         try:
-            self.remaining_clusters = remaining_clusters
-            self.remaining_clusters_lock = remaining_clusters_lock
-            self._update_threads()
+            self.fermilite_grid_wins = fermilite_grid_wins
+            self.fermilite_grid_wins_lock = fermilite_grid_wins_lock
+            if thread_tokens is not None:
+                # waits if other clusters are using all the threads
+                self.held_thread_tokens = thread_tokens.start_cluster()
+                self.thread_tokens = thread_tokens
+                self.threads = 1
             self._set_up_input_files()
 
             for fname in [self.all_reads1, self.all_reads2, self.references_fa]:
@@ -333,16 +405,22 @@ class Cluster:
     def _run(self):
         print('{:_^79}'.format(' LOG FILE START ' + self.name + ' '), file=self.log_fh, flush=True)
 
-        if self.total_reads == 0:
+        if self.stored_reads == 0:
             print('No reads left after filtering with cdhit', file=self.log_fh, flush=True)
             self.assembled_ok = False
         else:
-            wanted_reads = self._number_of_reads_for_assembly(self.longest_ref_length, self.reads_insert, self.total_reads_bases, self.total_reads, self.assembly_coverage)
-            made_reads = self._make_reads_for_assembly(wanted_reads, self.total_reads, self.all_reads1, self.all_reads2, self.reads_for_assembly1, self.reads_for_assembly2, random_seed=self.random_seed)
-            print('\nUsing', made_reads, 'from a total of', self.total_reads, 'for assembly.', file=self.log_fh, flush=True)
+            if self.stored_reads != self.total_reads:
+                print('\nRead store has a sample of', self.stored_reads, 'from a total of', self.total_reads, 'reads.', file=self.log_fh, flush=True)
+            wanted_reads = self._number_of_reads_for_assembly(self.longest_ref_length, self.reads_insert, self.stored_reads_bases, self.stored_reads, self.assembly_coverage)
+            # fermilite takes the reads in memory, so get them while the reads are being
+            # written, instead of Assembly reading the files again
+            packed_reads = [] if self.assembler == 'fermilite' else None
+            made_reads = self._make_reads_for_assembly(wanted_reads, self.stored_reads, self.all_reads1, self.all_reads2, self.reads_for_assembly1, self.reads_for_assembly2, random_seed=self.random_seed, packed_reads=packed_reads)
+            print('\nUsing', made_reads, 'from a total of', self.stored_reads, 'for assembly.', file=self.log_fh, flush=True)
             print('Assembling reads:', file=self.log_fh, flush=True)
 
-            self._update_threads()
+            # fermilite runs one grid point per thread, so cannot use more threads than that
+            self._take_threads('assembly', max_threads=len(assembly.fermilite_grid) if self.assembler == 'fermilite' else None)
             self.assembly = assembly.Assembly(
               self.reads_for_assembly1,
               self.reads_for_assembly2,
@@ -355,15 +433,31 @@ class Cluster:
               self.all_refs_fasta,
               contig_name_prefix=self.name,
               assembler=self.assembler,
+              aligner=self.aligner,
+              read_mapper=self.read_mapper,
               extern_progs=self.extern_progs,
               clean=self.clean,
               spades_mode=self.spades_mode,
               spades_options=self.spades_options,
-              threads=self.threads
+              threads=self.threads,
+              ref_scores=self.ref_scores,
+              max_cluster_refs=self.max_cluster_refs,
+              all_reference_index=self.all_refs_index,
+              fermilite_grid_mode=self.fermilite_grid_mode,
+              fermilite_grid_wins=None if self.fermilite_grid_wins is None else self.fermilite_grid_wins.copy(),
+              assembled_threshold=self.assembled_threshold,
+              final_assembly_nucmer_coords=self.assembly_compare_prefix + '.nucmer.coords',
+              bowtie2_index_cache_dir=self.bowtie2_index_cache_dir,
+              reads_packed=None if packed_reads is None else ''.join(packed_reads).encode(),
             )
+            packed_reads = None
 
-            self.assembly.run()
+            try:
+                self.assembly.run()
+            finally:
+                self._give_back_threads()
             self.assembled_ok = self.assembly.assembled_ok
+            self._record_fermilite_grid_win()
             self._clean_file(self.reads_for_assembly1)
             self._clean_file(self.reads_for_assembly2)
             if self.clean:
@@ -378,20 +472,25 @@ class Cluster:
             self.is_variant_only = '1' if is_variant_only else '0'
 
             print('\nAssembly was successful\n\nMapping reads to assembly:', file=self.log_fh, flush=True)
-            self._update_threads()
-            mapping.run_bowtie2(
-                self.all_reads1,
-                self.all_reads2,
-                self.final_assembly_fa,
-                self.final_assembly_bam[:-4],
-                threads=self.threads,
-                sort=True,
-                bowtie2=self.extern_progs.exe('bowtie2'),
-                bowtie2_preset='very-sensitive-local',
-                bowtie2_version=self.extern_progs.version('bowtie2'),
-                verbose=True,
-                verbose_filehandle=self.log_fh
-            )
+            self._take_threads('mapping reads to assembly')
+            try:
+                mapping.run_read_mapper(
+                    self.read_mapper,
+                    self.all_reads1,
+                    self.all_reads2,
+                    self.final_assembly_fa,
+                    self.final_assembly_bam[:-4],
+                    threads=self.threads,
+                    sort=True,
+                    bowtie2=self.extern_progs.exe('bowtie2'),
+                    bowtie2_preset='very-sensitive-local',
+                    bowtie2_version=self.extern_progs.version('bowtie2'),
+                    verbose=True,
+                    verbose_filehandle=self.log_fh,
+                    index_cache_dir=self.bowtie2_index_cache_dir,
+                )
+            finally:
+                self._give_back_threads()
 
             if self.assembly.has_contigs_on_both_strands:
                 self.status_flag.add('hit_both_strands')
@@ -412,9 +511,11 @@ class Cluster:
               nucmer_min_id=self.nucmer_min_id,
               nucmer_min_len=self.nucmer_min_len,
               nucmer_breaklen=self.nucmer_breaklen,
+              aligner=self.aligner,
               assembled_threshold=self.assembled_threshold,
               unique_threshold=self.unique_threshold,
               max_gene_nt_extend=self.max_gene_nt_extend,
+              run_nucmer=not self.assembly.final_assembly_nucmer_coords_written,
             )
             self.assembly_compare.run()
             self.status_flag = self.assembly_compare.update_flag(self.status_flag)
@@ -442,7 +543,9 @@ class Cluster:
                 log_fh=self.log_fh,
                 min_var_read_depth=self.min_var_read_depth,
                 min_second_var_read_depth=self.min_second_var_read_depth,
-                max_allele_freq=self.max_allele_freq
+                max_allele_freq=self.max_allele_freq,
+                pileup=self.pileup,
+                make_read_depths_file=not self.clean,
             )
             self.samtools_vars.run()
 
@@ -0,0 +1,82 @@
+from ariba import flag
+
+class Error (Exception): pass
+
+
+class ClusterResult:
+    '''What the parent process needs from a finished cluster: the report lines,
+       the sequences for the catted fasta files, the flag and some read counts.
+       This is sent back from the pool workers instead of the whole Cluster,
+       which holds the assembly, nucmer hits, variants etc.
+       Bump version whenever the attributes change'''
+    version = 1
+
+    def __init__(self,
+      name,
+      report_lines=None,
+      assembly_sequences=None,
+      assembled_reference_sequences=None,
+      gene_matching_ref=None,
+      gene_matching_ref_type=None,
+      gene_start_bases_added=None,
+      gene_end_bases_added=None,
+      status_flag=None,
+      stats=None,
+    ):
+        self.result_version = ClusterResult.version
+        self.name = name
+        self.report_lines = report_lines
+        self.assembly_sequences = assembly_sequences
+        self.assembled_reference_sequences = assembled_reference_sequences
+        self.gene_matching_ref = gene_matching_ref
+        self.gene_matching_ref_type = gene_matching_ref_type
+        self.gene_start_bases_added = gene_start_bases_added
+        self.gene_end_bases_added = gene_end_bases_added
+        self.status_flag = flag.Flag() if status_flag is None else status_flag
+        self.stats = {} if stats is None else stats
+
+
+    def __eq__(self, other):
+        return type(other) is type(self) and self.__dict__ == other.__dict__
+
+
+    @classmethod
+    def from_cluster(cls, c):
+        '''Makes a ClusterResult from a cluster.Cluster object. Works whether
+           or not the cluster was run, or it failed part of the way through'''
+        assembly = getattr(c, 'assembly', None)
+        compare = getattr(c, 'assembly_compare', None)
+        ref_sequence = getattr(c, 'ref_sequence', None)
+
+        return ClusterResult(
+            c.name,
+            report_lines=getattr(c, 'report_lines', None),
+            assembly_sequences=getattr(assembly, 'sequences', None),
+            assembled_reference_sequences=getattr(compare, 'assembled_reference_sequences', None),
+            gene_matching_ref=getattr(compare, 'gene_matching_ref', None),
+            gene_matching_ref_type=getattr(compare, 'gene_matching_ref_type', None),
+            gene_start_bases_added=getattr(compare, 'gene_start_bases_added', None),
+            gene_end_bases_added=getattr(compare, 'gene_end_bases_added', None),
+            status_flag=c.status_flag,
+            stats={
+                'ref_name': None if ref_sequence is None else ref_sequence.id,
+                'total_reads': c.total_reads,
+                'total_reads_bases': c.total_reads_bases,
+                'stored_reads': c.stored_reads,
+                'stored_reads_bases': c.stored_reads_bases,
+            },
+        )
+
+
+    def remove_outputs(self):
+        '''Removes the report lines and sequences, for when they have
+           been written to the output files and are no longer needed'''
+        self.report_lines = None
+        self.assembly_sequences = None
+        self.assembled_reference_sequences = None
+        self.gene_matching_ref = None
+
+
+    def check_version(self):
+        if self.result_version != ClusterResult.version:
+            raise Error('Cluster result for ' + self.name + ' has version ' + str(self.result_version) + ', but expected version ' + str(ClusterResult.version) + '. Cannot continue')
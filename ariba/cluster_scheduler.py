@@ -0,0 +1,81 @@
+import pyfastaq
+
+class Error (Exception): pass
+
+
+timings_columns = ['cluster', 'reads', 'bases', 'ref_length', 'seconds']
+
+
+class ClusterScheduler:
+    '''Estimates the cost of running each cluster, so that the most expensive
+       clusters can be started first. Otherwise a big cluster that happens to
+       be started last can leave most of the threads idle at the end of the run.
+
+       Without timings, the cost of a cluster is its number of read bases,
+       because that is what the assembly and read mapping times mostly depend
+       on. Ties are broken by reference length.
+
+       With a timings file from an earlier run (see write_timings_file), a
+       cluster that is in that file gets its earlier run time, scaled by the
+       change in number of read bases. Other clusters get the mean seconds
+       per read base of all the clusters in the file'''
+    def __init__(self, timings_file=None):
+        self.timings = {} # cluster name -> (reads, bases, ref_length, seconds)
+        self.seconds_per_base = None
+        if timings_file is not None:
+            self.timings = ClusterScheduler.load_timings_file(timings_file)
+            total_bases = sum([x[1] for x in self.timings.values()])
+            if total_bases > 0:
+                self.seconds_per_base = sum([x[3] for x in self.timings.values()]) / total_bases
+
+
+    @staticmethod
+    def load_timings_file(filename):
+        timings = {}
+        f = pyfastaq.utils.open_file_read(filename)
+        for line in f:
+            if line.startswith('#'):
+                continue
+
+            fields = line.rstrip().split('\t')
+            if len(fields) != len(timings_columns):
+                pyfastaq.utils.close(f)
+                raise Error('Expected ' + str(len(timings_columns)) + ' columns in timings file ' + filename + ' but got this line:\n' + line)
+
+            try:
+                timings[fields[0]] = (int(fields[1]), int(fields[2]), int(fields[3]), float(fields[4]))
+            except ValueError:
+                pyfastaq.utils.close(f)
+                raise Error('Error getting numbers from this line of timings file ' + filename + ':\n' + line)
+
+        pyfastaq.utils.close(f)
+        return timings
+
+
+    @staticmethod
+    def write_timings_file(timings, filename):
+        '''timings = dictionary of cluster name -> (reads, bases, ref_length, seconds)'''
+        f = pyfastaq.utils.open_file_write(filename)
+        print('#' + '\t'.join(timings_columns), file=f)
+        for name in sorted(timings):
+            reads, bases, ref_length, seconds = timings[name]
+            print(name, reads, bases, ref_length, round(seconds, 2), sep='\t', file=f)
+        pyfastaq.utils.close(f)
+
+
+    def cost(self, name, reads, bases, ref_length):
+        '''Returns tuple that sorts clusters from cheapest to most expensive'''
+        if name in self.timings and self.timings[name][1] > 0:
+            old_bases, old_seconds = self.timings[name][1], self.timings[name][3]
+            return (old_seconds * bases / old_bases, ref_length)
+        elif self.seconds_per_base is not None:
+            return (self.seconds_per_base * bases, ref_length)
+        else:
+            return (bases, ref_length)
+
+
+    def order(self, clusters):
+        '''clusters = list of (name, reads, bases, ref_length) tuples.
+           Returns list of names, most expensive first'''
+        costs = {x[0]: self.cost(*x) for x in clusters}
+        return sorted(costs, key=lambda x: (costs[x], x), reverse=True)
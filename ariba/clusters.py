@@ -5,29 +5,57 @@ import copy
 import tempfile
 import pickle
 import itertools
+import math
 import sys
+import traceback
 import multiprocessing
 import pyfastaq
 import minimap_ariba
-from ariba import cluster, common, histogram, mlst_reporter, read_store, report, report_filter, reference_data
+from ariba import cluster, cluster_result, cluster_scheduler, common, histogram, mlst_reporter, read_store, report, report_filter, reference_data, streamed_output, thread_tokens
 
 class Error (Exception): pass
 
-# passing shared objects (remaining_clusters) through here and thus making them
+# The reference data, read store and minimap scores of the reference sequences
+# are the same for every cluster, and can be large (eg megares has thousands of
+# sequences, each with metadata). Instead of pickling them into every cluster
+# task and back again, each pool worker gets them once from _init_shared_data,
+# which is the pool initializer. With the default fork start method they are
+# inherited from the parent process and are not pickled at all.
+# The thread tokens must also be given to the workers this way, because
+# multiprocessing semaphores cannot be pickled.
+_shared_data = {'refdata': None, 'read_store': None, 'ref_scores': None, 'thread_tokens': None}
+
+
+def _init_shared_data(refdata, read_store, ref_scores=None, thread_tokens=None):
+    _shared_data['refdata'] = refdata
+    _shared_data['read_store'] = read_store
+    _shared_data['ref_scores'] = ref_scores
+    _shared_data['thread_tokens'] = thread_tokens
+
+
+# passing shared objects (fermilite_grid_wins) through here and thus making them
 # explicit arguments to Pool.startmap when running this function. That seems to be
 # a recommended safe transfer mechanism as opposed making them attributes of a
-# pre-constructed 'obj' variable (although the docs are a bit hazy on that)
-def _run_cluster(obj, verbose, clean, fails_dir, remaining_clusters, remaining_clusters_lock):
+# pre-constructed 'obj' variable (although the docs are a bit hazy on that).
+# cluster_options = dict of keyword arguments for cluster.Cluster, apart from
+# refdata, read_store and ref_scores, which come from _shared_data.
+# Returns a cluster_result.ClusterResult, not the Cluster, so that only what
+# the parent needs for the final output files is sent back
+def _run_cluster(cluster_options, verbose, clean, fails_dir, fermilite_grid_wins=None, fermilite_grid_wins_lock=None):
+    obj = cluster.Cluster(refdata=_shared_data['refdata'], read_store=_shared_data['read_store'], ref_scores=_shared_data['ref_scores'], **cluster_options)
     failed_clusters = os.listdir(fails_dir)
 
     if len(failed_clusters) > 0:
         print('Other clusters failed. Will not start cluster', obj.name, file=sys.stderr)
-        return obj
+        if _shared_data['thread_tokens'] is not None:
+            _shared_data['thread_tokens'].skip_cluster()
+        return cluster_result.ClusterResult.from_cluster(obj)
 
     if verbose:
         print('Start running cluster', obj.name, 'in directory', obj.root_dir, flush=True)
+    start_time = time.time()
     try:
-        obj.run(remaining_clusters=remaining_clusters,remaining_clusters_lock=remaining_clusters_lock)
+        obj.run(thread_tokens=_shared_data['thread_tokens'],fermilite_grid_wins=fermilite_grid_wins,fermilite_grid_wins_lock=fermilite_grid_wins_lock)
     except:
         print('Failed cluster:', obj.name, file=sys.stderr)
         with open(os.path.join(fails_dir, obj.name), 'w'):
@@ -45,7 +73,15 @@ def _run_cluster(obj, verbose, clean, fails_dir, remaining_clusters, remaining_c
             except:
                 pass
 
-    return obj
+    result = cluster_result.ClusterResult.from_cluster(obj)
+    result.stats['seconds'] = time.time() - start_time
+    return result
+
+
+def _run_cluster_from_args(args):
+    '''Calls _run_cluster(*args). Needed because Pool.imap_unordered
+    only passes one argument to the function it calls'''
+    return _run_cluster(*args)
 
 
 class Clusters:
@@ -58,9 +94,13 @@ class Clusters:
       version_report_lines=None,
       assembly_kmer=21,
       assembly_coverage=100,
+      max_reads_cov=0,
+      max_cluster_refs=0,
       threads=1,
+      cluster_timings=None,
       verbose=False,
       assembler='fermilite',
+      fermilite_grid_mode='full',
       spades_mode='rna',
       spades_options=None,
       max_insert=1000,
@@ -68,6 +108,9 @@ class Clusters:
       nucmer_min_id=90,
       nucmer_min_len=20,
       nucmer_breaklen=200,
+      aligner='nucmer',
+      read_mapper='bowtie2',
+      pileup='mpileup',
       assembled_threshold=0.95,
       unique_threshold=0.03,
       max_gene_nt_extend=30,
@@ -82,6 +125,7 @@ class Clusters:
         self.extern_progs = extern_progs
         self.clusters_tsv = os.path.abspath(os.path.join(refdata_dir, '02.cdhit.clusters.tsv'))
         self.all_ref_seqs_fasta = os.path.abspath(os.path.join(refdata_dir, '02.cdhit.all.fa'))
+        self.all_ref_seqs_minimap_index = os.path.abspath(os.path.join(refdata_dir, '02.cdhit.all.mmi'))
 
         if version_report_lines is None:
             self.version_report_lines = []
@@ -92,8 +136,11 @@ class Clusters:
         self.logs_dir = os.path.join(self.outdir, 'Logs')
 
         self.assembler = assembler
+        self.fermilite_grid_mode = fermilite_grid_mode
         self.assembly_kmer = assembly_kmer
         self.assembly_coverage = assembly_coverage
+        self.max_reads_cov = max_reads_cov
+        self.max_cluster_refs = max_cluster_refs
         self.spades_mode = spades_mode
         self.spades_options = spades_options
 
@@ -108,6 +155,9 @@ class Clusters:
         self.catted_assembled_seqs_fasta = os.path.join(self.outdir, 'assembled_seqs.fa.gz')
         self.catted_genes_matching_refs_fasta = os.path.join(self.outdir, 'assembled_genes.fa.gz')
         self.catted_assemblies_fasta = os.path.join(self.outdir, 'assemblies.fa.gz')
+        self.clusters_log_file = os.path.join(self.outdir, 'log.clusters.gz')
+        self.cluster_timings_in = None if cluster_timings is None else os.path.abspath(cluster_timings)
+        self.cluster_timings_out = os.path.join(self.outdir, 'cluster_timings.tsv')
         self.threads = threads
         self.verbose = verbose
 
@@ -123,15 +173,21 @@ class Clusters:
         self.nucmer_min_id = nucmer_min_id
         self.nucmer_min_len = nucmer_min_len
         self.nucmer_breaklen = nucmer_breaklen
+        self.aligner = aligner
+        self.read_mapper = read_mapper
+        self.pileup = pileup
 
         self.assembled_threshold = assembled_threshold
         self.unique_threshold = unique_threshold
         self.max_gene_nt_extend = max_gene_nt_extend
 
         self.cluster_to_dir = {}  # gene name -> abs path of cluster directory
-        self.clusters = {}        # gene name -> Cluster object
+        self.clusters = {}        # gene name -> cluster_result.ClusterResult object, without its outputs
+        self.streamed_outputs = {} # name -> streamed_output.StreamedOutput, that cluster results are written to as they finish
         self.cluster_read_counts = {} # gene name -> number of reads
         self.cluster_base_counts = {} # gene name -> number of bases
+        self.cluster_ref_lengths = {} # gene name -> length of longest reference sequence
+        self.refname_to_score = {} # reference name -> minimap score
         self.pool = None
         self.fails_dir = os.path.join(self.outdir ,'.fails')
         self.clusters_all_ran_ok = True
@@ -246,12 +302,24 @@ class Clusters:
 
         minimap_prefix = 'minimap'
 
-        self._minimap_reads_to_all_ref_seqs(
+        if self.max_reads_cov > 0:
+            mean_read_length = self._mean_read_length(self.reads_1)
+            max_read_pairs = self._cluster_max_read_pairs(self.cluster_ids, self.refdata, max(self.max_reads_cov, self.assembly_coverage), self.max_insert, mean_read_length)
+            if self.verbose:
+                print('Keeping at most', self.max_reads_cov, 'read depth per cluster. Mean read length is', round(mean_read_length, 1), flush=True)
+        else:
+            max_read_pairs = None
+
+        minimap_results = self._minimap_reads_to_all_ref_seqs(
             self.clusters_tsv,
             self.all_ref_seqs_fasta,
             self.reads_1,
             self.reads_2,
             minimap_prefix,
+            threads=self.threads,
+            index_file=self.all_ref_seqs_minimap_index,
+            max_read_pairs=max_read_pairs,
+            write_summary_files=not self.clean,
             verbose=self.verbose
         )
 
@@ -259,9 +327,10 @@ class Clusters:
             print('Finished mapping\n')
             print('{:_^79}'.format(' Generating clusters '), flush=True)
 
-        self.cluster_to_rep, self.cluster_read_counts, self.cluster_base_counts, self.insert_hist, self.proper_pairs = self._load_minimap_files(minimap_prefix, self.insert_hist_bin)
+        self.cluster_to_rep, self.cluster_read_counts, self.cluster_base_counts, self.insert_hist, self.proper_pairs = self._load_minimap_results(minimap_results, self.insert_hist_bin)
+        self.refname_to_score = minimap_results['refname_to_score']
         self.cluster_to_dir = {x: os.path.join(self.tmp_dir, x) for x in self.cluster_to_rep}
-        reads_file_for_read_store = minimap_prefix + '.reads'
+        reads_prefix_for_read_store = minimap_prefix + '.reads'
 
         if len(self.cluster_read_counts):
             if self.verbose:
@@ -270,20 +339,14 @@ class Clusters:
                 filehandle = None
 
             self.read_store = read_store.ReadStore(
-              reads_file_for_read_store,
+              reads_prefix_for_read_store,
               os.path.join(self.outdir, 'read_store'),
-              log_fh=filehandle
+              log_fh=filehandle,
+              blocks=True,
             )
-
-        os.unlink(reads_file_for_read_store)
-
-        if self.clean:
-            for suffix in ['cluster2representative', 'clusterCounts', 'insertHistogram', 'properPairs']:
-                filename = minimap_prefix + '.' + suffix
-                try:
-                    os.unlink(filename)
-                except:
-                    pass
+        else:
+            for suffix in read_store.block_store_suffixes:
+                os.unlink(reads_prefix_for_read_store + suffix)
 
         if self.verbose:
             print('Found', self.proper_pairs, 'proper read pairs from minimap')
@@ -291,11 +354,60 @@ class Clusters:
 
 
     @staticmethod
-    def _minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, outprefix, verbose=False):
-        got = minimap_ariba.minimap_ariba(clusters_tsv, ref_fasta, reads_1, reads_2, outprefix)
+    def _mean_read_length(reads_file, max_reads=10000):
+        '''Returns mean length of the first max_reads reads in the file'''
+        total_reads = 0
+        total_bases = 0
+
+        for read in pyfastaq.sequences.file_reader(reads_file):
+            total_reads += 1
+            total_bases += len(read)
+            if total_reads >= max_reads:
+                break
+
+        if total_reads == 0:
+            raise Error('No reads found in file ' + reads_file + '. Cannot continue')
+
+        return total_bases / total_reads
+
+
+    @staticmethod
+    def _cluster_max_read_pairs(cluster_ids, refdata, coverage, max_insert, mean_read_length):
+        '''Returns dict of cluster name -> maximum number of read pairs to keep
+           from mapping, to get the given read coverage across the longest reference
+           in the cluster plus max_insert either side'''
+        max_pairs = {}
+
+        for cluster_name, ref_names in cluster_ids.items():
+            ref_length = max([len(refdata.sequence(x)) for x in ref_names]) + 2 * max_insert
+            max_pairs[cluster_name] = int(math.ceil(coverage * ref_length / (2 * mean_read_length)))
+
+        return max_pairs
+
+
+    @staticmethod
+    def _minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, outprefix, threads=1, index_file=None, block_read_store=True, max_read_pairs=None, write_summary_files=False, verbose=False):
+        '''Maps reads with minimap. Returns dict of results (see _load_minimap_results).
+           If write_summary_files is True, also writes the results to files
+           outprefix.{cluster2representative,clusterCounts,insertHistogram,properPairs}'''
+        # Older prepareref directories do not have a minimap index file, in
+        # which case minimap_ariba makes the index from the fasta file
+        if index_file is None or not os.path.exists(index_file):
+            index_file = ''
+        elif verbose:
+            print('Using minimap index file', index_file, flush=True)
+
+        # max_read_pairs is a dict of cluster name -> max number of read pairs.
+        # Those clusters only keep a random sample of their read pairs
+        if max_read_pairs is None:
+            max_read_pairs = {}
+
+        got, results = minimap_ariba.minimap_ariba(clusters_tsv, ref_fasta, reads_1, reads_2, outprefix, threads, index_file, int(block_read_store), max_read_pairs, int(write_summary_files))
         if (got != 0):
             raise Error('Error running minimap. Cannot continue')
 
+        return results
+
 
     @classmethod
     def _load_minimap_out_cluster2representative(cls, infile):
@@ -354,6 +466,18 @@ class Clusters:
         return cluster2rep, cluster_read_count, cluster_base_count, insert_hist, proper_pairs
 
 
+    @staticmethod
+    def _load_minimap_results(results, hist_bin_size):
+        '''Same as _load_minimap_files, but uses the dict returned by minimap_ariba
+           instead of the files. The dict also has the minimap score of each
+           reference sequence, in results['refname_to_score']'''
+        insert_hist = histogram.Histogram(hist_bin_size)
+        for value, count in sorted(results['insert_histogram'].items()):
+            insert_hist.add(value, count=count)
+
+        return results['cluster2representative'], results['cluster_read_counts'], results['cluster_base_counts'], insert_hist, results['proper_pairs']
+
+
     def _set_insert_size_data(self):
         if len(self.insert_hist) == 0:
             return False
@@ -377,28 +501,23 @@ class Clusters:
         counter = 0
         cluster_list = []
         self.log_files = []
-
-        # How the thread count withing each Cluster.run is managed:
-        # We want to handle those cases where there are more total threads allocated to the application than there are clusters
-        # remaining to run (for example,
-        # there are only two references, and eight threads). If we keep the default thread value of 1 in cluster. Cluster,
-        # then we will be wasting the allocated threads. The most simple approach would be to divide all threads equally between clusters
-        # before calling Pool.map. Multithreaded external programs like Spades and Bowtie2 are then called with multiple threads. That should
-        # never be slower than keeping just one thread in cluster.Cluster, except maybe in the extreme cases when (if)
-        # a multi-threaded run of the external program takes longer wall-clock time than a single-threaded one.
-        # However, this solution would always keep
-        # Cluster.threads=1 if the initial number of clusters > number of total threads. This can result in inefficiency at the
-        # tail of the Pool.map execution flow - when the clusters are getting finished overall, we are waiting for the completion of
-        # fewer and fewer remaining
-        # single-threaded cluster tasks while more and more total threads are staying idle. We mitigate this through the following approach:
-        # - Create a shared Value object that holds the number of remaining clusters (remaining_clusters).
-        # - Each Cluster.run decrements the remaining_clusters when it completes
-        # - Cluster.run sets its own thread count to max(1,threads_total//remaining_clusters). This can be done as many times
-        #   as needed at various points within Cluster.run (e.g. once before Spades is called, and again before Bowtie2 is called),
-        #   in order to catch more idle threads.
-        # This is a simple and conservative approach to adaptively use all threads at the tail of the map flow. It
-        # never over-subscribes the threads, and it does not require any extra blocking within Cluster.run in order to
-        # wait for threads becoming available.
+        self.streamed_outputs['logs'] = streamed_output.StreamedOutput(self.clusters_log_file)
+
+        # How the thread count within each Cluster.run is managed:
+        # The pool has one process per thread, so while there are more clusters
+        # than threads, every cluster runs single-threaded. When there are fewer
+        # clusters left than threads, the idle threads are given to the clusters
+        # that are still running, using a thread_tokens.ThreadTokens with one token
+        # per thread:
+        # - Cluster.run takes one token when it starts, waiting if all are in use,
+        #   and gives back all its tokens when it finishes.
+        # - Before a multithreaded step (assembly, which can be spades, the threaded
+        #   fermilite grid or bowtie2, and mapping reads to the final assembly),
+        #   Cluster takes as many free tokens as it can, without waiting, and uses that
+        #   many threads. It gives them back as soon as the step is done, so they can
+        #   be used by other clusters.
+        # This never over-subscribes the threads, and threads freed by a cluster that
+        # finishes early are picked up by the next multithreaded step of any other cluster.
 
         for cluster_name in sorted(self.cluster_to_dir):
             counter += 1
@@ -413,13 +532,14 @@ class Clusters:
             new_dir = self.cluster_to_dir[cluster_name]
             self.log_files.append(os.path.join(self.logs_dir, cluster_name + '.log'))
 
-            cluster_list.append(cluster.Cluster(
-                new_dir,
-                cluster_name,
-                self.refdata,
+            cluster_list.append(dict(
+                root_dir=new_dir,
+                name=cluster_name,
                 all_ref_seqs_fasta=self.all_ref_seqs_fasta,
+                all_ref_seqs_index=self.all_ref_seqs_minimap_index if os.path.exists(self.all_ref_seqs_minimap_index) else None,
+                total_reads=self.cluster_read_counts[cluster_name],
+                total_reads_bases=self.cluster_base_counts[cluster_name],
                 fail_file=os.path.join(self.fails_dir, cluster_name),
-                read_store=self.read_store,
                 reference_names=self.cluster_ids[cluster_name],
                 logfile=self.log_files[-1],
                 assembly_coverage=self.assembly_coverage,
@@ -430,6 +550,9 @@ class Clusters:
                 nucmer_min_id=self.nucmer_min_id,
                 nucmer_min_len=self.nucmer_min_len,
                 nucmer_breaklen=self.nucmer_breaklen,
+                aligner=self.aligner,
+                read_mapper=self.read_mapper,
+                pileup=self.pileup,
                 reads_insert=self.insert_size,
                 sspace_k=self.min_scaff_depth,
                 sspace_sd=self.insert_sspace_sd,
@@ -441,10 +564,23 @@ class Clusters:
                 spades_options=self.spades_options,
                 clean=self.clean,
                 extern_progs=self.extern_progs,
-                threads_total=self.threads
+                threads_total=self.threads,
+                max_cluster_refs=self.max_cluster_refs,
+                fermilite_grid_mode=self.fermilite_grid_mode
             ))
+
+        # Start the most expensive clusters first, so that the pool is not
+        # left waiting on one big cluster that happened to be started last
+        self.cluster_ref_lengths = {x['name']: max([len(self.refdata.sequence(y)) for y in x['reference_names']]) for x in cluster_list}
+        scheduler = cluster_scheduler.ClusterScheduler(timings_file=self.cluster_timings_in)
+        run_order = scheduler.order([(x['name'], x['total_reads'], x['total_reads_bases'], self.cluster_ref_lengths[x['name']]) for x in cluster_list])
+        run_order = {run_order[i]: i for i in range(len(run_order))}
+        cluster_list.sort(key=lambda x: run_order[x['name']])
+        if self.verbose:
+            print('Clusters will be started in this order (most expensive first):', *[x['name'] for x in cluster_list], flush=True)
+
         # Here is why we use proxy objects from a Manager process below
-        # instead of simple shared multiprocessing.Value counter:
+        # instead of shared memory objects like multiprocessing.Value:
         # Shared memory objects in multiprocessing use tempfile module to
         # create temporary directory, then create temporary file inside it,
         # memmap the file and unlink it. If TMPDIR envar points to a NFS
@@ -455,103 +591,126 @@ class Clusters:
         # inside multiprocessing cleanup, and only a harmless traceback is printed,
         # but it looks very spooky to the user and causes confusion. We use
         # instead shared proxies from the Manager. Those do not rely on shared
-        # memory, and thus bypass the NFS issues. The counter is accesses infrequently
+        # memory, and thus bypass the NFS issues. The dictionary is accessed infrequently
         # relative to computations, so the performance does not suffer.
-        # default authkey in the manager will be some generated random-looking string
-        manager = multiprocessing.Manager()
-        remaining_clusters = manager.Value('l',len(cluster_list))
-        # manager.Value does not provide access to the internal RLock that we need for
-        # implementing atomic -=, so we need to carry around a separate RLock object.
-        remaining_clusters_lock = manager.RLock()
+        # default authkey in the manager will be some generated random-looking string.
+        # (The semaphore in thread_tokens.ThreadTokens does not use temporary files.)
+        # fermilite_grid_wins = (overlap, min count) -> number of clusters whose best
+        # fermilite assembly used it. Only needed for the adaptive grid, which tries
+        # the most winning ones first
+        if self.assembler == 'fermilite' and self.fermilite_grid_mode == 'adaptive':
+            manager = multiprocessing.Manager()
+            fermilite_grid_wins = manager.dict()
+            # manager.dict does not provide an atomic increment, so we need to
+            # carry around a separate lock object.
+            fermilite_grid_wins_lock = manager.RLock()
+        else:
+            manager = None
+            fermilite_grid_wins = None
+            fermilite_grid_wins_lock = None
+
+        # Results are collected in the order that the clusters finish, and
+        # written straight away to the output files (see _add_cluster_result)
+        ref_scores = self.refname_to_score if self.max_cluster_refs > 0 else None
         try:
             if self.threads > 1:
-                self.pool = multiprocessing.Pool(self.threads)
-                cluster_list = self.pool.starmap(_run_cluster, zip(cluster_list, itertools.repeat(self.verbose), itertools.repeat(self.clean), itertools.repeat(self.fails_dir),
-                                                                   itertools.repeat(remaining_clusters),itertools.repeat(remaining_clusters_lock)))
+                tokens = thread_tokens.ThreadTokens(self.threads, waiting=len(cluster_list))
+                self.pool = multiprocessing.Pool(self.threads, initializer=_init_shared_data, initargs=(self.refdata, self.read_store, ref_scores, tokens))
+                run_args = zip(cluster_list, itertools.repeat(self.verbose), itertools.repeat(self.clean), itertools.repeat(self.fails_dir),
+                               itertools.repeat(fermilite_grid_wins),itertools.repeat(fermilite_grid_wins_lock))
+                for result in self.pool.imap_unordered(_run_cluster_from_args, run_args):
+                    self._add_cluster_result(result, len(cluster_list))
                 # harvest the pool as soon as we no longer need it
                 self.pool.close()
                 self.pool.join()
             else:
+                _init_shared_data(self.refdata, self.read_store, ref_scores)
                 for c in cluster_list:
-                    _run_cluster(c, self.verbose, self.clean, self.fails_dir, remaining_clusters, remaining_clusters_lock)
+                    self._add_cluster_result(_run_cluster(c, self.verbose, self.clean, self.fails_dir, fermilite_grid_wins, fermilite_grid_wins_lock), len(cluster_list))
         except:
+            # This also catches errors from writing the streamed outputs in
+            # this process, so say what went wrong instead of just failing
+            print('Error running clusters:', file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            self._stop_pool()
+            self._remove_streamed_outputs()
             self.clusters_all_ran_ok = False
+        finally:
+            _init_shared_data(None, None)
 
-        if self.verbose:
-            print('Final value of remaining_clusters counter:', remaining_clusters)
-        remaining_clusters = None
-        remaining_clusters_lock = None
-        manager.shutdown()
+        fermilite_grid_wins = None
+        fermilite_grid_wins_lock = None
+        if manager is not None:
+            manager.shutdown()
 
         if len(os.listdir(self.fails_dir)) > 0:
             self.clusters_all_ran_ok = False
 
-        self.clusters = {c.name: c for c in cluster_list}
-
-
-    @staticmethod
-    def _write_report(clusters_in, tsv_out):
-        columns = copy.copy(report.columns)
-        columns[0] = '#' + columns[0]
-
-        f = pyfastaq.utils.open_file_write(tsv_out)
-        print('\t'.join(columns), file=f)
-        columns[0] = columns[0][1:]
+        self._write_cluster_timings_file(self.cluster_timings_out)
 
-        for seq_name in sorted(clusters_in):
-            if clusters_in[seq_name].report_lines is None:
-                continue
-
-            for line in clusters_in[seq_name].report_lines:
-                print(line, file=f)
 
-        pyfastaq.utils.close(f)
+    def _write_cluster_timings_file(self, outfile):
+        timings = {}
+        for name, result in self.clusters.items():
+            if 'seconds' in result.stats:
+                timings[name] = (result.stats['total_reads'], result.stats['total_reads_bases'], self.cluster_ref_lengths[name], result.stats['seconds'])
+        cluster_scheduler.ClusterScheduler.write_timings_file(timings, outfile)
 
 
-    def _write_catted_assemblies_fasta(self, outfile):
-        f = pyfastaq.utils.open_file_write(outfile)
-
-        for gene in sorted(self.clusters):
-            try:
-                seq_dict = self.clusters[gene].assembly.sequences
-            except:
-                continue
-
-            for seq_name in sorted(seq_dict):
-                print(seq_dict[seq_name], file=f)
-
-        pyfastaq.utils.close(f)
-
-
-    def _write_catted_assembled_seqs_fasta(self, outfile):
-        f = pyfastaq.utils.open_file_write(outfile)
-
-        for gene in sorted(self.clusters):
-            try:
-                seq_dict = self.clusters[gene].assembly_compare.assembled_reference_sequences
-            except:
-                continue
+    def _open_streamed_outputs(self):
+        columns = copy.copy(report.columns)
+        columns[0] = '#' + columns[0]
+        self.streamed_outputs['report'] = streamed_output.StreamedOutput(self.report_file_all_tsv, header='\t'.join(columns))
+        self.streamed_outputs['assembled_seqs'] = streamed_output.StreamedOutput(self.catted_assembled_seqs_fasta)
+        self.streamed_outputs['genes_matching_refs'] = streamed_output.StreamedOutput(self.catted_genes_matching_refs_fasta)
+        self.streamed_outputs['assemblies'] = streamed_output.StreamedOutput(self.catted_assemblies_fasta)
 
-            for seq_name in sorted(seq_dict):
-                print(seq_dict[seq_name], file=f)
 
-        pyfastaq.utils.close(f)
+    def _remove_streamed_outputs(self):
+        for output in self.streamed_outputs.values():
+            output.remove()
 
 
-    def _write_catted_genes_matching_refs_fasta(self, outfile):
-        f = pyfastaq.utils.open_file_write(outfile)
+    @staticmethod
+    def _cluster_result_to_output_text(result):
+        '''Returns dictionary of output name -> text to add to that output
+           for the given cluster_result.ClusterResult'''
+        text = {}
+        text['report'] = '' if result.report_lines is None else ''.join([x + '\n' for x in result.report_lines])
 
-        for gene in sorted(self.clusters):
-            if self.clusters[gene].assembly_compare is not None and self.clusters[gene].assembly_compare.gene_matching_ref is not None:
-                seq = copy.copy(self.clusters[gene].assembly_compare.gene_matching_ref)
-                seq.id += '.' + '.'.join([
-                    self.clusters[gene].assembly_compare.gene_matching_ref_type,
-                    str(self.clusters[gene].assembly_compare.gene_start_bases_added),
-                    str(self.clusters[gene].assembly_compare.gene_end_bases_added)
-                ])
-                print(seq, file=f)
+        for name, seq_dict in [('assembled_seqs', result.assembled_reference_sequences), ('assemblies', result.assembly_sequences)]:
+            text[name] = '' if seq_dict is None else ''.join([str(seq_dict[x]) + '\n' for x in sorted(seq_dict)])
 
-        pyfastaq.utils.close(f)
+        if result.gene_matching_ref is None:
+            text['genes_matching_refs'] = ''
+        else:
+            seq = copy.copy(result.gene_matching_ref)
+            seq.id += '.' + '.'.join([
+                result.gene_matching_ref_type,
+                str(result.gene_start_bases_added),
+                str(result.gene_end_bases_added)
+            ])
+            text['genes_matching_refs'] = str(seq) + '\n'
+
+        return text
+
+
+    def _add_cluster_result(self, result, total_clusters):
+        '''Writes the outputs of a finished cluster to the streamed output
+           files, and keeps the result without its outputs in self.clusters'''
+        result.check_version()
+        for name, text in self._cluster_result_to_output_text(result).items():
+            self.streamed_outputs[name].add(result.name, text)
+
+        log_file = os.path.join(self.logs_dir, result.name + '.log')
+        if 'logs' in self.streamed_outputs and os.path.exists(log_file):
+            with open(log_file) as f:
+                self.streamed_outputs['logs'].add(result.name, f.read())
+
+        result.remove_outputs()
+        self.clusters[result.name] = result
+        if self.verbose:
+            print('Collected results of cluster ', result.name, ' (', len(self.clusters), ' of ', total_clusters, ')', sep='', flush=True)
 
 
     def _clean(self):
@@ -569,7 +728,7 @@ class Clusters:
 
             try:
                 if self.verbose:
-                    print('Deleting reads store files', self.read_store.outfile + '[.tbi]')
+                    print('Deleting reads store files', *self.read_store.outfiles)
                 self.read_store.clean()
             except:
                 pass
@@ -611,6 +770,7 @@ class Clusters:
             self.write_versions_file(cwd)
             self._map_and_cluster_reads()
             self.log_files = None
+            self._open_streamed_outputs()
 
             if len(self.cluster_to_dir) > 0:
                 got_insert_data_ok = self._set_insert_size_data()
@@ -632,12 +792,13 @@ class Clusters:
                 print('WARNING: no reads mapped to reference genes. Therefore no local assemblies will be run', file=sys.stderr)
 
             if not self.clusters_all_ran_ok:
+                self._remove_streamed_outputs()
                 raise Error('At least one cluster failed! Stopping...')
 
             if self.verbose:
                 print('{:_^79}'.format(' Writing reports '), flush=True)
                 print('Making', self.report_file_all_tsv)
-            self._write_report(self.clusters, self.report_file_all_tsv)
+            self.streamed_outputs['report'].finish()
 
             if self.verbose:
                 print('Making', self.report_file_filtered)
@@ -648,17 +809,15 @@ class Clusters:
                 print()
                 print('{:_^79}'.format(' Writing fasta of assembled sequences '), flush=True)
                 print(self.catted_assembled_seqs_fasta, 'and', self.catted_genes_matching_refs_fasta, flush=True)
-            self._write_catted_assembled_seqs_fasta(self.catted_assembled_seqs_fasta)
-            self._write_catted_genes_matching_refs_fasta(self.catted_genes_matching_refs_fasta)
-            self._write_catted_assemblies_fasta(self.catted_assemblies_fasta)
+            for name in ['assembled_seqs', 'genes_matching_refs', 'assemblies']:
+                self.streamed_outputs[name].finish()
 
             if self.log_files is not None:
-                clusters_log_file = os.path.join(self.outdir, 'log.clusters.gz')
                 if self.verbose:
                     print()
                     print('{:_^79}'.format(' Catting cluster log files '), flush=True)
-                    print('Writing file', clusters_log_file, flush=True)
-                common.cat_files(self.log_files, clusters_log_file)
+                    print('Writing file', self.clusters_log_file, flush=True)
+                self.streamed_outputs['logs'].finish()
 
             if self.verbose:
                 print()
@@ -1,11 +1,14 @@
 #include <unistd.h>
 #include <stdlib.h>
 #include <stdio.h>
+#include <string.h>
+#include <pthread.h>
 #include <iostream>
 #include <fstream>
 #include <vector>
 #include <string>
 #include <algorithm>
+#include <utility>
 #include "Python.h"
 #include "fml.h"
 
@@ -88,23 +91,76 @@ bool assemblyCompare(const Assembly&  lhs, const Assembly& rhs) {
 }
 
 
-int assemble(char *readsFile, char *fastaOut, char* logfileOut, char *contigNamePrefix);
+// One (overlap, min count) point of the assembly grid
+struct GridPoint
+{
+    unsigned short overlap;
+    unsigned short minCount;
+    int nUtg;
+    fml_utg_t *utg;
+};
+
+
+// The reads are shared by all threads and never changed. fml_assemble()
+// frees its input, so each grid point copies them just before assembling
+struct GridJobs
+{
+    const fml_opt_t *opt;
+    int nSeqs;
+    const bseq1_t *seqs;
+    std::vector<GridPoint> *points;
+    size_t nextPoint;
+    pthread_mutex_t lock;
+};
+
 
+bseq1_t *copySeqs(int nSeqs, const bseq1_t *seqs);
+bseq1_t *packedPairsToSeqs(const char *packed, size_t packedLength, int *nSeqs);
+void *assembleGridPoints(void *data);
+bool gridFromPython(PyObject *gridIn, std::vector<std::pair<unsigned short, unsigned short> >& gridOut);
+int assemble(const char *readsFile, const char *packedReads, size_t packedLength, char *fastaOut, char* logfileOut, char *contigNamePrefix, int threads, const std::vector<std::pair<unsigned short, unsigned short> >& grid);
 
+
+// Reads are either the name of a fasta/q file, or bytes of read pairs
+// with one pair per line: seq1 TAB qual1 TAB seq2 TAB qual2
 static PyObject * main_wrapper(PyObject * self, PyObject * args)
 {
-  char *readsFile;
+  PyObject *readsIn;
+  const char *readsFile = NULL;
+  const char *packedReads = NULL;
+  Py_ssize_t packedLength = 0;
   char *fastaOut;
   char *logOut;
   char *contigNamePrefix;
+  int threads = 1;
+  PyObject *gridIn = Py_None;
+  std::vector<std::pair<unsigned short, unsigned short> > grid;
   int gotFromMain = 1;
 
   // parse arguments
-  if (!PyArg_ParseTuple(args, "ssss", &readsFile, &fastaOut, &logOut, &contigNamePrefix)) {
+  if (!PyArg_ParseTuple(args, "Osss|iO", &readsIn, &fastaOut, &logOut, &contigNamePrefix, &threads, &gridIn)) {
+      return NULL;
+  }
+
+  if (PyBytes_Check(readsIn)) {
+      if (PyBytes_AsStringAndSize(readsIn, (char **) &packedReads, &packedLength) == -1) {
+          return NULL;
+      }
+  }
+  else {
+      readsFile = PyUnicode_AsUTF8(readsIn);
+      if (readsFile == NULL) {
+          return NULL;
+      }
+  }
+
+  if (!gridFromPython(gridIn, grid)) {
       return NULL;
   }
 
-  gotFromMain = assemble(readsFile, fastaOut, logOut, contigNamePrefix);
+  Py_BEGIN_ALLOW_THREADS
+  gotFromMain = assemble(readsFile, packedReads, (size_t) packedLength, fastaOut, logOut, contigNamePrefix, threads, grid);
+  Py_END_ALLOW_THREADS
   return PyLong_FromLong((long) gotFromMain);
 }
 
@@ -132,21 +188,175 @@ PyInit_fermilite_ariba(void)
 }
 
 
-int assemble(char *readsFile, char *fastaOut, char* logfileOut, char* contigNamePrefix)
+// Grid is a list of (overlap, min count) tuples, assembled in that order.
+// None means the default grid of all overlaps and min counts
+bool gridFromPython(PyObject *gridIn, std::vector<std::pair<unsigned short, unsigned short> >& gridOut)
+{
+    if (gridIn == Py_None)
+    {
+        std::vector<unsigned short> minCounts;
+        minCounts.push_back(4);
+        minCounts.push_back(17);
+        minCounts.push_back(30);
+        std::vector<unsigned short> overlaps;
+        overlaps.push_back(6);
+        overlaps.push_back(15);
+
+        for (std::vector<unsigned short>::iterator overlapsIter = overlaps.begin(); overlapsIter != overlaps.end(); overlapsIter++)
+        {
+            for (std::vector<unsigned short>::iterator minCountIter = minCounts.begin(); minCountIter != minCounts.end(); minCountIter++)
+            {
+                gridOut.push_back(std::make_pair(*overlapsIter, *minCountIter));
+            }
+        }
+        return true;
+    }
+
+    PyObject *iter = PyObject_GetIter(gridIn);
+    if (iter == NULL)
+    {
+        return false;
+    }
+
+    PyObject *item;
+    while ((item = PyIter_Next(iter)) != NULL)
+    {
+        int overlap, minCount;
+        int ok = PyArg_ParseTuple(item, "ii", &overlap, &minCount);
+        Py_DECREF(item);
+        if (!ok)
+        {
+            Py_DECREF(iter);
+            return false;
+        }
+        gridOut.push_back(std::make_pair((unsigned short) overlap, (unsigned short) minCount));
+    }
+
+    Py_DECREF(iter);
+    return !PyErr_Occurred();
+}
+
+
+bseq1_t *copySeqs(int nSeqs, const bseq1_t *seqs)
+{
+    bseq1_t *copied = (bseq1_t *) calloc(nSeqs, sizeof(bseq1_t));
+    for (int i = 0; i < nSeqs; ++i)
+    {
+        copied[i].l_seq = seqs[i].l_seq;
+        copied[i].seq = (char *) malloc(seqs[i].l_seq + 1);
+        memcpy(copied[i].seq, seqs[i].seq, seqs[i].l_seq + 1);
+        if (seqs[i].qual)
+        {
+            copied[i].qual = (char *) malloc(seqs[i].l_seq + 1);
+            memcpy(copied[i].qual, seqs[i].qual, seqs[i].l_seq + 1);
+        }
+    }
+    return copied;
+}
+
+
+// Returns NULL and sets nSeqs to -1 if a line does not have 4 fields
+bseq1_t *packedPairsToSeqs(const char *packed, size_t packedLength, int *nSeqs)
+{
+    std::vector<bseq1_t> seqs;
+    const char *end = packed + packedLength;
+    const char *lineStart = packed;
+
+    while (lineStart < end)
+    {
+        const char *lineEnd = (const char *) memchr(lineStart, '\n', end - lineStart);
+        if (lineEnd == NULL)
+        {
+            lineEnd = end;
+        }
+
+        if (lineEnd > lineStart)
+        {
+            std::vector<std::pair<const char *, size_t> > fields;
+            const char *fieldStart = lineStart;
+            for (const char *p = lineStart; p <= lineEnd; ++p)
+            {
+                if (p == lineEnd || *p == '\t')
+                {
+                    fields.push_back(std::make_pair(fieldStart, (size_t) (p - fieldStart)));
+                    fieldStart = p + 1;
+                }
+            }
+
+            if (fields.size() != 4 || fields[0].second != fields[1].second || fields[2].second != fields[3].second)
+            {
+                for (std::vector<bseq1_t>::iterator iter = seqs.begin(); iter != seqs.end(); iter++)
+                {
+                    free(iter->seq);
+                    free(iter->qual);
+                }
+                *nSeqs = -1;
+                return NULL;
+            }
+
+            for (unsigned int i = 0; i < 4; i += 2)
+            {
+                bseq1_t s;
+                s.l_seq = fields[i].second;
+                s.seq = (char *) malloc(s.l_seq + 1);
+                memcpy(s.seq, fields[i].first, s.l_seq);
+                s.seq[s.l_seq] = 0;
+                s.qual = (char *) malloc(s.l_seq + 1);
+                memcpy(s.qual, fields[i+1].first, s.l_seq);
+                s.qual[s.l_seq] = 0;
+                seqs.push_back(s);
+            }
+        }
+
+        lineStart = lineEnd + 1;
+    }
+
+    *nSeqs = seqs.size();
+    if (seqs.size() == 0)
+    {
+        return NULL;
+    }
+
+    bseq1_t *seqsOut = (bseq1_t *) malloc(seqs.size() * sizeof(bseq1_t));
+    std::copy(seqs.begin(), seqs.end(), seqsOut);
+    return seqsOut;
+}
+
+
+void *assembleGridPoints(void *data)
+{
+    GridJobs *jobs = (GridJobs *) data;
+
+    while (1)
+    {
+        pthread_mutex_lock(&jobs->lock);
+        size_t i = jobs->nextPoint++;
+        pthread_mutex_unlock(&jobs->lock);
+        if (i >= jobs->points->size())
+        {
+            break;
+        }
+
+        GridPoint& point = (*jobs->points)[i];
+        fml_opt_t opt = *(jobs->opt);
+        opt.min_cnt = point.minCount;
+        opt.min_asm_ovlp = point.overlap;
+        bseq1_t *seqs = copySeqs(jobs->nSeqs, jobs->seqs);
+        point.utg = fml_assemble(&opt, jobs->nSeqs, seqs, &point.nUtg);
+    }
+
+    return NULL;
+}
+
+
+int assemble(const char *readsFile, const char *packedReads, size_t packedLength, char *fastaOut, char* logfileOut, char* contigNamePrefix, int threads, const std::vector<std::pair<unsigned short, unsigned short> >& grid)
 {
     fml_opt_t opt;
-    int n_seqs, n_utg;
+    int n_seqs = 0;
     bseq1_t *seqs;
     fml_opt_init(&opt);
     opt.max_cnt = 10000;
     opt.mag_opt.flag |= MAG_F_AGGRESSIVE;
-    std::vector<unsigned short> minCounts;
-    minCounts.push_back(4);
-    minCounts.push_back(17);
-    minCounts.push_back(30);
-    std::vector<unsigned short> overlaps;
-    overlaps.push_back(6);
-    overlaps.push_back(15);
     unsigned short assemblyCount = 0;
     std::ofstream ofs_stats(logfileOut);
 
@@ -167,28 +377,88 @@ int assemble(char *readsFile, char *fastaOut, char* logfileOut, char* contigName
         return 1;
     }
 
-    for (std::vector<unsigned short>::iterator overlapsIter = overlaps.begin(); overlapsIter != overlaps.end(); overlapsIter++)
+    // Load the reads once. They are copied for each grid point when it is
+    // assembled, so there are never more than threads copies at once
+    if (packedReads)
     {
-        for (std::vector<unsigned short>::iterator minCountIter = minCounts.begin(); minCountIter != minCounts.end(); minCountIter++)
+        seqs = packedPairsToSeqs(packedReads, packedLength, &n_seqs);
+        if (n_seqs == -1)
         {
-            opt.min_cnt = *minCountIter;
-            opt.min_asm_ovlp = *overlapsIter;
-
-            // need to get the reads from the file every time, instead of before
-            // the loop because fml_assemble() destroys them :(
-            seqs = bseq_read(readsFile, &n_seqs);
-            if (seqs && n_seqs > 0) {
-                fml_utg_t *utg;
-                utg = fml_assemble(&opt, n_seqs, seqs, &n_utg);
-                Assembly a(n_utg, utg, *minCountIter, *overlapsIter, contigNamePrefix);
-                a.printStats(ofs_stats);
-                a.toFile(ofs_fa);
-                fml_utg_destroy(n_utg, utg);
-                if (a.numberOfContigs > 0)
-                {
-                    assemblyCount++;
-                }
-            }
+            ofs_stats.close();
+            ofs_fa.close();
+            std::remove(fastaOut);
+            std::cerr << "[ariba_fermilite] Error parsing read pairs. Each line must be seq1 TAB qual1 TAB seq2 TAB qual2, with qualities the same length as sequences. Cannot continue" << std::endl;
+            return 1;
+        }
+    }
+    else
+    {
+        seqs = bseq_read(readsFile, &n_seqs);
+    }
+    std::vector<GridPoint> points;
+
+    if (seqs && n_seqs > 0)
+    {
+        for (std::vector<std::pair<unsigned short, unsigned short> >::const_iterator gridIter = grid.begin(); gridIter != grid.end(); gridIter++)
+        {
+            GridPoint point;
+            point.overlap = gridIter->first;
+            point.minCount = gridIter->second;
+            point.nUtg = 0;
+            point.utg = NULL;
+            points.push_back(point);
+        }
+    }
+
+    GridJobs jobs;
+    jobs.opt = &opt;
+    jobs.nSeqs = n_seqs;
+    jobs.seqs = seqs;
+    jobs.points = &points;
+    jobs.nextPoint = 0;
+    pthread_mutex_init(&jobs.lock, NULL);
+    size_t numberOfThreads = threads < 1 ? 1 : threads;
+    numberOfThreads = std::min(numberOfThreads, points.size());
+
+    if (numberOfThreads <= 1)
+    {
+        assembleGridPoints(&jobs);
+    }
+    else
+    {
+        std::vector<pthread_t> workers(numberOfThreads);
+        for (size_t i = 0; i < numberOfThreads; ++i)
+        {
+            pthread_create(&workers[i], NULL, assembleGridPoints, &jobs);
+        }
+        for (size_t i = 0; i < numberOfThreads; ++i)
+        {
+            pthread_join(workers[i], NULL);
+        }
+    }
+
+    pthread_mutex_destroy(&jobs.lock);
+
+    if (seqs)
+    {
+        for (int i = 0; i < n_seqs; ++i)
+        {
+            free(seqs[i].seq);
+            free(seqs[i].qual);
+        }
+        free(seqs);
+    }
+
+    // Write results in grid order, so output does not depend on the number of threads
+    for (std::vector<GridPoint>::iterator pointIter = points.begin(); pointIter != points.end(); pointIter++)
+    {
+        Assembly a(pointIter->nUtg, pointIter->utg, pointIter->minCount, pointIter->overlap, contigNamePrefix);
+        a.printStats(ofs_stats);
+        a.toFile(ofs_fa);
+        fml_utg_destroy(pointIter->nUtg, pointIter->utg);
+        if (a.numberOfContigs > 0)
+        {
+            assemblyCount++;
         }
     }
 
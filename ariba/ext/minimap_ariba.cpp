@@ -4,12 +4,14 @@
 #include <fstream>
 #include <stdlib.h>
 #include <stdlib.h>
+#include <string.h>
 #include <assert.h>
 #include <stdio.h>
 #include <zlib.h>
 #include <map>
 #include <vector>
 #include <algorithm>
+#include <math.h>
 #include "minimap.h"
 #include "kseq.h"
 #include "Python.h"
@@ -18,14 +20,247 @@ KSEQ_INIT(gzFile, gzread)
 
 typedef std::vector<std::pair<uint32_t, bool> > MapPositionVector;
 
+// number of read pairs loaded into memory at once, to be mapped in parallel
+const size_t readPairBatchSize = 50000;
+
+// index parameters. These are also checked when loading an index from a file
+const int indexW = 10;
+const int indexK = 15;
+
+// This sets the -f option of minimap:
+// -f FLOAT    filter out top FLOAT fraction of repetitive minimizers [0.001]
+// Needed so that reads map to sequences from large clusters.
+const float indexMaxOccFraction = 0.000001;
+
+// Parameters of the in-process alignment, which can be used instead of nucmer.
+// Seeds are found with minimap, then extended with banded local alignment
+const int alignIndexW = 5;
+const int alignIndexK = 15;
+const int alignMinMinimizers = 2;
+const int alignBandPad = 50;
+const int alignMatch = 2;
+const int alignMismatch = -4;
+const int alignGapOpen = 4;
+const int alignGapExtend = 2;
+
+// A difference in an alignment. Same as a line of show-snps output:
+// positions are 1-based, and query position is on the forward strand
+struct AlignSnp
+{
+    int refPos;
+    char refBase;
+    char qryBase;
+    int qryPos;
+    int buff;
+    int dist;
+};
+
+// Same as a line of show-coords output: 1-based positions, with
+// qryStart > qryEnd if the query is reverse complemented
+struct AlignHit
+{
+    uint32_t refId;
+    uint32_t qryId;
+    int refStart;
+    int refEnd;
+    int qryStart;
+    int qryEnd;
+    int hitLengthRef;
+    int hitLengthQry;
+    double percentIdentity;
+    int refLength;
+    int qryLength;
+    bool reverse;
+    std::vector<AlignSnp> snps;
+};
+
+// Parameters of the in-process read mapper, which can be used instead of
+// bowtie2 to map the reads of one cluster to its assembly. Seeds are found
+// with minimap, then extended with the same banded local alignment (and
+// scores) as above. Reads are soft-clipped, as with bowtie2 --local
+const int readMapIndexW = 5;
+const int readMapIndexK = 15;
+const int readMapMinMinimizers = 2;
+const int readMapMinMatch = 20;
+const int readMapBandPad = 20;
+const int readMapMaxMapq = 42;
+// A pair of alignments that are a proper pair is used instead of the best
+// alignment of each read, unless its total score is lower by more than this
+const int readMapUnpairedPenalty = 20;
+
+// Alignment of one read. pos is 0-based, and the cigar includes soft clipping.
+// Insert sizes include the bases soft clipped at the start (leftClip), as in bowtie2
+struct ReadAlignment
+{
+    ReadAlignment() : refId(0), pos(0), end(0), leftClip(0), reverse(false), score(0), editDistance(0), mapq(0) {}
+    uint32_t refId;
+    int pos;
+    int end;
+    int leftClip;
+    bool reverse;
+    int score;
+    int editDistance;
+    int mapq;
+    std::string cigar;
+};
+
+struct ReadPair
+{
+    std::string seq1;
+    std::string qual1;
+    std::string seq2;
+    std::string qual2;
+};
+
+// Seed of the random number generator used to sample read pairs from
+// clusters with more read pairs than wanted. Sampling is done in input
+// order, so results are reproducible and do not depend on the number of threads
+const uint64_t pairSampleSeed = 42;
+
+// Results gathered by each thread, merged after all reads are mapped
+struct ThreadCounts
+{
+    ThreadCounts() : properPairs(0) {}
+    std::map<std::string, uint64_t> refnameToScore;
+    std::map<uint32_t, uint32_t> insertHist;
+    uint32_t properPairs;
+};
+
+// Summary of the mapping, returned to python and optionally written to files
+struct MinimapResults
+{
+    MinimapResults() : properPairs(0) {}
+    std::map<std::string, std::string> cluster2representative;
+    std::map<std::string, uint64_t> refnameToScore;
+    std::map<std::string, uint64_t> readCounters;
+    std::map<std::string, uint64_t> baseCounters;
+    std::map<uint32_t, uint32_t> insertHist;
+    uint32_t properPairs;
+};
+
+struct MappingData
+{
+    const mm_idx_t *mi;
+    const mm_mapopt_t *opt;
+    int k;
+    const std::map<std::string, std::string> *refnameToCluster;
+    const std::vector<ReadPair> *pairs;
+    std::vector<std::vector<std::string> > *pairClusters;
+    std::vector<mm_tbuf_t*> tbufs;
+    std::vector<ThreadCounts> threadCounts;
+};
+
+// Keeps a uniform random sample of at most maxPairs of the read pairs of one
+// cluster, using reservoir sampling. The pairs are identified by their index
+// in the input reads files
+class PairSample
+{
+public:
+    PairSample(uint64_t maxPairsIn=0) : maxPairs(maxPairsIn), seen(0), rngState(pairSampleSeed) {}
+
+    // Adds pair with index pairIndex to the sample, or not. If the pair is added,
+    // returns true and sets evictedOut to the index of the pair that it replaced,
+    // or to pairIndex if no pair was replaced
+    bool add(uint64_t pairIndex, uint64_t& evictedOut);
+    std::vector<uint64_t> sortedPairIndexes() const;
+
+private:
+    uint64_t random();
+    uint64_t maxPairs;
+    uint64_t seen;
+    uint64_t rngState;
+    std::vector<uint64_t> pairIndexes;
+};
+
+// A read pair in at least one cluster sample. If the pair has already been
+// written to the read store, storedCluster is the cluster it was stored in,
+// and storedNumber the number of the pair in that cluster
+struct SampledPair
+{
+    ReadPair pair;
+    std::vector<std::string> clusters;
+    std::set<std::string> sampledBy;
+    std::string storedCluster;
+    uint64_t storedNumber;
+};
+
+// Writes records (lines of text) into compressed blocks, where each block
+// only has records with the same key (cluster name). Records are buffered
+// per key, and a key's buffer is written when it gets bigger than
+// maxKeyBuffer. All buffers are written if the total buffered gets bigger
+// than maxTotalBuffer. Each block is a zlib-compressed chunk of lines. The
+// index file has one line per block:
+// key<TAB>offset<TAB>compressed_length<TAB>uncompressed_length<TAB>number_of_records
+class BlockWriter
+{
+public:
+    BlockWriter() : totalBuffered(0), offset(0) {}
+    bool open(const std::string& filename);
+    bool add(const std::string& key, const std::string& record);
+    bool close();
+
+private:
+    struct Buffer
+    {
+        Buffer() : records(0) {}
+        std::string data;
+        uint64_t records;
+    };
+    static const size_t maxKeyBuffer = 1 << 20;
+    static const size_t maxTotalBuffer = 1 << 28;
+    bool writeBlock(const std::string& key, Buffer& buffer);
+    std::ofstream ofs;
+    std::ofstream indexOfs;
+    std::map<std::string, Buffer> buffers;
+    size_t totalBuffered;
+    uint64_t offset;
+};
+
+// A read pair to be mapped by the in-process read mapper, and the SAM lines
+// made from it
+struct NamedReadPair
+{
+    std::string name;
+    ReadPair pair;
+    std::string samLines;
+};
+
+struct ReadMappingData
+{
+    const mm_idx_t *mi;
+    const mm_mapopt_t *opt;
+    const std::vector<std::string> *refNames;
+    const std::vector<std::string> *refSeqs;
+    const std::vector<int> *indexToRefId;
+    int maxInsert;
+    std::vector<NamedReadPair> *pairs;
+    std::vector<mm_tbuf_t*> tbufs;
+};
+
+extern "C" void kt_for(int n_threads, void (*func)(void*,long,int), void *data, long n);
+
 void loadClusters(std::string& filename, std::map<std::string, std::string>& refnameToCluster);
-void chooseCluster(std::string outfile, std::map<std::string, uint64_t>& refnameToScore, std::map<std::string, std::string>& refnameToCluster);
+void chooseCluster(const std::map<std::string, uint64_t>& refnameToScore, std::map<std::string, std::string>& refnameToCluster, std::map<std::string, std::string>& cluster2representativeOut);
+void writeCluster2RepresentativeFile(std::string outfile, const std::map<std::string, std::string>& cluster2representative);
 void writeClusterCountsFile(std::string outfile, const std::map<std::string, uint64_t>& readCounters, const std::map<std::string, uint64_t>& baseCounters);
 void writeInsertHistogramFile(std::string outfile, const std::map<uint32_t, uint32_t>& insertHist);
 void writeProperPairsFile(std::string outfile, uint32_t properPairs);
-bool readMappingOk(const mm_reg1_t* r, const mm_idx_t* mi, const kseq_t *ks1, uint32_t endTolerance);
+bool readMappingOk(const mm_reg1_t* r, const mm_idx_t* mi, unsigned readLength, uint32_t endTolerance);
+int loadReadPairs(kseq_t *ks1, kseq_t *ks2, std::vector<ReadPair>& pairs, size_t maxPairs);
+void mapReadPairWorker(void *data, long i, int tid);
+void mapReadPair(const mm_idx_t *mi, const mm_mapopt_t *opt, int k, const std::map<std::string, std::string>& refnameToCluster, const ReadPair& pair, mm_tbuf_t *tbuf1, mm_tbuf_t *tbuf2, std::vector<std::string>& usedClustersOut, ThreadCounts& counts);
 
-int run_minimap(char *clustersFileIn, char *refFileIn, char *readsFile1In, char *readsFile2In, char *outprefixIn);
+mm_idx_t* buildIndex(const char *refFile, int n_threads);
+mm_idx_t* loadIndex(const char *indexFile, const char *refFile);
+bool indexMatchesRefFile(const mm_idx_t *mi, const char *refFile);
+
+int run_minimap(char *clustersFileIn, char *refFileIn, char *readsFile1In, char *readsFile2In, char *outprefixIn, int n_threads, char *indexFileIn, int blockReadStore, const std::map<std::string, uint64_t>& clusterMaxPairs, int writeSummaryFiles, MinimapResults& results);
+PyObject* minimapResultsToDict(const MinimapResults& results);
+int run_build_index(char *refFileIn, char *indexFileIn, int n_threads);
+int run_map_sequences(char *indexFileIn, char *queryFileIn, std::map<std::string, uint64_t>& refnameToScore);
+const mm_idx_t* cachedIndex(const char *indexFile);
+int run_align_sequences(char *refFileIn, char *qryFileIn, double minIdentity, int minLength, std::vector<std::string>& refNamesOut, std::vector<std::string>& qryNamesOut, std::vector<AlignHit>& hitsOut);
+int run_map_reads(char *refFileIn, char *readsFile1In, char *readsFile2In, int maxInsert, int n_threads, std::ostream& samOut);
 
 static PyObject * main_wrapper(PyObject * self, PyObject * args)
 {
@@ -34,20 +269,285 @@ static PyObject * main_wrapper(PyObject * self, PyObject * args)
   char *readsFile1;
   char *readsFile2;
   char *outprefix;
+  int threads = 1;
+  char indexFileDefault[] = "";
+  char *indexFile = indexFileDefault;
+  int blockReadStore = 0;
+  PyObject *maxPairsDict = NULL;
+  std::map<std::string, uint64_t> clusterMaxPairs;
+  int writeSummaryFiles = 1;
+  MinimapResults results;
+  int gotFromMain = 1;
+
+  // parse arguments
+  if (!PyArg_ParseTuple(args, "sssss|isiO!i", &clustersFile, &refFile, &readsFile1, &readsFile2, &outprefix, &threads, &indexFile, &blockReadStore, &PyDict_Type, &maxPairsDict, &writeSummaryFiles)) {
+      return NULL;
+  }
+
+  // optional dict of cluster name -> maximum number of read pairs to keep
+  if (maxPairsDict != NULL)
+  {
+      PyObject *key, *value;
+      Py_ssize_t pos = 0;
+      while (PyDict_Next(maxPairsDict, &pos, &key, &value))
+      {
+          const char *cluster = PyUnicode_AsUTF8(key);
+          unsigned long long maxPairs = PyLong_AsUnsignedLongLong(value);
+          if (cluster == NULL || PyErr_Occurred())
+          {
+              return NULL;
+          }
+          clusterMaxPairs[cluster] = maxPairs;
+      }
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  gotFromMain = run_minimap(clustersFile, refFile, readsFile1, readsFile2, outprefix, threads, indexFile, blockReadStore, clusterMaxPairs, writeSummaryFiles, results);
+  Py_END_ALLOW_THREADS
+
+  // returns (exit code, dict of results). The dict is None if the exit code is not zero
+  if (gotFromMain != 0)
+  {
+      return Py_BuildValue("(lO)", (long) gotFromMain, Py_None);
+  }
+
+  PyObject *resultsDict = minimapResultsToDict(results);
+  if (resultsDict == NULL)
+  {
+      return NULL;
+  }
+  return Py_BuildValue("(lN)", (long) gotFromMain, resultsDict);
+}
+
+
+// Sets dict[key] = value, and gives up our reference to value
+static bool setDictItem(PyObject *dict, const char *key, PyObject *value)
+{
+    if (value == NULL)
+    {
+        return false;
+    }
+    bool ok = PyDict_SetItemString(dict, key, value) == 0;
+    Py_DECREF(value);
+    return ok;
+}
+
+
+static PyObject* stringMapToDict(const std::map<std::string, std::string>& strings)
+{
+    PyObject *dict = PyDict_New();
+    for (std::map<std::string, std::string>::const_iterator iter = strings.begin(); dict != NULL && iter != strings.end(); iter++)
+    {
+        if (!setDictItem(dict, iter->first.c_str(), PyUnicode_FromString(iter->second.c_str())))
+        {
+            Py_CLEAR(dict);
+        }
+    }
+    return dict;
+}
+
+
+static PyObject* countMapToDict(const std::map<std::string, uint64_t>& counts)
+{
+    PyObject *dict = PyDict_New();
+    for (std::map<std::string, uint64_t>::const_iterator iter = counts.begin(); dict != NULL && iter != counts.end(); iter++)
+    {
+        if (!setDictItem(dict, iter->first.c_str(), PyLong_FromUnsignedLongLong(iter->second)))
+        {
+            Py_CLEAR(dict);
+        }
+    }
+    return dict;
+}
+
+
+PyObject* minimapResultsToDict(const MinimapResults& results)
+{
+    PyObject *insertHist = PyDict_New();
+    for (std::map<uint32_t, uint32_t>::const_iterator iter = results.insertHist.begin(); insertHist != NULL && iter != results.insertHist.end(); iter++)
+    {
+        PyObject *key = PyLong_FromUnsignedLong(iter->first);
+        PyObject *value = PyLong_FromUnsignedLong(iter->second);
+        if (key == NULL || value == NULL || PyDict_SetItem(insertHist, key, value) != 0)
+        {
+            Py_CLEAR(insertHist);
+        }
+        Py_XDECREF(key);
+        Py_XDECREF(value);
+    }
+
+    PyObject *dict = PyDict_New();
+    if (dict == NULL
+        || !setDictItem(dict, "cluster2representative", stringMapToDict(results.cluster2representative))
+        || !setDictItem(dict, "refname_to_score", countMapToDict(results.refnameToScore))
+        || !setDictItem(dict, "cluster_read_counts", countMapToDict(results.readCounters))
+        || !setDictItem(dict, "cluster_base_counts", countMapToDict(results.baseCounters))
+        || !setDictItem(dict, "insert_histogram", insertHist)
+        || !setDictItem(dict, "proper_pairs", PyLong_FromUnsignedLong(results.properPairs)))
+    {
+        Py_XDECREF(dict);
+        return NULL;
+    }
+
+    return dict;
+}
+
+
+static PyObject * build_index_wrapper(PyObject * self, PyObject * args)
+{
+  char *refFile;
+  char *indexFile;
+  int threads = 1;
   int gotFromMain = 1;
 
   // parse arguments
-  if (!PyArg_ParseTuple(args, "sssss", &clustersFile, &refFile, &readsFile1, &readsFile2, &outprefix)) {
+  if (!PyArg_ParseTuple(args, "ss|i", &refFile, &indexFile, &threads)) {
       return NULL;
   }
 
-  gotFromMain = run_minimap(clustersFile, refFile, readsFile1, readsFile2, outprefix);
+  Py_BEGIN_ALLOW_THREADS
+  gotFromMain = run_build_index(refFile, indexFile, threads);
+  Py_END_ALLOW_THREADS
   return PyLong_FromLong((long) gotFromMain);
 }
 
 
+static PyObject * map_sequences_wrapper(PyObject * self, PyObject * args)
+{
+  char *indexFile;
+  char *queryFile;
+  std::map<std::string, uint64_t> refnameToScore;
+  int gotFromMain = 1;
+
+  // parse arguments
+  if (!PyArg_ParseTuple(args, "ss", &indexFile, &queryFile)) {
+      return NULL;
+  }
+
+  // returns (exit code, dict of ref name -> score). The dict is None if the exit code is not zero
+  gotFromMain = run_map_sequences(indexFile, queryFile, refnameToScore);
+  if (gotFromMain != 0)
+  {
+      return Py_BuildValue("(lO)", (long) gotFromMain, Py_None);
+  }
+
+  PyObject *scoresDict = countMapToDict(refnameToScore);
+  if (scoresDict == NULL)
+  {
+      return NULL;
+  }
+  return Py_BuildValue("(lN)", (long) gotFromMain, scoresDict);
+}
+
+
+static PyObject * align_sequences_wrapper(PyObject * self, PyObject * args)
+{
+  char *refFile;
+  char *qryFile;
+  double minIdentity = 0;
+  int minLength = 0;
+  std::vector<std::string> refNames;
+  std::vector<std::string> qryNames;
+  std::vector<AlignHit> hits;
+  int gotFromMain = 1;
+
+  // parse arguments
+  if (!PyArg_ParseTuple(args, "ss|di", &refFile, &qryFile, &minIdentity, &minLength)) {
+      return NULL;
+  }
+
+  // returns (exit code, list of hits). The list is None if the exit code is not zero.
+  // Each hit is a tuple of the show-coords columns (ref start, ref end, qry start, qry end,
+  // hit length ref, hit length qry, percent identity, ref length, qry length, qry frame,
+  // ref name, qry name), then a list of the hit's show-snps tuples (ref pos, ref base,
+  // qry base, qry pos, buff, dist)
+  Py_BEGIN_ALLOW_THREADS
+  gotFromMain = run_align_sequences(refFile, qryFile, minIdentity, minLength, refNames, qryNames, hits);
+  Py_END_ALLOW_THREADS
+  if (gotFromMain != 0)
+  {
+      return Py_BuildValue("(lO)", (long) gotFromMain, Py_None);
+  }
+
+  PyObject *hitsList = PyList_New(0);
+  if (hitsList == NULL)
+  {
+      return NULL;
+  }
+
+  for (std::vector<AlignHit>::const_iterator hit = hits.begin(); hit != hits.end(); hit++)
+  {
+      PyObject *snpsList = PyList_New(0);
+      if (snpsList == NULL)
+      {
+          Py_DECREF(hitsList);
+          return NULL;
+      }
+
+      for (std::vector<AlignSnp>::const_iterator snp = hit->snps.begin(); snp != hit->snps.end(); snp++)
+      {
+          PyObject *snpTuple = Py_BuildValue("(iCCiii)", snp->refPos, (int) snp->refBase, (int) snp->qryBase, snp->qryPos, snp->buff, snp->dist);
+          if (snpTuple == NULL || PyList_Append(snpsList, snpTuple) != 0)
+          {
+              Py_XDECREF(snpTuple);
+              Py_DECREF(snpsList);
+              Py_DECREF(hitsList);
+              return NULL;
+          }
+          Py_DECREF(snpTuple);
+      }
+
+      PyObject *hitTuple = Py_BuildValue("(iiiiiidiiissN)", hit->refStart, hit->refEnd, hit->qryStart, hit->qryEnd,
+          hit->hitLengthRef, hit->hitLengthQry, hit->percentIdentity, hit->refLength, hit->qryLength, hit->reverse ? -1 : 1,
+          refNames[hit->refId].c_str(), qryNames[hit->qryId].c_str(), snpsList);
+      if (hitTuple == NULL || PyList_Append(hitsList, hitTuple) != 0)
+      {
+          Py_XDECREF(hitTuple);
+          Py_DECREF(hitsList);
+          return NULL;
+      }
+      Py_DECREF(hitTuple);
+  }
+
+  return Py_BuildValue("(lN)", (long) gotFromMain, hitsList);
+}
+
+
+static PyObject * map_reads_wrapper(PyObject * self, PyObject * args)
+{
+  char *refFile;
+  char *readsFile1;
+  char *readsFile2;
+  int maxInsert = 1000;
+  int threads = 1;
+  int gotFromMain = 1;
+  std::ostringstream samOut;
+
+  // parse arguments
+  if (!PyArg_ParseTuple(args, "sss|ii", &refFile, &readsFile1, &readsFile2, &maxInsert, &threads)) {
+      return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  gotFromMain = run_map_reads(refFile, readsFile1, readsFile2, maxInsert, threads, samOut);
+  Py_END_ALLOW_THREADS
+
+  const std::string samText = samOut.str();
+  PyObject *samBytes = PyBytes_FromStringAndSize(samText.data(), samText.size());
+  if (samBytes == NULL)
+  {
+      return NULL;
+  }
+  return Py_BuildValue("(lN)", (long) gotFromMain, samBytes);
+}
+
+
 static PyMethodDef minimapMethods[] = {
    { "minimap_ariba", main_wrapper, METH_VARARGS, "minimap ariba" },
+   { "build_index", build_index_wrapper, METH_VARARGS, "build minimap index file" },
+   { "map_sequences", map_sequences_wrapper, METH_VARARGS, "map sequences to minimap index file, returning score of each reference sequence" },
+   { "align_sequences", align_sequences_wrapper, METH_VARARGS, "align query sequences to reference sequences, returning nucmer-like hits and snps" },
+   { "map_reads", map_reads_wrapper, METH_VARARGS, "map read pairs to reference sequences, returning the SAM output" },
    { NULL, NULL, 0, NULL }
 };
 
@@ -69,27 +569,61 @@ PyInit_minimap_ariba(void)
 
 
 
-int run_minimap(char *clustersFileIn, char *refFileIn, char *readsFile1In, char *readsFile2In, char *outprefixIn)
+int run_minimap(char *clustersFileIn, char *refFileIn, char *readsFile1In, char *readsFile2In, char *outprefixIn, int n_threads, char *indexFileIn, int blockReadStore, const std::map<std::string, uint64_t>& clusterMaxPairs, int writeSummaryFiles, MinimapResults& results)
 {
     mm_verbose = 0;
-    std::map<std::string, uint64_t> refnameToScore;
+    std::map<std::string, uint64_t>& refnameToScore = results.refnameToScore;
     std::map<std::string, std::string> refnameToCluster;
     std::string clustersFile(clustersFileIn);
     loadClusters(clustersFile, refnameToCluster);
-    std::map<std::string, uint64_t> readCounters;
-    std::map<std::string, uint64_t> baseCounters;
-    std::map<uint32_t, uint32_t> insertHist;
-    uint32_t properPairs = 0;
+    std::map<std::string, uint64_t>& readCounters = results.readCounters;
+    std::map<std::string, uint64_t>& baseCounters = results.baseCounters;
+    std::map<uint32_t, uint32_t>& insertHist = results.insertHist;
+    uint32_t& properPairs = results.properPairs;
     std::string outprefix(outprefixIn);
     std::string readsOutfile = outprefix + ".reads";
     std::ofstream ofs;
-    ofs.open(readsOutfile.c_str());
-    if (!ofs.good())
+
+    // The block read store has each read pair stored once, in the blocks
+    // of the first cluster that it hits (outprefix.reads.blocks). Each
+    // cluster has a list of its pairs (outprefix.reads.pairs), where a pair
+    // is "cluster<TAB>N" meaning the Nth (0-based) pair stored in the blocks
+    // of that cluster.
+    BlockWriter readsWriter;
+    BlockWriter pairsWriter;
+    std::map<std::string, uint64_t> storedPairs;
+    bool readsOutfileOk;
+
+    // Clusters in clusterMaxPairs only keep a random sample of their read
+    // pairs. Those pairs are written after all reads are mapped. The read and
+    // base counts are of all pairs, not just the sampled pairs
+    std::map<std::string, PairSample> clusterSamples;
+    for (std::map<std::string, uint64_t>::const_iterator iter = clusterMaxPairs.begin(); iter != clusterMaxPairs.end(); iter++)
+    {
+        clusterSamples[iter->first] = PairSample(iter->second);
+    }
+    std::map<uint64_t, SampledPair> sampledPairs;
+    uint64_t pairsDone = 0;
+    if (blockReadStore)
+    {
+        readsOutfileOk = readsWriter.open(readsOutfile + ".blocks") && pairsWriter.open(readsOutfile + ".pairs");
+    }
+    else
+    {
+        ofs.open(readsOutfile.c_str());
+        readsOutfileOk = ofs.good();
+    }
+    if (!readsOutfileOk)
     {
-        std::cerr << "[ariba_minimap] Error opening reads output file '" << readsOutfile << "'. Cannot continue" << std::endl;
+        std::cerr << "[ariba_minimap] Error opening reads output file(s) '" << readsOutfile << "'. Cannot continue" << std::endl;
         return 1;
     }
 
+    if (n_threads < 1)
+    {
+        n_threads = 1;
+    }
+
     // open query file for reading; you may use your favorite FASTA/Q parser
     gzFile infile1 = gzopen(readsFile1In, "r");
     if (!infile1)
@@ -106,124 +640,198 @@ int run_minimap(char *clustersFileIn, char *refFileIn, char *readsFile1In, char
     kseq_t *ks1 = kseq_init(infile1);
     kseq_t *ks2 = kseq_init(infile2);
 
-    // create index for target; we are creating one index for all target sequence
-    int n_threads = 1;
-    int w = 10, k = 15;
-    mm_idx_t *mi = mm_idx_build(refFileIn, w, k, n_threads);
+    // create index for target; we are creating one index for all target sequence.
+    // Use the index made by prepareref if there is one
+    int k = indexK;
+    mm_idx_t *mi = 0;
+    if (strlen(indexFileIn) > 0)
+    {
+        mi = loadIndex(indexFileIn, refFileIn);
+        if (!mi)
+        {
+            std::cerr << "[ariba_minimap] Will make a new index" << std::endl;
+        }
+    }
+    if (!mi)
+    {
+        mi = buildIndex(refFileIn, n_threads);
+    }
     if (!mi)
     {
         std::cerr << "[ariba_minimap] Error indexing" << std::endl;
         return 1;
     }
 
-    // This sets the -f option of minimap:
-    // -f FLOAT    filter out top FLOAT fraction of repetitive minimizers [0.001]
-    // Needed so that reads map to sequences from large clusters.
-    mm_idx_set_max_occ(mi, 0.000001);
-
     // mapping
     mm_mapopt_t opt;
     mm_mapopt_init(&opt); // initialize mapping parameters
-    mm_tbuf_t *tbuf1 = mm_tbuf_init(); // thread buffer; for multi-threading, allocate one tbuf for each thread
-    mm_tbuf_t *tbuf2 = mm_tbuf_init(); // thread buffer; for multi-threading, allocate one tbuf for each thread
-    while (kseq_read(ks1) >= 0) { // each kseq_read() call reads one query sequence
-        const mm_reg1_t *reg1, *reg2;
-        int j, n_reg1, n_reg2;
-        int ks2ok = kseq_read(ks2);
-        if (ks2ok == 0)
-        {
-            std::cerr << "Error getting mate of read. Cannot continue" << std::endl;
-            return 1;
-        }
+    std::vector<ReadPair> pairs;
+    std::vector<std::vector<std::string> > pairClusters;
+    MappingData mappingData;
+    mappingData.mi = mi;
+    mappingData.opt = &opt;
+    mappingData.k = k;
+    mappingData.refnameToCluster = &refnameToCluster;
+    mappingData.pairs = &pairs;
+    mappingData.pairClusters = &pairClusters;
+    mappingData.threadCounts.resize(n_threads);
+    for (int i = 0; i < 2 * n_threads; i++)
+    {
+        mappingData.tbufs.push_back(mm_tbuf_init()); // one tbuf per read of the pair, per thread
+    }
+
+    int loadOk = 1;
+    bool writeOk = true;
 
-        // get all hits for the forward and reverse reads
-        reg1 = mm_map(mi, ks1->seq.l, ks1->seq.s, &n_reg1, tbuf1, &opt, 0);
-        reg2 = mm_map(mi, ks2->seq.l, ks2->seq.s, &n_reg2, tbuf2, &opt, 0);
+    // Load the reads in batches. Each batch is mapped using all threads, and then
+    // the reads are written in input order so that the output does not depend
+    // on the number of threads
+    while ((loadOk = loadReadPairs(ks1, ks2, pairs, readPairBatchSize)) == 1 && pairs.size() > 0)
+    {
+        pairClusters.assign(pairs.size(), std::vector<std::string>());
 
-        if (n_reg1 > 0 || n_reg2 > 0)
+        if (n_threads > 1)
+        {
+            kt_for(n_threads, mapReadPairWorker, &mappingData, (long) pairs.size());
+        }
+        else
         {
-            std::map<std::string, MapPositionVector> positions1;
-            std::map<std::string, MapPositionVector> positions2;
-            std::set<std::string> refnames;
+            for (long i = 0; i < (long) pairs.size(); i++)
+            {
+                mapReadPairWorker(&mappingData, i, 0);
+            }
+        }
 
-            for (j  =0; j < n_reg1; ++j)
+        for (size_t i = 0; i < pairs.size(); i++)
+        {
+            std::vector<std::string> keptClusters;
+            for (std::vector<std::string>::const_iterator iter = pairClusters[i].begin(); iter != pairClusters[i].end(); iter++)
             {
-                const mm_reg1_t *r = &reg1[j];
-                if (readMappingOk(r, mi, ks1, (int) 1.1 * k))
+                if (clusterSamples.find(*iter) == clusterSamples.end())
                 {
-                    refnames.insert(mi->name[r->rid]);
-                    refnameToScore[mi->name[r->rid]] += r->cnt;
-                    uint32_t coord = r->rev ? std::max(r->rs, r->re) : std::min(r->rs, r->re);
-                    positions1[mi->name[r->rid]].push_back(std::make_pair(coord, r->rev));
+                    keptClusters.push_back(*iter);
                 }
             }
-            for (j  =0; j < n_reg2; ++j)
+
+            std::string storingCluster;
+            uint64_t storedNumber = 0;
+            if (blockReadStore && keptClusters.size() > 0)
             {
-                const mm_reg1_t *r = &reg2[j];
-                if (readMappingOk(r, mi, ks2, (int) 1.1 * k))
+                storingCluster = keptClusters[0];
+                storedNumber = storedPairs[storingCluster]++;
+                std::ostringstream pairRef;
+                pairRef << storingCluster << '\t' << storedNumber;
+                std::string pairRecord = pairs[i].seq1 + '\t' + pairs[i].qual1 + '\t' + pairs[i].seq2 + '\t' + pairs[i].qual2;
+                writeOk = readsWriter.add(storingCluster, pairRecord) && writeOk;
+                for (std::vector<std::string>::const_iterator iter = keptClusters.begin(); iter != keptClusters.end(); iter++)
                 {
-                    refnames.insert(mi->name[r->rid]);
-                    refnameToScore[mi->name[r->rid]] += r->cnt;
-                    uint32_t coord = r->rev ? std::max(r->rs, r->re) : std::min(r->rs, r->re);
-                    positions2[mi->name[r->rid]].push_back(std::make_pair(coord, r->rev));
+                    writeOk = pairsWriter.add(*iter, pairRef.str()) && writeOk;
                 }
             }
 
-            bool foundProperPair = false;
-            std::set<std::string> usedClusters;
-            for (std::set<std::string>::const_iterator iter = refnames.begin(); iter != refnames.end(); iter++)
+            for (std::vector<std::string>::const_iterator iter = pairClusters[i].begin(); iter != pairClusters[i].end(); iter++)
             {
-                std::string cluster = refnameToCluster[*iter];
-
-                // do not write a read pair to the same cluster more than once
-                if (usedClusters.find(cluster) != usedClusters.end())
+                std::map<std::string, PairSample>::iterator sample = clusterSamples.find(*iter);
+                if (sample != clusterSamples.end())
                 {
-                    continue;
-                }
+                    uint64_t pairIndex = pairsDone + i;
+                    uint64_t evicted;
+                    if (sample->second.add(pairIndex, evicted))
+                    {
+                        if (evicted != pairIndex)
+                        {
+                            std::map<uint64_t, SampledPair>::iterator evictedPair = sampledPairs.find(evicted);
+                            evictedPair->second.sampledBy.erase(*iter);
+                            if (evictedPair->second.sampledBy.size() == 0)
+                            {
+                                sampledPairs.erase(evictedPair);
+                            }
+                        }
 
-                usedClusters.insert(cluster);
-                readCounters[cluster]++;
-                ofs << cluster << '\t' << readCounters[cluster] << '\t' << ks1->seq.s << '\t' << ks1->qual.s << '\n';
-                readCounters[cluster]++;
-                ofs << cluster << '\t' << readCounters[cluster] << '\t' << ks2->seq.s << '\t' << ks2->qual.s << '\n';
-                baseCounters[cluster] += ks1->seq.l + ks2->seq.l;
+                        std::map<uint64_t, SampledPair>::iterator sampled = sampledPairs.find(pairIndex);
+                        if (sampled == sampledPairs.end())
+                        {
+                            SampledPair& newPair = sampledPairs[pairIndex];
+                            newPair.pair = pairs[i];
+                            newPair.clusters = pairClusters[i];
+                            newPair.storedCluster = storingCluster;
+                            newPair.storedNumber = storedNumber;
+                            sampled = sampledPairs.find(pairIndex);
+                        }
+                        sampled->second.sampledBy.insert(*iter);
+                    }
+                }
 
-                // get insert size info, if reads mapped as proper pair
-                if (positions1.find(*iter) != positions1.end() && positions2.find(*iter) != positions2.end())
+                readCounters[*iter]++;
+                if (!blockReadStore && sample == clusterSamples.end())
                 {
-                    if (positions1[*iter].size() != 1 || positions2[*iter].size() != 1 || positions1[*iter][0].second == positions2[*iter][0].second)
-                    {
-                        continue;
-                    }
+                    ofs << *iter << '\t' << readCounters[*iter] << '\t' << pairs[i].seq1 << '\t' << pairs[i].qual1 << '\n';
+                }
+                readCounters[*iter]++;
+                if (!blockReadStore && sample == clusterSamples.end())
+                {
+                    ofs << *iter << '\t' << readCounters[*iter] << '\t' << pairs[i].seq2 << '\t' << pairs[i].qual2 << '\n';
+                }
+                baseCounters[*iter] += pairs[i].seq1.size() + pairs[i].seq2.size();
+            }
+        }
 
-                    uint32_t insertSize;
+        pairsDone += pairs.size();
+    }
 
-                    if (positions1[*iter][0].second && positions1[*iter][0].first > positions2[*iter][0].first)
-                    {
-                        insertSize = positions1[*iter][0].first - positions2[*iter][0].first + 1;
-                    }
-                    else if (positions2[*iter][0].second && positions2[*iter][0].first > positions1[*iter][0].first)
-                    {
-                        insertSize = positions2[*iter][0].first - positions1[*iter][0].first + 1;
-                    }
-                    else
-                    {
-                        continue;
-                    }
+    // Write the pairs sampled from clusters that have a maximum number of pairs.
+    // Pairs that were not already written for another cluster are stored in
+    // the first cluster that sampled them, in input order
+    if (blockReadStore)
+    {
+        for (std::map<uint64_t, SampledPair>::iterator iter = sampledPairs.begin(); iter != sampledPairs.end(); iter++)
+        {
+            SampledPair& sampled = iter->second;
+            if (sampled.storedCluster.size() > 0)
+            {
+                continue;
+            }
 
-                    insertHist[insertSize + 2*k]++;
-                    foundProperPair = true;
+            for (std::vector<std::string>::const_iterator cluster = sampled.clusters.begin(); cluster != sampled.clusters.end(); cluster++)
+            {
+                if (sampled.sampledBy.find(*cluster) != sampled.sampledBy.end())
+                {
+                    sampled.storedCluster = *cluster;
+                    break;
                 }
             }
 
-            if (foundProperPair)
+            sampled.storedNumber = storedPairs[sampled.storedCluster]++;
+            std::string pairRecord = sampled.pair.seq1 + '\t' + sampled.pair.qual1 + '\t' + sampled.pair.seq2 + '\t' + sampled.pair.qual2;
+            writeOk = readsWriter.add(sampled.storedCluster, pairRecord) && writeOk;
+        }
+    }
+
+    for (std::map<std::string, PairSample>::const_iterator sample = clusterSamples.begin(); sample != clusterSamples.end(); sample++)
+    {
+        std::vector<uint64_t> pairIndexes = sample->second.sortedPairIndexes();
+        uint64_t readNumber = 0;
+        for (std::vector<uint64_t>::const_iterator pairIndex = pairIndexes.begin(); pairIndex != pairIndexes.end(); pairIndex++)
+        {
+            const SampledPair& sampled = sampledPairs[*pairIndex];
+            if (blockReadStore)
+            {
+                std::ostringstream pairRef;
+                pairRef << sampled.storedCluster << '\t' << sampled.storedNumber;
+                writeOk = pairsWriter.add(sample->first, pairRef.str()) && writeOk;
+            }
+            else
             {
-                properPairs++;
+                ofs << sample->first << '\t' << ++readNumber << '\t' << sampled.pair.seq1 << '\t' << sampled.pair.qual1 << '\n';
+                ofs << sample->first << '\t' << ++readNumber << '\t' << sampled.pair.seq2 << '\t' << sampled.pair.qual2 << '\n';
             }
         }
     }
-    mm_tbuf_destroy(tbuf1);
-    mm_tbuf_destroy(tbuf2);
+
+    for (size_t i = 0; i < mappingData.tbufs.size(); i++)
+    {
+        mm_tbuf_destroy(mappingData.tbufs[i]);
+    }
 
     // deallocate index and close the query file
     mm_idx_destroy(mi);
@@ -231,32 +839,480 @@ int run_minimap(char *clustersFileIn, char *refFileIn, char *readsFile1In, char
     kseq_destroy(ks2);
     gzclose(infile1);
     gzclose(infile2);
-    ofs.close();
-    chooseCluster(outprefix + ".cluster2representative", refnameToScore, refnameToCluster);
-    writeClusterCountsFile(outprefix + ".clusterCounts", readCounters, baseCounters);
-    writeInsertHistogramFile(outprefix + ".insertHistogram", insertHist);
-    writeProperPairsFile(outprefix + ".properPairs", properPairs);
-    return 0;
-}
+    if (blockReadStore)
+    {
+        writeOk = readsWriter.close() && writeOk;
+        writeOk = pairsWriter.close() && writeOk;
+    }
+    else
+    {
+        ofs.close();
+    }
 
+    if (loadOk != 1)
+    {
+        std::cerr << "Error getting mate of read. Cannot continue" << std::endl;
+        return 1;
+    }
 
-void loadClusters(std::string& filename, std::map<std::string, std::string>& refnameToCluster)
-{
-    std::ifstream ifs;
-    std::string line;
-    ifs.open(filename.c_str());
-    if (!ifs.good())
+    if (!writeOk)
     {
-        std::cerr << "Error opening clusters file '" << filename << "'. Cannot continue" << std::endl;
-        exit(1);
+        std::cerr << "[ariba_minimap] Error writing reads output file '" << readsOutfile << "'. Cannot continue" << std::endl;
+        return 1;
     }
 
-    while(getline(ifs, line))
+    // merge the counts gathered by each thread
+    for (std::vector<ThreadCounts>::const_iterator counts = mappingData.threadCounts.begin(); counts != mappingData.threadCounts.end(); counts++)
     {
-        std::stringstream ss(line);
-        std::string cluster;
-        std::string seqname;
-        getline(ss, cluster, '\t');
+        for (std::map<std::string, uint64_t>::const_iterator iter = counts->refnameToScore.begin(); iter != counts->refnameToScore.end(); iter++)
+        {
+            refnameToScore[iter->first] += iter->second;
+        }
+
+        for (std::map<uint32_t, uint32_t>::const_iterator iter = counts->insertHist.begin(); iter != counts->insertHist.end(); iter++)
+        {
+            insertHist[iter->first] += iter->second;
+        }
+
+        properPairs += counts->properPairs;
+    }
+
+    chooseCluster(refnameToScore, refnameToCluster, results.cluster2representative);
+
+    if (writeSummaryFiles)
+    {
+        writeCluster2RepresentativeFile(outprefix + ".cluster2representative", results.cluster2representative);
+        writeClusterCountsFile(outprefix + ".clusterCounts", readCounters, baseCounters);
+        writeInsertHistogramFile(outprefix + ".insertHistogram", insertHist);
+        writeProperPairsFile(outprefix + ".properPairs", properPairs);
+    }
+
+    return 0;
+}
+
+
+int run_build_index(char *refFileIn, char *indexFileIn, int n_threads)
+{
+    mm_verbose = 0;
+    mm_idx_t *mi = buildIndex(refFileIn, n_threads < 1 ? 1 : n_threads);
+    if (!mi)
+    {
+        std::cerr << "[ariba_minimap] Error indexing" << std::endl;
+        return 1;
+    }
+
+    FILE *fp = fopen(indexFileIn, "wb");
+    if (!fp)
+    {
+        std::cerr << "[ariba_minimap] Error opening index output file '" << indexFileIn << "'. Cannot continue" << std::endl;
+        mm_idx_destroy(mi);
+        return 1;
+    }
+
+    mm_idx_dump(fp, mi);
+    bool writeOk = !ferror(fp);
+    writeOk = (fclose(fp) == 0) && writeOk;
+    mm_idx_destroy(mi);
+
+    if (!writeOk)
+    {
+        std::cerr << "[ariba_minimap] Error writing index file '" << indexFileIn << "'" << std::endl;
+        return 1;
+    }
+
+    return 0;
+}
+
+
+// Indexes loaded by map_sequences, kept for the life of the process so that
+// each cluster run by a worker process does not load the index again
+static std::map<std::string, mm_idx_t*> indexCache;
+
+const mm_idx_t* cachedIndex(const char *indexFile)
+{
+    std::map<std::string, mm_idx_t*>::const_iterator iter = indexCache.find(indexFile);
+    if (iter != indexCache.end())
+    {
+        return iter->second;
+    }
+
+    mm_idx_t *mi = loadIndex(indexFile, 0);
+    if (mi)
+    {
+        indexCache[indexFile] = mi;
+    }
+    return mi;
+}
+
+
+int run_map_sequences(char *indexFileIn, char *queryFileIn, std::map<std::string, uint64_t>& refnameToScore)
+{
+    mm_verbose = 0;
+    const mm_idx_t *mi = cachedIndex(indexFileIn);
+    if (!mi)
+    {
+        std::cerr << "[ariba_minimap] Error loading index file '" << indexFileIn << "'" << std::endl;
+        return 1;
+    }
+
+    gzFile infile = gzopen(queryFileIn, "r");
+    if (!infile)
+    {
+        std::cerr << "[ariba_minimap] Error opening file " << queryFileIn << std::endl;
+        return 1;
+    }
+
+    mm_mapopt_t opt;
+    mm_mapopt_init(&opt);
+    mm_tbuf_t *tbuf = mm_tbuf_init();
+    kseq_t *ks = kseq_init(infile);
+
+    while (kseq_read(ks) >= 0)
+    {
+        int n_reg;
+        const mm_reg1_t *reg = mm_map(mi, ks->seq.l, ks->seq.s, &n_reg, tbuf, &opt, 0);
+        for (int j = 0; j < n_reg; j++)
+        {
+            refnameToScore[mi->name[reg[j].rid]] += reg[j].cnt;
+        }
+    }
+
+    mm_tbuf_destroy(tbuf);
+    kseq_destroy(ks);
+    gzclose(infile);
+    return 0;
+}
+
+
+mm_idx_t* buildIndex(const char *refFile, int n_threads)
+{
+    mm_idx_t *mi = mm_idx_build(refFile, indexW, indexK, n_threads);
+    if (mi)
+    {
+        mm_idx_set_max_occ(mi, indexMaxOccFraction);
+    }
+    return mi;
+}
+
+
+// Returns the index stored in indexFile, or null if the file cannot be
+// read, or was made with different parameters or reference sequences.
+// The reference sequences are not checked if refFile is null
+mm_idx_t* loadIndex(const char *indexFile, const char *refFile)
+{
+    FILE *fp = fopen(indexFile, "rb");
+    if (!fp)
+    {
+        return 0;
+    }
+
+    mm_idx_t *mi = mm_idx_load(fp);
+    fclose(fp);
+
+    if (!mi)
+    {
+        std::cerr << "[ariba_minimap] Could not load index file '" << indexFile << "'" << std::endl;
+        return 0;
+    }
+
+    if (mi->w != indexW || mi->k != indexK || mi->freq_thres != indexMaxOccFraction || (refFile && !indexMatchesRefFile(mi, refFile)))
+    {
+        std::cerr << "[ariba_minimap] Index file '" << indexFile << "' does not match reference sequences" << std::endl;
+        mm_idx_destroy(mi);
+        return 0;
+    }
+
+    return mi;
+}
+
+
+bool indexMatchesRefFile(const mm_idx_t *mi, const char *refFile)
+{
+    if (!mi->name)
+    {
+        return false;
+    }
+
+    gzFile infile = gzopen(refFile, "r");
+    if (!infile)
+    {
+        return false;
+    }
+
+    kseq_t *ks = kseq_init(infile);
+    uint32_t i = 0;
+    bool matches = true;
+
+    while (matches && kseq_read(ks) >= 0)
+    {
+        matches = i < mi->n && ks->seq.l == (unsigned) mi->len[i] && strcmp(ks->name.s, mi->name[i]) == 0;
+        i++;
+    }
+
+    kseq_destroy(ks);
+    gzclose(infile);
+    return matches && i == mi->n;
+}
+
+
+int loadReadPairs(kseq_t *ks1, kseq_t *ks2, std::vector<ReadPair>& pairs, size_t maxPairs)
+{
+    pairs.clear();
+
+    while (pairs.size() < maxPairs && kseq_read(ks1) >= 0) // each kseq_read() call reads one query sequence
+    {
+        if (kseq_read(ks2) <= 0)
+        {
+            return 0;
+        }
+
+        pairs.push_back(ReadPair());
+        ReadPair& pair = pairs.back();
+        pair.seq1.assign(ks1->seq.s, ks1->seq.l);
+        if (ks1->qual.l > 0) pair.qual1.assign(ks1->qual.s, ks1->qual.l);
+        pair.seq2.assign(ks2->seq.s, ks2->seq.l);
+        if (ks2->qual.l > 0) pair.qual2.assign(ks2->qual.s, ks2->qual.l);
+    }
+
+    return 1;
+}
+
+
+void mapReadPairWorker(void *data, long i, int tid)
+{
+    MappingData *mappingData = (MappingData*) data;
+    mapReadPair(mappingData->mi, mappingData->opt, mappingData->k, *(mappingData->refnameToCluster), (*mappingData->pairs)[i],
+        mappingData->tbufs[2 * tid], mappingData->tbufs[2 * tid + 1], (*mappingData->pairClusters)[i], mappingData->threadCounts[tid]);
+}
+
+
+void mapReadPair(const mm_idx_t *mi, const mm_mapopt_t *opt, int k, const std::map<std::string, std::string>& refnameToCluster, const ReadPair& pair, mm_tbuf_t *tbuf1, mm_tbuf_t *tbuf2, std::vector<std::string>& usedClustersOut, ThreadCounts& counts)
+{
+    const mm_reg1_t *reg1, *reg2;
+    int j, n_reg1, n_reg2;
+
+    // get all hits for the forward and reverse reads
+    reg1 = mm_map(mi, pair.seq1.size(), pair.seq1.c_str(), &n_reg1, tbuf1, opt, 0);
+    reg2 = mm_map(mi, pair.seq2.size(), pair.seq2.c_str(), &n_reg2, tbuf2, opt, 0);
+
+    if (n_reg1 == 0 && n_reg2 == 0)
+    {
+        return;
+    }
+
+    std::map<std::string, MapPositionVector> positions1;
+    std::map<std::string, MapPositionVector> positions2;
+    std::set<std::string> refnames;
+
+    for (j  =0; j < n_reg1; ++j)
+    {
+        const mm_reg1_t *r = &reg1[j];
+        if (readMappingOk(r, mi, pair.seq1.size(), (int) 1.1 * k))
+        {
+            refnames.insert(mi->name[r->rid]);
+            counts.refnameToScore[mi->name[r->rid]] += r->cnt;
+            uint32_t coord = r->rev ? std::max(r->rs, r->re) : std::min(r->rs, r->re);
+            positions1[mi->name[r->rid]].push_back(std::make_pair(coord, r->rev));
+        }
+    }
+    for (j  =0; j < n_reg2; ++j)
+    {
+        const mm_reg1_t *r = &reg2[j];
+        if (readMappingOk(r, mi, pair.seq2.size(), (int) 1.1 * k))
+        {
+            refnames.insert(mi->name[r->rid]);
+            counts.refnameToScore[mi->name[r->rid]] += r->cnt;
+            uint32_t coord = r->rev ? std::max(r->rs, r->re) : std::min(r->rs, r->re);
+            positions2[mi->name[r->rid]].push_back(std::make_pair(coord, r->rev));
+        }
+    }
+
+    bool foundProperPair = false;
+    std::set<std::string> usedClusters;
+    for (std::set<std::string>::const_iterator iter = refnames.begin(); iter != refnames.end(); iter++)
+    {
+        std::map<std::string, std::string>::const_iterator clusterIter = refnameToCluster.find(*iter);
+        std::string cluster = clusterIter == refnameToCluster.end() ? "" : clusterIter->second;
+
+        // do not write a read pair to the same cluster more than once
+        if (usedClusters.find(cluster) != usedClusters.end())
+        {
+            continue;
+        }
+
+        usedClusters.insert(cluster);
+        usedClustersOut.push_back(cluster);
+
+        // get insert size info, if reads mapped as proper pair
+        if (positions1.find(*iter) != positions1.end() && positions2.find(*iter) != positions2.end())
+        {
+            if (positions1[*iter].size() != 1 || positions2[*iter].size() != 1 || positions1[*iter][0].second == positions2[*iter][0].second)
+            {
+                continue;
+            }
+
+            uint32_t insertSize;
+
+            if (positions1[*iter][0].second && positions1[*iter][0].first > positions2[*iter][0].first)
+            {
+                insertSize = positions1[*iter][0].first - positions2[*iter][0].first + 1;
+            }
+            else if (positions2[*iter][0].second && positions2[*iter][0].first > positions1[*iter][0].first)
+            {
+                insertSize = positions2[*iter][0].first - positions1[*iter][0].first + 1;
+            }
+            else
+            {
+                continue;
+            }
+
+            counts.insertHist[insertSize + 2*k]++;
+            foundProperPair = true;
+        }
+    }
+
+    if (foundProperPair)
+    {
+        counts.properPairs++;
+    }
+}
+
+
+bool PairSample::add(uint64_t pairIndex, uint64_t& evictedOut)
+{
+    seen++;
+
+    if (pairIndexes.size() < maxPairs)
+    {
+        pairIndexes.push_back(pairIndex);
+        evictedOut = pairIndex;
+        return true;
+    }
+
+    uint64_t j = random() % seen;
+    if (j < maxPairs)
+    {
+        evictedOut = pairIndexes[j];
+        pairIndexes[j] = pairIndex;
+        return true;
+    }
+
+    return false;
+}
+
+
+std::vector<uint64_t> PairSample::sortedPairIndexes() const
+{
+    std::vector<uint64_t> sorted(pairIndexes);
+    std::sort(sorted.begin(), sorted.end());
+    return sorted;
+}
+
+
+// splitmix64, so that the sample is the same on all platforms
+uint64_t PairSample::random()
+{
+    uint64_t z = (rngState += 0x9e3779b97f4a7c15ULL);
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    return z ^ (z >> 31);
+}
+
+
+bool BlockWriter::open(const std::string& filename)
+{
+    std::string indexFilename = filename + ".index";
+    ofs.open(filename.c_str(), std::ios::binary);
+    indexOfs.open(indexFilename.c_str());
+    return ofs.good() && indexOfs.good();
+}
+
+
+bool BlockWriter::add(const std::string& key, const std::string& record)
+{
+    Buffer& buffer = buffers[key];
+    buffer.data.append(record).append(1, '\n');
+    buffer.records++;
+    totalBuffered += record.size() + 1;
+
+    if (buffer.data.size() >= maxKeyBuffer)
+    {
+        if (!writeBlock(key, buffer))
+        {
+            return false;
+        }
+    }
+
+    if (totalBuffered >= maxTotalBuffer)
+    {
+        for (std::map<std::string, Buffer>::iterator iter = buffers.begin(); iter != buffers.end(); iter++)
+        {
+            if (!writeBlock(iter->first, iter->second))
+            {
+                return false;
+            }
+        }
+    }
+
+    return true;
+}
+
+
+bool BlockWriter::close()
+{
+    bool ok = true;
+    for (std::map<std::string, Buffer>::iterator iter = buffers.begin(); iter != buffers.end(); iter++)
+    {
+        ok = writeBlock(iter->first, iter->second) && ok;
+    }
+
+    ofs.close();
+    indexOfs.close();
+    return ok && !ofs.fail() && !indexOfs.fail();
+}
+
+
+bool BlockWriter::writeBlock(const std::string& key, Buffer& buffer)
+{
+    if (buffer.records == 0)
+    {
+        return true;
+    }
+
+    uLongf compressedLength = compressBound(buffer.data.size());
+    std::vector<Bytef> compressed(compressedLength);
+    if (compress2(&compressed[0], &compressedLength, (const Bytef*) buffer.data.data(), buffer.data.size(), 1) != Z_OK)
+    {
+        return false;
+    }
+
+    ofs.write((const char*) &compressed[0], compressedLength);
+    indexOfs << key << '\t' << offset << '\t' << compressedLength << '\t' << buffer.data.size() << '\t' << buffer.records << '\n';
+    offset += compressedLength;
+    totalBuffered -= buffer.data.size();
+    std::string().swap(buffer.data);
+    buffer.records = 0;
+    return ofs.good() && indexOfs.good();
+}
+
+
+void loadClusters(std::string& filename, std::map<std::string, std::string>& refnameToCluster)
+{
+    std::ifstream ifs;
+    std::string line;
+    ifs.open(filename.c_str());
+    if (!ifs.good())
+    {
+        std::cerr << "Error opening clusters file '" << filename << "'. Cannot continue" << std::endl;
+        exit(1);
+    }
+
+    while(getline(ifs, line))
+    {
+        std::stringstream ss(line);
+        std::string cluster;
+        std::string seqname;
+        getline(ss, cluster, '\t');
         if (cluster.size() == 0)
         {
             std::cerr << "Error reading clusters file at the following line\n" << line << std::endl;
@@ -273,21 +1329,24 @@ void loadClusters(std::string& filename, std::map<std::string, std::string>& ref
 }
 
 
-void chooseCluster(std::string outfile, std::map<std::string, uint64_t>& refnameToScore, std::map<std::string, std::string>& refnameToCluster)
+void chooseCluster(const std::map<std::string, uint64_t>& refnameToScore, std::map<std::string, std::string>& refnameToCluster, std::map<std::string, std::string>& cluster2representativeOut)
 {
     std::map<std::string, uint64_t> bestClusterScore;
-    std::map<std::string, std::string> bestCluster;
-    std::map<std::string, uint64_t>::iterator iter;
+    std::map<std::string, uint64_t>::const_iterator iter;
     for (iter = refnameToScore.begin(); iter != refnameToScore.end(); iter++)
     {
         std::string cluster = refnameToCluster[iter->first];
         if (bestClusterScore.find(cluster) == bestClusterScore.end() || bestClusterScore[cluster] < iter->second)
         {
             bestClusterScore[cluster] = iter->second;
-            bestCluster[cluster] = iter->first;
+            cluster2representativeOut[cluster] = iter->first;
         }
     }
+}
+
 
+void writeCluster2RepresentativeFile(std::string outfile, const std::map<std::string, std::string>& cluster2representative)
+{
     std::ofstream ofs;
     ofs.open(outfile.c_str());
     if (!ofs.good())
@@ -296,9 +1355,9 @@ void chooseCluster(std::string outfile, std::map<std::string, uint64_t>& refname
         exit(1);
     }
 
-    for (iter = bestClusterScore.begin(); iter != bestClusterScore.end(); iter++)
+    for (std::map<std::string, std::string>::const_iterator iter = cluster2representative.begin(); iter != cluster2representative.end(); iter++)
     {
-        ofs << iter->first << '\t' << bestCluster[iter->first] << '\n';
+        ofs << iter->first << '\t' << iter->second << '\n';
     }
 
     ofs.close();
@@ -363,12 +1422,12 @@ void writeProperPairsFile(std::string outfile, uint32_t properPairs)
 }
 
 
-bool readMappingOk(const mm_reg1_t* r, const mm_idx_t* mi, const kseq_t *ks, uint32_t endTolerance)
+bool readMappingOk(const mm_reg1_t* r, const mm_idx_t* mi, unsigned readLength, uint32_t endTolerance)
 {
     // coords are same style as python (0-based, end is one past the end)
     assert (r->qs < r->qe && r->rs <  r->re);
 
-    if (r->qe - r->qs < std::min((unsigned) 50, (int) 0.5 * ks->seq.l))
+    if (r->qe - r->qs < std::min((unsigned) 50, (int) 0.5 * readLength))
     {
         return false;
     }
@@ -379,13 +1438,927 @@ bool readMappingOk(const mm_reg1_t* r, const mm_idx_t* mi, const kseq_t *ks, uin
     if (r->rev)
     {
         startOk = (r->qs < endTolerance || refLength - r->re < endTolerance);
-        endOk = (ks->seq.l - r->qe < endTolerance || r->rs < endTolerance);
+        endOk = (readLength - r->qe < endTolerance || r->rs < endTolerance);
     }
     else
     {
         startOk = (r->qs < endTolerance || r->rs < endTolerance);
-        endOk = (ks->seq.l - r->qe < endTolerance || refLength - r->re < endTolerance);
+        endOk = (readLength - r->qe < endTolerance || refLength - r->re < endTolerance);
     }
 
     return (startOk && endOk);
 }
+
+
+bool loadSequences(const char *filename, std::vector<std::string>& namesOut, std::vector<std::string>& seqsOut)
+{
+    gzFile infile = gzopen(filename, "r");
+    if (!infile)
+    {
+        std::cerr << "[ariba_minimap] Error opening file " << filename << std::endl;
+        return false;
+    }
+
+    kseq_t *ks = kseq_init(infile);
+    while (kseq_read(ks) >= 0)
+    {
+        namesOut.push_back(ks->name.s);
+        std::string seq(ks->seq.s, ks->seq.l);
+        std::transform(seq.begin(), seq.end(), seq.begin(), ::toupper);
+        seqsOut.push_back(seq);
+    }
+
+    kseq_destroy(ks);
+    gzclose(infile);
+    return true;
+}
+
+
+std::string reverseComplement(const std::string& seq)
+{
+    std::string revcomp(seq.rbegin(), seq.rend());
+    for (std::string::iterator iter = revcomp.begin(); iter != revcomp.end(); iter++)
+    {
+        switch (*iter)
+        {
+            case 'A': *iter = 'T'; break;
+            case 'C': *iter = 'G'; break;
+            case 'G': *iter = 'C'; break;
+            case 'T': *iter = 'A'; break;
+            default: *iter = 'N';
+        }
+    }
+    return revcomp;
+}
+
+
+// Smith-Waterman alignment with affine gaps of ref[rWinStart, rWinEnd) against
+// qry[qWinStart, qWinEnd), only looking at cells within halfBand of the line
+// that goes through (centreRef, centreQryStart) and (centreRef + centreLength, centreQryEnd),
+// and that has slope 1 outside of that. Returns the alignment score. Start
+// positions of the best local alignment are put in refStartOut and qryStartOut,
+// and its operations in opsOut: 'M' (match or mismatch), 'D' (base in ref only),
+// 'I' (base in query only).
+int bandedLocalAlign(const std::string& ref, int rWinStart, int rWinEnd, const std::string& qry, int qWinStart, int qWinEnd, int centreRef, int centreLength, int centreQryStart, int centreQryEnd, int halfBand, int& refStartOut, int& qryStartOut, std::vector<char>& opsOut)
+{
+    const int negInf = -1000000000;
+    const int rows = rWinEnd - rWinStart;
+    const int cols = qWinEnd - qWinStart;
+    std::vector<int> lo(rows + 1, 1);
+    std::vector<int> hi(rows + 1, 0);
+    std::vector<size_t> rowOffset(rows + 2, 0);
+
+    for (int ii = 1; ii <= rows; ++ii)
+    {
+        int refPos = rWinStart + ii - 1;
+        double centre;
+        if (refPos < centreRef)
+        {
+            centre = centreQryStart - (centreRef - refPos);
+        }
+        else if (refPos >= centreRef + centreLength)
+        {
+            centre = centreQryEnd + (refPos - centreRef - centreLength);
+        }
+        else
+        {
+            centre = centreQryStart + 1.0 * (refPos - centreRef) * (centreQryEnd - centreQryStart) / std::max(1, centreLength);
+        }
+        int col = (int) centre - qWinStart + 1;
+        lo[ii] = std::max(1, col - halfBand);
+        hi[ii] = std::min(cols, col + halfBand);
+        rowOffset[ii + 1] = rowOffset[ii] + (hi[ii] >= lo[ii] ? hi[ii] - lo[ii] + 1 : 0);
+    }
+
+    // traceback bits: 0-1 = where H came from (0 = nowhere, 1 = diagonal, 2 = E, 3 = F),
+    // 2 = E extended a gap, 3 = F extended a gap, 4 = diagonal started a new alignment
+    std::vector<uint8_t> traceback(rowOffset[rows + 1], 0);
+    std::vector<int> prevH(cols + 2, 0), prevE(cols + 2, negInf), curH(cols + 2, 0), curE(cols + 2, negInf);
+    int prevLo = 1, prevHi = 0;
+    int best = 0, bestI = 0, bestJ = 0;
+
+    for (int ii = 1; ii <= rows; ++ii)
+    {
+        const char refBase = ref[rWinStart + ii - 1];
+        int f = negInf;
+        for (int jj = lo[ii]; jj <= hi[ii]; ++jj)
+        {
+            uint8_t tb = 0;
+            const char qryBase = qry[qWinStart + jj - 1];
+            const bool prevDiagInBand = (ii > 1 && jj - 1 >= prevLo && jj - 1 <= prevHi);
+            const int hd = prevDiagInBand ? prevH[jj - 1] : 0;
+            const int diag = hd + (refBase == qryBase && refBase != 'N' ? alignMatch : alignMismatch);
+            if (hd <= 0)
+            {
+                tb |= 16;
+            }
+
+            int e = negInf;
+            if (ii > 1 && jj >= prevLo && jj <= prevHi)
+            {
+                const int eOpen = prevH[jj] - alignGapOpen - alignGapExtend;
+                const int eExtend = prevE[jj] - alignGapExtend;
+                if (eExtend > eOpen)
+                {
+                    e = eExtend;
+                    tb |= 4;
+                }
+                else
+                {
+                    e = eOpen;
+                }
+            }
+
+            if (jj > lo[ii])
+            {
+                const int fOpen = curH[jj - 1] - alignGapOpen - alignGapExtend;
+                const int fExtend = f - alignGapExtend;
+                if (fExtend > fOpen)
+                {
+                    f = fExtend;
+                    tb |= 8;
+                }
+                else
+                {
+                    f = fOpen;
+                }
+            }
+            else
+            {
+                f = negInf;
+            }
+
+            int h = 0;
+            if (diag > 0 && diag >= e && diag >= f)
+            {
+                h = diag;
+                tb |= 1;
+            }
+            else if (e > 0 && e >= f)
+            {
+                h = e;
+                tb |= 2;
+            }
+            else if (f > 0)
+            {
+                h = f;
+                tb |= 3;
+            }
+
+            curH[jj] = h;
+            curE[jj] = e;
+            traceback[rowOffset[ii] + jj - lo[ii]] = tb;
+            if (h > best)
+            {
+                best = h;
+                bestI = ii;
+                bestJ = jj;
+            }
+        }
+
+        for (int jj = lo[ii]; jj <= hi[ii]; ++jj)
+        {
+            prevH[jj] = curH[jj];
+            prevE[jj] = curE[jj];
+        }
+        prevLo = lo[ii];
+        prevHi = hi[ii];
+    }
+
+    opsOut.clear();
+    if (best == 0)
+    {
+        return 0;
+    }
+
+    int ii = bestI, jj = bestJ;
+    char state = 'H';
+    while (ii > 0 && jj > 0)
+    {
+        const uint8_t tb = traceback[rowOffset[ii] + jj - lo[ii]];
+        if (state == 'H')
+        {
+            const int from = tb & 3;
+            if (from == 1)
+            {
+                opsOut.push_back('M');
+                --ii;
+                --jj;
+                if (tb & 16)
+                {
+                    break;
+                }
+            }
+            else if (from == 2)
+            {
+                state = 'E';
+            }
+            else if (from == 3)
+            {
+                state = 'F';
+            }
+            else
+            {
+                break;
+            }
+        }
+        else if (state == 'E')
+        {
+            opsOut.push_back('D');
+            state = (tb & 4) ? 'E' : 'H';
+            --ii;
+        }
+        else
+        {
+            opsOut.push_back('I');
+            state = (tb & 8) ? 'F' : 'H';
+            --jj;
+        }
+    }
+
+    std::reverse(opsOut.begin(), opsOut.end());
+    refStartOut = rWinStart + ii;
+    qryStartOut = qWinStart + jj;
+    return best;
+}
+
+
+// Makes a hit from alignment operations. Positions in the hit are 1-based and
+// the query positions are on the forward strand, as in show-coords and show-snps
+AlignHit makeAlignHit(const std::string& ref, const std::string& orientedQry, bool reverse, uint32_t refId, uint32_t qryId, int refStart, int qryStart, const std::vector<char>& ops)
+{
+    AlignHit hit;
+    const int qryLength = orientedQry.size();
+    hit.refId = refId;
+    hit.qryId = qryId;
+    hit.reverse = reverse;
+    hit.refLength = ref.size();
+    hit.qryLength = qryLength;
+    int refPos = refStart;
+    int qryPos = qryStart;
+    int errors = 0;
+
+    for (std::vector<char>::const_iterator iter = ops.begin(); iter != ops.end(); iter++)
+    {
+        AlignSnp snp;
+        bool isSnp = false;
+
+        if (*iter == 'M')
+        {
+            if (ref[refPos] != orientedQry[qryPos] || ref[refPos] == 'N')
+            {
+                snp.refPos = refPos + 1;
+                snp.refBase = ref[refPos];
+                snp.qryBase = orientedQry[qryPos];
+                snp.qryPos = qryPos + 1;
+                isSnp = true;
+            }
+            ++refPos;
+            ++qryPos;
+        }
+        else if (*iter == 'D')
+        {
+            snp.refPos = refPos + 1;
+            snp.refBase = ref[refPos];
+            snp.qryBase = '.';
+            snp.qryPos = qryPos;
+            isSnp = true;
+            ++refPos;
+        }
+        else
+        {
+            snp.refPos = refPos;
+            snp.refBase = '.';
+            snp.qryBase = orientedQry[qryPos];
+            snp.qryPos = qryPos + 1;
+            isSnp = true;
+            ++qryPos;
+        }
+
+        if (isSnp)
+        {
+            if (reverse)
+            {
+                snp.qryPos = qryLength - snp.qryPos + 1;
+            }
+            hit.snps.push_back(snp);
+            ++errors;
+        }
+    }
+
+    hit.refStart = refStart + 1;
+    hit.refEnd = refPos;
+    hit.hitLengthRef = refPos - refStart;
+    hit.hitLengthQry = qryPos - qryStart;
+    hit.percentIdentity = ops.size() ? 100.0 * (ops.size() - errors) / ops.size() : 0;
+    if (reverse)
+    {
+        hit.qryStart = qryLength - qryStart;
+        hit.qryEnd = qryLength - qryPos + 1;
+    }
+    else
+    {
+        hit.qryStart = qryStart + 1;
+        hit.qryEnd = qryPos;
+    }
+
+    // BUFF = distance to the nearest other difference or end of the alignment,
+    // DIST = distance to the nearest end of either sequence
+    for (size_t i = 0; i < hit.snps.size(); ++i)
+    {
+        AlignSnp& snp = hit.snps[i];
+        int buff = std::min(snp.refPos - hit.refStart, hit.refEnd - snp.refPos);
+        if (i > 0)
+        {
+            buff = std::min(buff, snp.refPos - hit.snps[i-1].refPos);
+        }
+        if (i + 1 < hit.snps.size())
+        {
+            buff = std::min(buff, hit.snps[i+1].refPos - snp.refPos);
+        }
+        snp.buff = buff;
+        snp.dist = std::min(std::min(snp.refPos - 1, hit.refLength - snp.refPos), std::min(snp.qryPos - 1, hit.qryLength - snp.qryPos));
+    }
+
+    return hit;
+}
+
+
+bool alignHitCompare(const AlignHit& lhs, const AlignHit& rhs)
+{
+    if (lhs.refId != rhs.refId) return lhs.refId < rhs.refId;
+    if (lhs.refStart != rhs.refStart) return lhs.refStart < rhs.refStart;
+    if (lhs.refEnd != rhs.refEnd) return lhs.refEnd < rhs.refEnd;
+    if (lhs.qryId != rhs.qryId) return lhs.qryId < rhs.qryId;
+    if (lhs.qryStart != rhs.qryStart) return lhs.qryStart < rhs.qryStart;
+    return lhs.qryEnd < rhs.qryEnd;
+}
+
+
+int run_align_sequences(char *refFileIn, char *qryFileIn, double minIdentity, int minLength, std::vector<std::string>& refNamesOut, std::vector<std::string>& qryNamesOut, std::vector<AlignHit>& hitsOut)
+{
+    mm_verbose = 0;
+    std::vector<std::string> refSeqs;
+    std::vector<std::string> qrySeqs;
+    if (!loadSequences(refFileIn, refNamesOut, refSeqs) || !loadSequences(qryFileIn, qryNamesOut, qrySeqs))
+    {
+        return 1;
+    }
+
+    mm_idx_t *mi = mm_idx_build(refFileIn, alignIndexW, alignIndexK, 1);
+    if (!mi)
+    {
+        std::cerr << "[ariba_minimap] Error making index of file " << refFileIn << std::endl;
+        return 1;
+    }
+    mm_idx_set_max_occ(mi, indexMaxOccFraction);
+
+    // minimap skips empty sequences, so look up its reference ids by name
+    std::map<std::string, uint32_t> refNameToId;
+    for (uint32_t i = 0; i < refNamesOut.size(); ++i)
+    {
+        refNameToId[refNamesOut[i]] = i;
+    }
+
+    mm_mapopt_t opt;
+    mm_mapopt_init(&opt);
+    opt.min_cnt = alignMinMinimizers;
+    opt.min_match = std::min(opt.min_match, std::max(alignIndexK, minLength));
+    mm_tbuf_t *tbuf = mm_tbuf_init();
+    std::set<std::vector<int> > seen;
+
+    for (uint32_t qryId = 0; qryId < qrySeqs.size(); ++qryId)
+    {
+        const std::string& qry = qrySeqs[qryId];
+        const int qryLength = qry.size();
+        if (qryLength == 0)
+        {
+            continue;
+        }
+        const std::string qryRevcomp = reverseComplement(qry);
+        int nReg;
+        const mm_reg1_t *reg = mm_map(mi, qryLength, qry.c_str(), &nReg, tbuf, &opt, 0);
+
+        for (int r = 0; r < nReg; ++r)
+        {
+            std::map<std::string, uint32_t>::const_iterator idIter = refNameToId.find(mi->name[reg[r].rid]);
+            if (idIter == refNameToId.end())
+            {
+                continue;
+            }
+            const uint32_t refId = idIter->second;
+            const std::string& ref = refSeqs[refId];
+            const int refLength = ref.size();
+            const bool reverse = reg[r].rev;
+            const std::string& orientedQry = reverse ? qryRevcomp : qry;
+            const int rs = reg[r].rs;
+            const int re = reg[r].re;
+            const int qs = reverse ? qryLength - reg[r].qe : reg[r].qs;
+            const int qe = reverse ? qryLength - reg[r].qs : reg[r].qe;
+            const int halfBand = alignBandPad + abs((re - rs) - (qe - qs));
+            const int rWinStart = std::max(0, rs - qs - alignBandPad);
+            const int rWinEnd = std::min(refLength, re + (qryLength - qe) + alignBandPad);
+            const int qWinStart = std::max(0, qs - rs - alignBandPad);
+            const int qWinEnd = std::min(qryLength, qe + (refLength - re) + alignBandPad);
+            int refStart, qryStart;
+            std::vector<char> ops;
+
+            if (bandedLocalAlign(ref, rWinStart, rWinEnd, orientedQry, qWinStart, qWinEnd, rs, re - rs, qs, qe, halfBand, refStart, qryStart, ops) == 0)
+            {
+                continue;
+            }
+
+            AlignHit hit = makeAlignHit(ref, orientedQry, reverse, refId, qryId, refStart, qryStart, ops);
+            if (hit.percentIdentity < minIdentity || hit.hitLengthRef < minLength)
+            {
+                continue;
+            }
+
+            std::vector<int> key;
+            key.push_back(refId);
+            key.push_back(qryId);
+            key.push_back(hit.refStart);
+            key.push_back(hit.refEnd);
+            key.push_back(hit.qryStart);
+            key.push_back(hit.qryEnd);
+            if (seen.insert(key).second)
+            {
+                hitsOut.push_back(hit);
+            }
+        }
+    }
+
+    mm_tbuf_destroy(tbuf);
+    mm_idx_destroy(mi);
+    std::sort(hitsOut.begin(), hitsOut.end(), alignHitCompare);
+    return 0;
+}
+
+
+std::string removeMateSuffix(const std::string& name)
+{
+    const size_t length = name.size();
+    if (length > 2 && name[length - 2] == '/' && (name[length - 1] == '1' || name[length - 1] == '2'))
+    {
+        return name.substr(0, length - 2);
+    }
+    return name;
+}
+
+
+bool readAlignmentScoreCompare(const ReadAlignment& lhs, const ReadAlignment& rhs)
+{
+    return lhs.score > rhs.score;
+}
+
+
+// Minimum alignment score of a read. Same as the bowtie2 option --score-min G,1,10
+// used in mapping.run_bowtie2, but with the scores of the in-process alignment
+int readMapMinScore(int readLength)
+{
+    return 1 + (int) (10 * log(readLength));
+}
+
+
+ReadAlignment makeReadAlignment(const std::string& ref, const std::string& orientedRead, uint32_t refId, bool reverse, int refStart, int qryStart, const std::vector<char>& ops, int score)
+{
+    const int readLength = orientedRead.size();
+    ReadAlignment aln;
+    aln.refId = refId;
+    aln.pos = refStart;
+    aln.reverse = reverse;
+    aln.score = score;
+    aln.leftClip = qryStart;
+
+    std::ostringstream cigar;
+    if (qryStart > 0)
+    {
+        cigar << qryStart << 'S';
+    }
+    int refPos = refStart;
+    int qryPos = qryStart;
+    size_t i = 0;
+    while (i < ops.size())
+    {
+        size_t j = i;
+        while (j < ops.size() && ops[j] == ops[i])
+        {
+            if (ops[j] == 'M')
+            {
+                if (ref[refPos] != orientedRead[qryPos] || ref[refPos] == 'N')
+                {
+                    aln.editDistance++;
+                }
+                ++refPos;
+                ++qryPos;
+            }
+            else if (ops[j] == 'D')
+            {
+                aln.editDistance++;
+                ++refPos;
+            }
+            else
+            {
+                aln.editDistance++;
+                ++qryPos;
+            }
+            ++j;
+        }
+        cigar << j - i << ops[i];
+        i = j;
+    }
+    if (qryPos < readLength)
+    {
+        cigar << readLength - qryPos << 'S';
+    }
+    aln.end = refPos;
+    aln.cigar = cigar.str();
+    return aln;
+}
+
+
+// Aligns one read to the references, returning one alignment per distinct
+// place that the read aligns, sorted by decreasing score
+std::vector<ReadAlignment> alignRead(const mm_idx_t *mi, const mm_mapopt_t *opt, const std::vector<std::string>& refSeqs, const std::vector<int>& indexToRefId, const std::string& read, mm_tbuf_t *tbuf)
+{
+    std::vector<ReadAlignment> alignments;
+    const int readLength = read.size();
+    if (readLength == 0)
+    {
+        return alignments;
+    }
+
+    const std::string readRevcomp = reverseComplement(read);
+    std::set<std::vector<int> > seen;
+    int nReg;
+    const mm_reg1_t *reg = mm_map(mi, readLength, read.c_str(), &nReg, tbuf, opt, 0);
+
+    for (int r = 0; r < nReg; ++r)
+    {
+        const int refIdOrMinus = indexToRefId[reg[r].rid];
+        if (refIdOrMinus < 0)
+        {
+            continue;
+        }
+        const std::string& ref = refSeqs[refIdOrMinus];
+        const int refLength = ref.size();
+        const bool reverse = reg[r].rev;
+        const std::string& orientedRead = reverse ? readRevcomp : read;
+        const int rs = reg[r].rs;
+        const int re = reg[r].re;
+        const int qs = reverse ? readLength - reg[r].qe : reg[r].qs;
+        const int qe = reverse ? readLength - reg[r].qs : reg[r].qe;
+        const int halfBand = readMapBandPad + abs((re - rs) - (qe - qs));
+        const int rWinStart = std::max(0, rs - qs - readMapBandPad);
+        const int rWinEnd = std::min(refLength, re + (readLength - qe) + readMapBandPad);
+        int refStart, qryStart;
+        std::vector<char> ops;
+
+        const int score = bandedLocalAlign(ref, rWinStart, rWinEnd, orientedRead, 0, readLength, rs, re - rs, qs, qe, halfBand, refStart, qryStart, ops);
+        if (score == 0 || score < readMapMinScore(readLength))
+        {
+            continue;
+        }
+
+        ReadAlignment aln = makeReadAlignment(ref, orientedRead, refIdOrMinus, reverse, refStart, qryStart, ops, score);
+        std::vector<int> key;
+        key.push_back(aln.refId);
+        key.push_back(aln.pos);
+        key.push_back(aln.reverse);
+        if (seen.insert(key).second)
+        {
+            alignments.push_back(aln);
+        }
+    }
+
+    std::stable_sort(alignments.begin(), alignments.end(), readAlignmentScoreCompare);
+    return alignments;
+}
+
+
+// Returns the insert size of the pair if the two alignments are a proper pair
+// ("innies" on the same reference, with insert size at most maxInsert), otherwise zero
+int properPairInsert(const ReadAlignment& aln1, const ReadAlignment& aln2, int maxInsert)
+{
+    if (aln1.refId != aln2.refId || aln1.reverse == aln2.reverse)
+    {
+        return 0;
+    }
+    const ReadAlignment& fwd = aln1.reverse ? aln2 : aln1;
+    const ReadAlignment& rev = aln1.reverse ? aln1 : aln2;
+    if (fwd.pos > rev.end)
+    {
+        return 0;
+    }
+    const int insert = std::max(fwd.end, rev.end) - std::min(fwd.pos - fwd.leftClip, rev.pos - rev.leftClip);
+    return insert <= maxInsert ? insert : 0;
+}
+
+
+// Looks for an alignment of a read whose mate is aligned but that had no
+// alignment itself, by aligning it (in the orientation expected from its
+// mate) to all of the reference within maxInsert of the mate. Returns true
+// if it was found, in which case it is put in alnOut
+bool rescueMate(const std::string& ref, const ReadAlignment& mateAln, const std::string& read, int maxInsert, ReadAlignment& alnOut)
+{
+    const int readLength = read.size();
+    const int refLength = ref.size();
+    if (readLength == 0)
+    {
+        return false;
+    }
+
+    const bool reverse = !mateAln.reverse;
+    const std::string orientedRead = reverse ? reverseComplement(read) : read;
+    const int rWinStart = reverse ? std::max(0, mateAln.pos) : std::max(0, mateAln.end - maxInsert);
+    const int rWinEnd = reverse ? std::min(refLength, mateAln.pos - mateAln.leftClip + maxInsert) : std::min(refLength, mateAln.end);
+    if (rWinEnd - rWinStart < readMapIndexK)
+    {
+        return false;
+    }
+
+    // band is wide enough to include every cell, ie a full local alignment
+    int refStart, qryStart;
+    std::vector<char> ops;
+    const int score = bandedLocalAlign(ref, rWinStart, rWinEnd, orientedRead, 0, readLength, rWinStart, 0, 0, 0, rWinEnd - rWinStart + readLength, refStart, qryStart, ops);
+    if (score < readMapMinScore(readLength))
+    {
+        return false;
+    }
+
+    alnOut = makeReadAlignment(ref, orientedRead, mateAln.refId, reverse, refStart, qryStart, ops, score);
+    return true;
+}
+
+
+// Mapping quality of the alignment alignments[chosen], from the difference
+// between its score and the best score of the other alignments of the read
+int mappingQuality(const std::vector<ReadAlignment>& alignments, size_t chosen)
+{
+    int otherBest = 0;
+    for (size_t i = 0; i < alignments.size(); ++i)
+    {
+        if (i != chosen)
+        {
+            otherBest = std::max(otherBest, alignments[i].score);
+        }
+    }
+    if (otherBest == 0)
+    {
+        return readMapMaxMapq;
+    }
+    const int diff = alignments[chosen].score - otherBest;
+    return diff <= 0 ? 0 : std::min(readMapMaxMapq, 3 * diff);
+}
+
+
+void appendSamLine(std::ostringstream& out, const std::string& name, const std::string& seq, const std::string& qual, bool isRead1, const ReadAlignment *aln, const ReadAlignment *mateAln, bool properPair, const std::vector<std::string>& refNames)
+{
+    int flag = 1 | (isRead1 ? 64 : 128);
+    if (properPair) flag |= 2;
+    if (aln == NULL) flag |= 4;
+    if (mateAln == NULL) flag |= 8;
+    if (aln != NULL && aln->reverse) flag |= 16;
+    if (mateAln != NULL && mateAln->reverse) flag |= 32;
+
+    // An unmapped read with a mapped mate is given the position of its mate, as in bowtie2
+    const ReadAlignment *placed = aln == NULL ? mateAln : aln;
+    const ReadAlignment *matePlaced = mateAln == NULL ? aln : mateAln;
+    const bool reverse = aln != NULL && aln->reverse;
+    std::string outSeq = reverse ? reverseComplement(seq) : seq;
+    std::string outQual = qual.size() ? (reverse ? std::string(qual.rbegin(), qual.rend()) : qual) : "*";
+    int tlen = 0;
+    if (aln != NULL && mateAln != NULL && aln->refId == mateAln->refId)
+    {
+        const int start = std::min(aln->pos - aln->leftClip, mateAln->pos - mateAln->leftClip);
+        const int end = std::max(aln->end, mateAln->end);
+        const bool leftmost = aln->pos < mateAln->pos || (aln->pos == mateAln->pos && isRead1);
+        tlen = leftmost ? end - start : start - end;
+    }
+
+    out << name << '\t' << flag << '\t'
+        << (placed == NULL ? "*" : refNames[placed->refId]) << '\t'
+        << (placed == NULL ? 0 : placed->pos + 1) << '\t'
+        << (aln == NULL ? 0 : aln->mapq) << '\t'
+        << (aln == NULL ? "*" : aln->cigar) << '\t'
+        << (matePlaced == NULL ? "*" : (placed != NULL && placed->refId == matePlaced->refId ? "=" : refNames[matePlaced->refId])) << '\t'
+        << (matePlaced == NULL ? 0 : matePlaced->pos + 1) << '\t'
+        << tlen << '\t' << outSeq << '\t' << outQual;
+    if (aln != NULL)
+    {
+        out << "\tAS:i:" << aln->score << "\tNM:i:" << aln->editDistance;
+    }
+    out << '\n';
+}
+
+
+void mapNamedReadPair(const ReadMappingData& data, NamedReadPair& namedPair, mm_tbuf_t *tbuf)
+{
+    ReadPair& pair = namedPair.pair;
+    std::transform(pair.seq1.begin(), pair.seq1.end(), pair.seq1.begin(), ::toupper);
+    std::transform(pair.seq2.begin(), pair.seq2.end(), pair.seq2.begin(), ::toupper);
+    std::vector<ReadAlignment> alns1 = alignRead(data.mi, data.opt, *data.refSeqs, *data.indexToRefId, pair.seq1, tbuf);
+    std::vector<ReadAlignment> alns2 = alignRead(data.mi, data.opt, *data.refSeqs, *data.indexToRefId, pair.seq2, tbuf);
+    long chosen1 = alns1.size() ? 0 : -1;
+    long chosen2 = alns2.size() ? 0 : -1;
+    bool properPair = false;
+
+    if (chosen1 >= 0 && chosen2 >= 0)
+    {
+        const int unpairedScore = alns1[0].score + alns2[0].score;
+        int bestPairedScore = -1;
+        for (size_t i = 0; i < alns1.size(); ++i)
+        {
+            for (size_t j = 0; j < alns2.size(); ++j)
+            {
+                const int pairedScore = alns1[i].score + alns2[j].score;
+                if (pairedScore > bestPairedScore && properPairInsert(alns1[i], alns2[j], data.maxInsert) > 0)
+                {
+                    bestPairedScore = pairedScore;
+                    chosen1 = i;
+                    chosen2 = j;
+                }
+            }
+        }
+
+        if (bestPairedScore >= 0 && bestPairedScore >= unpairedScore - readMapUnpairedPenalty)
+        {
+            properPair = true;
+        }
+        else
+        {
+            chosen1 = chosen2 = 0;
+        }
+    }
+
+    ReadAlignment rescued;
+    if (chosen1 >= 0 && chosen2 < 0 && rescueMate((*data.refSeqs)[alns1[chosen1].refId], alns1[chosen1], pair.seq2, data.maxInsert, rescued))
+    {
+        alns2.push_back(rescued);
+        chosen2 = 0;
+        properPair = properPairInsert(alns1[chosen1], alns2[chosen2], data.maxInsert) > 0;
+    }
+    else if (chosen2 >= 0 && chosen1 < 0 && rescueMate((*data.refSeqs)[alns2[chosen2].refId], alns2[chosen2], pair.seq1, data.maxInsert, rescued))
+    {
+        alns1.push_back(rescued);
+        chosen1 = 0;
+        properPair = properPairInsert(alns1[chosen1], alns2[chosen2], data.maxInsert) > 0;
+    }
+
+    ReadAlignment *aln1 = NULL;
+    ReadAlignment *aln2 = NULL;
+    if (chosen1 >= 0)
+    {
+        aln1 = &alns1[chosen1];
+        aln1->mapq = mappingQuality(alns1, chosen1);
+    }
+    if (chosen2 >= 0)
+    {
+        aln2 = &alns2[chosen2];
+        aln2->mapq = mappingQuality(alns2, chosen2);
+    }
+
+    std::ostringstream out;
+    appendSamLine(out, namedPair.name, pair.seq1, pair.qual1, true, aln1, aln2, properPair, *data.refNames);
+    appendSamLine(out, namedPair.name, pair.seq2, pair.qual2, false, aln2, aln1, properPair, *data.refNames);
+    namedPair.samLines = out.str();
+}
+
+
+void mapNamedReadPairWorker(void *data, long i, int tid)
+{
+    ReadMappingData *mappingData = (ReadMappingData*) data;
+    mapNamedReadPair(*mappingData, (*mappingData->pairs)[i], mappingData->tbufs[tid]);
+}
+
+
+int loadNamedReadPairs(kseq_t *ks1, kseq_t *ks2, std::vector<NamedReadPair>& pairs, size_t maxPairs)
+{
+    pairs.clear();
+
+    while (pairs.size() < maxPairs && kseq_read(ks1) >= 0)
+    {
+        if (kseq_read(ks2) <= 0)
+        {
+            return 0;
+        }
+
+        pairs.push_back(NamedReadPair());
+        NamedReadPair& namedPair = pairs.back();
+        namedPair.name = removeMateSuffix(ks1->name.s);
+        namedPair.pair.seq1.assign(ks1->seq.s, ks1->seq.l);
+        if (ks1->qual.l > 0) namedPair.pair.qual1.assign(ks1->qual.s, ks1->qual.l);
+        namedPair.pair.seq2.assign(ks2->seq.s, ks2->seq.l);
+        if (ks2->qual.l > 0) namedPair.pair.qual2.assign(ks2->qual.s, ks2->qual.l);
+    }
+
+    return 1;
+}
+
+
+int run_map_reads(char *refFileIn, char *readsFile1In, char *readsFile2In, int maxInsert, int n_threads, std::ostream& samOut)
+{
+    mm_verbose = 0;
+    n_threads = std::max(1, n_threads);
+    std::vector<std::string> refNames;
+    std::vector<std::string> refSeqs;
+    if (!loadSequences(refFileIn, refNames, refSeqs))
+    {
+        return 1;
+    }
+
+    samOut << "@HD\tVN:1.0\tSO:unsorted\n";
+    for (size_t i = 0; i < refNames.size(); ++i)
+    {
+        samOut << "@SQ\tSN:" << refNames[i] << "\tLN:" << refSeqs[i].size() << '\n';
+    }
+    samOut << "@PG\tID:minimap_ariba\tPN:minimap_ariba\n";
+
+    mm_idx_t *mi = mm_idx_build(refFileIn, readMapIndexW, readMapIndexK, 1);
+    if (!mi)
+    {
+        std::cerr << "[ariba_minimap] Error making index of file " << refFileIn << std::endl;
+        return 1;
+    }
+    mm_idx_set_max_occ(mi, indexMaxOccFraction);
+
+    // minimap skips empty sequences, so look up its reference ids by name
+    std::map<std::string, int> refNameToId;
+    for (size_t i = 0; i < refNames.size(); ++i)
+    {
+        refNameToId[refNames[i]] = i;
+    }
+    std::vector<int> indexToRefId(mi->n, -1);
+    for (uint32_t i = 0; i < mi->n; ++i)
+    {
+        std::map<std::string, int>::const_iterator iter = refNameToId.find(mi->name[i]);
+        if (iter != refNameToId.end())
+        {
+            indexToRefId[i] = iter->second;
+        }
+    }
+
+    gzFile fp1 = gzopen(readsFile1In, "r");
+    gzFile fp2 = gzopen(readsFile2In, "r");
+    if (!fp1 || !fp2)
+    {
+        std::cerr << "[ariba_minimap] Error opening reads files " << readsFile1In << " " << readsFile2In << std::endl;
+        if (fp1) gzclose(fp1);
+        if (fp2) gzclose(fp2);
+        mm_idx_destroy(mi);
+        return 1;
+    }
+    kseq_t *ks1 = kseq_init(fp1);
+    kseq_t *ks2 = kseq_init(fp2);
+
+    mm_mapopt_t opt;
+    mm_mapopt_init(&opt);
+    opt.min_cnt = readMapMinMinimizers;
+    opt.min_match = readMapMinMatch;
+
+    std::vector<NamedReadPair> pairs;
+    ReadMappingData mappingData;
+    mappingData.mi = mi;
+    mappingData.opt = &opt;
+    mappingData.refNames = &refNames;
+    mappingData.refSeqs = &refSeqs;
+    mappingData.indexToRefId = &indexToRefId;
+    mappingData.maxInsert = maxInsert;
+    mappingData.pairs = &pairs;
+    for (int i = 0; i < n_threads; ++i)
+    {
+        mappingData.tbufs.push_back(mm_tbuf_init());
+    }
+
+    int exitCode = 0;
+    while (true)
+    {
+        if (!loadNamedReadPairs(ks1, ks2, pairs, readPairBatchSize))
+        {
+            std::cerr << "[ariba_minimap] Error! Number of reads in files " << readsFile1In << " and " << readsFile2In << " differ" << std::endl;
+            exitCode = 1;
+            break;
+        }
+        if (pairs.size() == 0)
+        {
+            break;
+        }
+
+        kt_for(n_threads, mapNamedReadPairWorker, &mappingData, pairs.size());
+        for (std::vector<NamedReadPair>::const_iterator iter = pairs.begin(); iter != pairs.end(); iter++)
+        {
+            samOut << iter->samLines;
+        }
+    }
+
+    for (int i = 0; i < n_threads; ++i)
+    {
+        mm_tbuf_destroy(mappingData.tbufs[i]);
+    }
+    kseq_destroy(ks1);
+    kseq_destroy(ks2);
+    gzclose(fp1);
+    gzclose(fp2);
+    mm_idx_destroy(mi);
+    return exitCode;
+}
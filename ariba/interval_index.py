@@ -0,0 +1,74 @@
+import bisect
+
+class Error (Exception): pass
+
+
+class IntervalIndex:
+    '''Index of closed intervals [start, end], each with a value, for fast point
+       and range queries. Intervals are sorted by start position. max_ends[i] is the
+       largest end of intervals 0..i, so that a query can stop as soon as no earlier
+       interval can reach it. Queries return values in the order the intervals were given'''
+    def __init__(self, intervals=None):
+        '''intervals = iterable of (start, end, value) tuples'''
+        intervals = [] if intervals is None else list(intervals)
+        order = sorted(range(len(intervals)), key=lambda i: (intervals[i][0], i))
+        self.starts = [intervals[i][0] for i in order]
+        self.ends = [intervals[i][1] for i in order]
+        self.values = [intervals[i][2] for i in order]
+        self.orders = order
+        self.max_ends = []
+        for end in self.ends:
+            self.max_ends.append(end if len(self.max_ends) == 0 else max(end, self.max_ends[-1]))
+
+        if any([end < start for start, end in zip(self.starts, self.ends)]):
+            raise Error('Cannot make interval index because an interval has end < start')
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+    def _overlapping_indexes(self, start, end):
+        i = bisect.bisect_right(self.starts, end) - 1
+        found = []
+        while i >= 0 and self.max_ends[i] >= start:
+            if self.ends[i] >= start:
+                found.append(i)
+            i -= 1
+        found.sort(key=lambda x: self.orders[x])
+        return found
+
+
+    def overlapping(self, start, end):
+        '''Returns list of values of intervals that overlap [start, end]'''
+        return [self.values[i] for i in self._overlapping_indexes(start, end)]
+
+
+    def containing(self, position):
+        '''Returns list of values of intervals that contain position'''
+        return self.overlapping(position, position)
+
+
+    def contains(self, position):
+        '''Returns True iff at least one interval contains position'''
+        i = bisect.bisect_right(self.starts, position) - 1
+        while i >= 0 and self.max_ends[i] >= position:
+            if self.ends[i] >= position:
+                return True
+            i -= 1
+        return False
+
+
+    def bases_with_depth_at_least(self, min_depth):
+        '''Returns the number of positions that are in at least min_depth intervals'''
+        events = [(x, 1) for x in self.starts] + [(x + 1, -1) for x in self.ends]
+        events.sort()
+        depth = 0
+        total = 0
+        previous = None
+        for position, change in events:
+            if depth >= min_depth:
+                total += position - previous
+            depth += change
+            previous = position
+        return total
@@ -1,12 +1,19 @@
 import os
 import sys
+import hashlib
+import subprocess
+import tempfile
+import threading
 from distutils.version import LooseVersion
 import pysam
 import pyfastaq
+import minimap_ariba
 from ariba import common
 
 class Error (Exception): pass
 
+read_mappers = ['bowtie2', 'minimap']
+
 bowtie2_index_extensions = [x + '.bt2' for x in ['1', '2', '3', '4', 'rev.1', 'rev.2']]
 
 def bowtie2_index(ref_fa, outprefix, bowtie2='bowtie2', verbose=False, verbose_filehandle=sys.stdout):
@@ -30,6 +37,60 @@ def bowtie2_index(ref_fa, outprefix, bowtie2='bowtie2', verbose=False, verbose_f
     common.syscall(cmd, verbose=verbose, verbose_filehandle=verbose_filehandle)
 
 
+def bowtie2_index_cache_prefix(ref_fa, cache_dir):
+    '''Returns the prefix of the bowtie2 index of ref_fa in cache_dir.
+       The prefix depends on the contents of ref_fa, so that an index is
+       only reused if the sequences have not changed since it was made'''
+    md5 = hashlib.md5()
+    with open(ref_fa, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            md5.update(chunk)
+    return os.path.join(cache_dir, 'bowtie2_index.' + md5.hexdigest())
+
+
+def _sam_coordinate_sort_key(sam):
+    '''Sort key for pysam alignments, giving the same order as samtools sort.
+       Unmapped reads with no reference go last. Ties keep the input order
+       because list.sort is stable'''
+    if sam.reference_id < 0:
+        return (float('inf'), 0, False)
+    return (sam.reference_id, sam.reference_start, sam.is_reverse)
+
+
+def _sam_to_bam(infile, final_bam, sort=False, remove_both_unmapped=False, verbose=False, verbose_filehandle=sys.stdout):
+    '''Writes all the reads from infile (an open pysam.AlignmentFile) to final_bam, and closes infile.
+       If sort is True, the reads are sorted in memory (the per-cluster BAMs are small)
+       and final_bam is indexed'''
+    header = infile.header.to_dict()
+    if sort:
+        header.setdefault('HD', {'VN': '1.0'})['SO'] = 'coordinate'
+        records = []
+    outfile = pysam.AlignmentFile(final_bam, 'wb', header=header)
+
+    for sam in infile:
+        if remove_both_unmapped and sam.is_unmapped and sam.mate_is_unmapped:
+            continue
+        if sort:
+            records.append(sam)
+        else:
+            outfile.write(sam)
+
+    infile.close()
+
+    if sort:
+        if verbose:
+            print('Sorting', len(records), 'reads in memory and writing', final_bam, file=verbose_filehandle)
+        records.sort(key=_sam_coordinate_sort_key)
+        for sam in records:
+            outfile.write(sam)
+        outfile.close()
+        if verbose:
+            print('Indexing', final_bam, file=verbose_filehandle)
+        pysam.index(final_bam)
+    else:
+        outfile.close()
+
+
 def run_bowtie2(
       reads_fwd,
       reads_rev,
@@ -45,7 +106,13 @@ def run_bowtie2(
       verbose_filehandle=sys.stdout,
       remove_both_unmapped=False,
       clean_index=True,
+      index_cache_dir=None,
     ):
+    '''Maps reads to ref_fa with bowtie2. If ref_fa is not already indexed, then
+       an index is made. If index_cache_dir is given, the index is put in that
+       directory (see bowtie2_index_cache_prefix) and not deleted, so later calls
+       on the same sequences reuse it. The caller is then responsible for deleting
+       index_cache_dir. Otherwise the index is deleted if clean_index is True'''
 
     ref_is_indexed = True
     for ext in bowtie2_index_extensions:
@@ -59,6 +126,15 @@ def run_bowtie2(
         if verbose:
             print('Bowtie2 index files found (', ref_fa, '.*.bt2) so no need to index', sep='', file=verbose_filehandle)
         map_index = ref_fa
+    elif index_cache_dir is not None:
+        if not os.path.exists(index_cache_dir):
+            os.mkdir(index_cache_dir)
+        map_index = bowtie2_index_cache_prefix(ref_fa, index_cache_dir)
+        if all([os.path.exists(map_index + '.' + ext) for ext in bowtie2_index_extensions]):
+            if verbose:
+                print('Using cached bowtie2 index', map_index, file=verbose_filehandle)
+        else:
+            bowtie2_index(ref_fa, map_index, bowtie2=bowtie2, verbose=verbose, verbose_filehandle=verbose_filehandle)
     else:
         map_index = out_prefix + '.map_index'
         bowtie2_index(ref_fa, map_index, bowtie2=bowtie2, verbose=verbose, verbose_filehandle=verbose_filehandle)
@@ -67,10 +143,6 @@ def run_bowtie2(
             clean_files = [map_index + '.' + x + '.bt2' for x in ['1', '2', '3', '4', 'rev.1', 'rev.2']]
 
     final_bam = out_prefix + '.bam'
-    if sort:
-        intermediate_bam = out_prefix + '.unsorted.bam'
-    else:
-        intermediate_bam = final_bam
 
     map_cmd = [
         bowtie2,
@@ -84,40 +156,141 @@ def run_bowtie2(
     ]
 
     if LooseVersion(bowtie2_version) >= LooseVersion('2.3.1'):
-        map_cmd.append('--score-min G,1,10')
-
-    if remove_both_unmapped:
-        map_cmd.append(r''' | awk ' !(and($2,4)) || !(and($2,8)) ' ''')
-
-    tmp_sam_file = out_prefix + '.unsorted.sam'
-    map_cmd.append(' > ' + tmp_sam_file)
-    map_cmd = ' '.join(map_cmd)
-
-    common.syscall(map_cmd, verbose=verbose, verbose_filehandle=verbose_filehandle)
+        map_cmd.extend(['--score-min', 'G,1,10'])
 
     if verbose:
-        print('Converting', tmp_sam_file, '->', intermediate_bam, file=verbose_filehandle)
-    infile = pysam.AlignmentFile(tmp_sam_file, "r")
-    outfile = pysam.AlignmentFile(intermediate_bam, "wb", template=infile)
-    for x in infile:
-        outfile.write(x)
-    infile.close()
-    outfile.close()
-    os.unlink(tmp_sam_file)
+        print('syscall:', ' '.join(map_cmd), flush=True, file=verbose_filehandle)
 
-    if sort:
-        if verbose:
-            print('Sorting', intermediate_bam, '->', final_bam, file=verbose_filehandle)
-        pysam.sort('-o', final_bam, '-O', 'BAM', intermediate_bam)
-        if verbose:
-            print('Indexing', final_bam, file=verbose_filehandle)
-        pysam.index(final_bam)
-        clean_files.append(intermediate_bam)
+    # bowtie2 stdout is read directly here, so no intermediate SAM file is
+    # made. stderr goes to a temporary file so that bowtie2 cannot block on it
+    with tempfile.TemporaryFile() as stderr_fh:
+        bowtie2_process = subprocess.Popen(map_cmd, stdout=subprocess.PIPE, stderr=stderr_fh)
+        sam_error = None
+
+        # If bowtie2 fails, pysam usually raises an error because the SAM
+        # header is missing or truncated. Still wait for bowtie2 and report
+        # its stderr, which says what actually went wrong
+        try:
+            infile = pysam.AlignmentFile(bowtie2_process.stdout, 'r')
+            _sam_to_bam(infile, final_bam, sort=sort, remove_both_unmapped=remove_both_unmapped, verbose=verbose, verbose_filehandle=verbose_filehandle)
+        except Exception as error:
+            sam_error = error
+        finally:
+            bowtie2_process.stdout.close()
+            return_code = bowtie2_process.wait()
+
+        if return_code != 0 or sam_error is not None:
+            stderr_fh.seek(0)
+            if sam_error is not None:
+                print('Error reading SAM output of bowtie2:', sam_error, file=sys.stderr)
+            print('The following command failed with exit code', return_code, file=sys.stderr)
+            print(' '.join(map_cmd), file=sys.stderr)
+            print('\nThe output was:\n', file=sys.stderr)
+            print(stderr_fh.read().decode(), file=sys.stderr, flush=True)
+            sys.exit(1)
 
     for fname in clean_files:
         os.unlink(fname)
 
 
+def _write_bytes_to_fd(data, fd):
+    '''Writes data to file descriptor fd, then closes it. Stops early
+       without error if the other end of the pipe is closed'''
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+    except BrokenPipeError:
+        pass
+
+
+def run_minimap(
+      reads_fwd,
+      reads_rev,
+      ref_fa,
+      out_prefix,
+      threads=1,
+      max_insert=1000,
+      sort=False,
+      verbose=False,
+      verbose_filehandle=sys.stdout,
+      remove_both_unmapped=False,
+    ):
+    '''Maps reads to ref_fa in this process, using minimap to find seeds then
+       banded local alignment (see minimap_ariba.map_reads). Writes out_prefix.bam,
+       in the same way as run_bowtie2. Meant for mapping the reads of one
+       cluster to its assembly, without the cost of running bowtie2-build and bowtie2'''
+    final_bam = out_prefix + '.bam'
+    if verbose:
+        print('Mapping reads with minimap_ariba', reads_fwd, reads_rev, '->', ref_fa, file=verbose_filehandle, flush=True)
+    got, sam_bytes = minimap_ariba.map_reads(ref_fa, reads_fwd, reads_rev, max_insert, threads)
+    if got != 0:
+        raise Error('Error mapping reads ' + reads_fwd + ' ' + reads_rev + ' to ' + ref_fa + '. Cannot continue')
+
+    # pysam can only read SAM from a file, so give it the SAM through a pipe
+    # instead of writing a temporary file. It is written to the pipe by
+    # another thread, because a full pipe blocks until it is read
+    read_fd, write_fd = os.pipe()
+    writer = threading.Thread(target=_write_bytes_to_fd, args=(sam_bytes, write_fd))
+    writer.start()
+    infile = None
+    try:
+        with os.fdopen(read_fd, 'rb') as f:
+            infile = pysam.AlignmentFile(f, 'r')
+            _sam_to_bam(infile, final_bam, sort=sort, remove_both_unmapped=remove_both_unmapped, verbose=verbose, verbose_filehandle=verbose_filehandle)
+    except:
+        # pysam has its own copy of the pipe file descriptor. Close it
+        # so that the writer thread stops instead of waiting forever
+        if infile is not None:
+            infile.close()
+        raise
+    finally:
+        writer.join()
+
+
+def run_read_mapper(read_mapper, reads_fwd, reads_rev, ref_fa, out_prefix, **kwargs):
+    '''Runs run_bowtie2 or run_minimap, depending on read_mapper, which must be one of read_mappers.
+       Options that only apply to bowtie2 are ignored by minimap'''
+    if read_mapper == 'bowtie2':
+        run_bowtie2(reads_fwd, reads_rev, ref_fa, out_prefix, **kwargs)
+    elif read_mapper == 'minimap':
+        minimap_options = {k: kwargs[k] for k in ['threads', 'max_insert', 'sort', 'verbose', 'verbose_filehandle', 'remove_both_unmapped'] if k in kwargs}
+        run_minimap(reads_fwd, reads_rev, ref_fa, out_prefix, **minimap_options)
+    else:
+        raise Error('Read mapper "' + str(read_mapper) + '" not recognised. Must be one of: ' + ','.join(read_mappers) + '. Cannot continue')
+
+
+def read_mapper_concordance(bam1, bam2):
+    '''Compares the mapping of the same reads in two BAM files, eg made by
+       run_bowtie2 and run_minimap. Returns a dictionary of counts:
+       reads (total in bam1), mapped1, mapped2, both_mapped, same_position
+       (same reference, start and strand) and same_proper_pair (proper pair flag agrees)'''
+    def load(bam):
+        reads = {}
+        for sam in pysam.AlignmentFile(bam):
+            if sam.is_secondary or sam.is_supplementary:
+                continue
+            key = (sam.query_name, sam.is_read1)
+            if sam.is_unmapped:
+                reads[key] = None
+            else:
+                reads[key] = (sam.reference_name, sam.reference_start, sam.is_reverse, sam.is_proper_pair)
+        return reads
+
+    reads1 = load(bam1)
+    reads2 = load(bam2)
+    counts = {x: 0 for x in ['reads', 'mapped1', 'mapped2', 'both_mapped', 'same_position', 'same_proper_pair']}
+    for key, aln1 in reads1.items():
+        aln2 = reads2.get(key)
+        counts['reads'] += 1
+        counts['mapped1'] += aln1 is not None
+        counts['mapped2'] += aln2 is not None
+        if aln1 is not None and aln2 is not None:
+            counts['both_mapped'] += 1
+            counts['same_position'] += aln1[:3] == aln2[:3]
+            counts['same_proper_pair'] += aln1[3] == aln2[3]
+    return counts
+
+
 def get_total_alignment_score(bam):
     '''Returns total of AS: tags in the input BAM'''
     sam_reader = pysam.Samfile(bam, "rb")
@@ -1,23 +1,62 @@
 import pyfastaq
 import os
+import bisect
+import zlib
 import pysam
 from ariba import common
 
 class Error (Exception): pass
 
+block_store_suffixes = ['.blocks', '.blocks.index', '.pairs', '.pairs.index']
+
 class ReadStore:
-    def __init__(self, infile, outprefix, log_fh=None):
+    '''infile is either a text file of reads (cluster, read number, seq, quals),
+       which gets sorted and tabix indexed, or if blocks=True then the prefix of
+       the block read store files made by minimap_ariba. Block read stores
+       do not need sorting. They have each read pair stored once, in
+       infile.blocks, and the list of pairs for each cluster in infile.pairs.'''
+    def __init__(self, infile, outprefix, log_fh=None, blocks=False):
         assert infile != outprefix
         self.infile = os.path.abspath(infile)
         self.outprefix = os.path.abspath(outprefix)
-        self.outfile = os.path.abspath(outprefix) + '.gz'
+        self.blocks = blocks
+
+        if self.blocks:
+            self.outfile = self.outprefix + '.blocks'
+            self.pairs_file = self.outprefix + '.pairs'
+            infiles = [self.infile + x for x in block_store_suffixes]
+            self.outfiles = [self.outprefix + x for x in block_store_suffixes]
+        else:
+            self.outfile = self.outprefix + '.gz'
+            infiles = [self.infile]
+            self.outfiles = [self.outfile, self.outfile + '.tbi']
+
+        for filename in infiles:
+            if not os.path.exists(filename):
+                raise Error('File not found ' + filename + '. Cannot continue')
+
+        if self.blocks:
+            self._move_block_store_files(self.infile, self.outprefix, log_fh)
+            self.reads_index = self._load_blocks_index(self.outfile + '.index')
+            self.pairs_index = self._load_blocks_index(self.pairs_file + '.index')
+        else:
+            self._sort_file(self.infile, self.outprefix, log_fh)
+            self._compress_and_index_file(self.outprefix, log_fh)
+            os.unlink(self.outprefix)
 
-        if not os.path.exists(self.infile):
-            raise Error('File not found ' + self.infile + '. Cannot continue')
 
-        self._sort_file(self.infile, self.outprefix, log_fh)
-        self._compress_and_index_file(self.outprefix, log_fh)
-        os.unlink(self.outprefix)
+    @staticmethod
+    def pair_is_in_sample(pair_number, fraction, random_seed=None):
+        '''Returns True iff read pair number pair_number (counting from 1) is in a
+           random sample of the given fraction of pairs. The sample only depends on
+           random_seed, so is reproducible and the same for reads coming from the
+           store or from a fastq file'''
+        mask = 0xFFFFFFFFFFFFFFFF
+        x = (pair_number + (0 if random_seed is None else random_seed) * 0x9E3779B97F4A7C15) & mask
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & mask
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & mask
+        x ^= x >> 31
+        return x < fraction * 0x10000000000000000
 
 
     @staticmethod
@@ -35,27 +74,103 @@ class ReadStore:
         pysam.tabix_index(infile + '.gz', seq_col=0, start_col=1, end_col=1)
 
 
-    def get_reads(self, cluster_name, out1, out2=None, fasta=False, log_fh=None, wanted_ids=None):
+    @staticmethod
+    def _move_block_store_files(inprefix, outprefix, log_fh=None):
+        if log_fh is not None:
+            print('Moving block read store files', inprefix + '.*', 'to', outprefix + '.*', file=log_fh, flush=True)
+        for suffix in block_store_suffixes:
+            os.rename(inprefix + suffix, outprefix + suffix)
+
+
+    @staticmethod
+    def _load_blocks_index(infile):
+        '''Returns dict of cluster name -> list of (offset, compressed length, uncompressed length,
+           number of records, number of records in previous blocks) of each block for that cluster,
+           in the order the blocks were written'''
+        index = {}
+
+        with open(infile) as f:
+            for line in f:
+                try:
+                    cluster, offset, length, uncompressed_length, records = [int(x) if i > 0 else x for i, x in enumerate(line.rstrip().split('\t'))]
+                except:
+                    raise Error('Error reading blocks index file ' + infile + ' at this line:\n' + line)
+
+                cluster_blocks = index.setdefault(cluster, [])
+                first_record = 0 if len(cluster_blocks) == 0 else cluster_blocks[-1][4] + cluster_blocks[-1][3]
+                cluster_blocks.append((offset, length, uncompressed_length, records, first_record))
+
+        return index
+
+
+    @staticmethod
+    def _load_block(filehandle, block):
+        offset, length, uncompressed_length = block[:3]
+        filehandle.seek(offset)
+        return zlib.decompress(filehandle.read(length), bufsize=uncompressed_length).decode().splitlines()
+
+
+    def _blocks_reads(self, cluster_name):
+        '''Yields (read number, seq, qual) of the reads in the cluster. Each pair is
+           stored in the blocks of the first cluster that it hit. The pairs are
+           in the same order as the input reads, so blocks are loaded in order,
+           keeping the current block of each storing cluster'''
+        current_blocks = {} # storing cluster -> (number of first pair in block, list of pairs)
+        number = 1
+
+        with open(self.outfile, 'rb') as f_reads, open(self.pairs_file, 'rb') as f_pairs:
+            for pairs_block in self.pairs_index.get(cluster_name, []):
+                for pair in self._load_block(f_pairs, pairs_block):
+                    storing_cluster, pair_number = pair.split('\t')
+                    pair_number = int(pair_number)
+                    first_pair, block_pairs = current_blocks.get(storing_cluster, (0, []))
+
+                    if not first_pair <= pair_number < first_pair + len(block_pairs):
+                        storing_blocks = self.reads_index[storing_cluster]
+                        reads_block = storing_blocks[bisect.bisect_right([x[4] for x in storing_blocks], pair_number) - 1]
+                        first_pair, block_pairs = reads_block[4], self._load_block(f_reads, reads_block)
+                        current_blocks[storing_cluster] = (first_pair, block_pairs)
+
+                    seq1, qual1, seq2, qual2 = block_pairs[pair_number - first_pair].split('\t')
+                    yield number, seq1, qual1
+                    yield number + 1, seq2, qual2
+                    number += 2
+
+
+    def _tabix_reads(self, cluster_name):
+        tabix_file = pysam.TabixFile(self.outfile)
+        for line in tabix_file.fetch(reference=cluster_name):
+            yield line.rstrip().split()[1:]
+        tabix_file.close()
+
+
+    def get_reads(self, cluster_name, out1, out2=None, fasta=False, log_fh=None, wanted_ids=None, sample_fraction=None, random_seed=None):
+        '''Writes reads from the cluster to out1 and out2 (interleaved in out1 if out2 is None).
+           If sample_fraction is given, only writes the read pairs chosen
+           by pair_is_in_sample(). Returns number of reads and bases written'''
         total_reads = 0
         total_bases = 0
 
         if log_fh is not None:
             print('Getting reads for', cluster_name, 'from', self.outfile, file=log_fh)
-        tabix_file = pysam.TabixFile(self.outfile)
         f_out1 = pyfastaq.utils.open_file_write(out1)
         if out2 is None:
             f_out2 = f_out1
         else:
             f_out2 = pyfastaq.utils.open_file_write(out2)
 
-        for line in tabix_file.fetch(reference=cluster_name):
-            cluster, number, seq, qual = line.rstrip().split()
+        reads = self._blocks_reads(cluster_name) if self.blocks else self._tabix_reads(cluster_name)
+
+        for number, seq, qual in reads:
             number = int(number)
             if wanted_ids is not None:
                 new_number = number if number % 2 else number - 1
                 if new_number not in wanted_ids:
                     continue
 
+            if sample_fraction is not None and not self.pair_is_in_sample((number + 1) // 2, sample_fraction, random_seed=random_seed):
+                continue
+
             if number % 2 == 0:
                 if fasta:
                     print('>' + str(number - 1) + '/2', seq, sep='\n', file=f_out2)
@@ -79,5 +194,5 @@ class ReadStore:
         return total_reads, total_bases
 
     def clean(self):
-        os.unlink(self.outfile)
-        os.unlink(self.outfile + '.tbi')
+        for filename in self.outfiles:
+            os.unlink(filename)
@@ -2,6 +2,8 @@ import sys
 import os
 import pickle
 import pyfastaq
+import pysam
+import minimap_ariba
 from ariba import common, reference_data
 
 class Error (Exception): pass
@@ -209,6 +211,17 @@ class RefPreparer:
         with open(clusters_pickle_file, 'wb') as f:
             pickle.dump(clusters, f)
 
+        minimap_index_file = cdhit_outprefix + '.all.mmi'
+        if self.verbose:
+            print('\nMaking minimap index', minimap_index_file, flush=True)
+
+        got = minimap_ariba.build_index(cdhit_outprefix + '.all.fa', minimap_index_file, self.threads)
+        if got != 0:
+            raise Error('Error making minimap index ' + minimap_index_file + '. Cannot continue')
+
+        # faidx index, so that sequences can be quickly extracted when choosing the closest reference
+        pysam.faidx(cdhit_outprefix + '.all.fa')
+
         if number_of_removed_seqs > 0:
             print('WARNING.', number_of_removed_seqs, 'sequence(s) excluded. Please see the log file 01.filter.check_genes.log for details. This will show them:', file=sys.stderr)
             print('    grep REMOVE', os.path.join(outdir, '01.filter.check_genes.log'), file=sys.stderr)
@@ -3,7 +3,9 @@ import copy
 import os
 import pymummer
 import pyfastaq
-from ariba import common
+import pysam
+import minimap_ariba
+from ariba import aligner as ariba_aligner, common
 
 class Error (Exception): pass
 
@@ -18,6 +20,11 @@ class RefSeqChooser:
         nucmer_min_id=90,
         nucmer_min_len=20,
         nucmer_breaklen=200,
+        aligner='nucmer',
+        ref_scores=None,
+        max_cluster_refs=0,
+        close_score_fraction=0.9,
+        all_refs_index=None,
     ):
         self.cluster_fasta = os.path.abspath(cluster_fasta)
         self.all_refs_fasta = os.path.abspath(all_refs_fasta)
@@ -27,6 +34,21 @@ class RefSeqChooser:
         self.nucmer_min_id = nucmer_min_id
         self.nucmer_min_len = nucmer_min_len
         self.nucmer_breaklen = nucmer_breaklen
+        self.aligner = aligner
+
+        # If ref_scores (dict of ref name -> minimap score) is given and
+        # max_cluster_refs > 0, then only align to the max_cluster_refs highest
+        # scoring refs in the cluster, plus refs outside the cluster that
+        # scored at least close_score_fraction times the lowest of those scores
+        self.ref_scores = ref_scores
+        self.max_cluster_refs = max_cluster_refs
+        self.close_score_fraction = close_score_fraction
+
+        # If all_refs_index (minimap index of all_refs_fasta) is given, then
+        # the check for a better match outside the cluster only runs nucmer
+        # against the refs that minimap finds, instead of all refs. If minimap
+        # finds no refs outside the cluster, all refs are used
+        self.all_refs_index = None if all_refs_index is None else os.path.abspath(all_refs_index)
         self.closest_ref_within_cluster = None
         self.closest_ref_from_all_refs = None
         self.closest_ref_is_in_cluster = False
@@ -134,10 +156,10 @@ class RefSeqChooser:
 
 
     @classmethod
-    def _closest_nucmer_match_between_fastas(cls, ref_fasta, qry_fasta, log_fh, min_id, min_length, breaklen, use_qry_length, check_flanking):
+    def _closest_nucmer_match_between_fastas(cls, ref_fasta, qry_fasta, log_fh, min_id, min_length, breaklen, use_qry_length, check_flanking, aligner='nucmer'):
         tmpdir = tempfile.mkdtemp(prefix='tmp.closest_nucmer_match.', dir=os.getcwd())
         coords_file = os.path.join(tmpdir, 'nucmer_vs_cluster_refs.coords')
-        pymummer.nucmer.Runner(
+        ariba_aligner.Runner(
             ref_fasta,
             qry_fasta,
             coords_file,
@@ -145,6 +167,7 @@ class RefSeqChooser:
             min_length=min_length,
             breaklen=breaklen,
             maxmatch=True,
+            aligner=aligner,
         ).run()
         nucmer_matches = RefSeqChooser._load_nucmer_coords_file(coords_file, log_fh=log_fh)
         common.rmtree(tmpdir)
@@ -156,9 +179,110 @@ class RefSeqChooser:
             return best_hit, nucmer_matches
 
 
+    @classmethod
+    def _candidate_ref_names(cls, cluster_names, ref_scores, max_cluster_refs, close_score_fraction):
+        '''Returns tuple (set of names of the max_cluster_refs highest scoring refs in the cluster,
+           set of names of refs outside the cluster that scored at least close_score_fraction
+           times the lowest of those scores). Returns (None, None) if no ref in the cluster has a score'''
+        scored = sorted([(-ref_scores[x], x) for x in cluster_names if ref_scores.get(x, 0) > 0])
+        if len(scored) == 0:
+            return None, None
+
+        top_scored = scored[:max_cluster_refs]
+        min_score = -top_scored[-1][0] * close_score_fraction
+        cluster_refs = {x[1] for x in top_scored}
+        other_refs = {x for x in ref_scores if x not in cluster_names and ref_scores[x] >= min_score}
+        return cluster_refs, other_refs
+
+
+    def _write_candidate_fastas(self, outdir):
+        '''Writes fasta files of candidate refs from the cluster, and all candidate refs.
+           Returns names of the two files, or (None, None) if there are no candidates'''
+        cluster_names = {x.id for x in pyfastaq.sequences.file_reader(self.cluster_fasta)}
+        cluster_refs, other_refs = RefSeqChooser._candidate_ref_names(cluster_names, self.ref_scores, self.max_cluster_refs, self.close_score_fraction)
+        if cluster_refs is None:
+            print('No minimap scores for refs in cluster, so using all refs', file=self.log_fh)
+            return None, None
+
+        print('Using', len(cluster_refs), 'of', len(cluster_names), 'refs in cluster, and', len(other_refs), 'refs outside cluster, that have the highest minimap scores', file=self.log_fh)
+        cluster_candidates_fasta = os.path.join(outdir, 'candidates.cluster.fa')
+        all_candidates_fasta = os.path.join(outdir, 'candidates.all.fa')
+        f_cluster = pyfastaq.utils.open_file_write(cluster_candidates_fasta)
+        f_all = pyfastaq.utils.open_file_write(all_candidates_fasta)
+
+        for seq in pyfastaq.sequences.file_reader(self.cluster_fasta):
+            if seq.id in cluster_refs:
+                print(seq, file=f_cluster)
+                print(seq, file=f_all)
+
+        if len(other_refs):
+            for seq in pyfastaq.sequences.file_reader(self.all_refs_fasta):
+                if seq.id in other_refs:
+                    print(seq, file=f_all)
+
+        pyfastaq.utils.close(f_cluster)
+        pyfastaq.utils.close(f_all)
+        return cluster_candidates_fasta, all_candidates_fasta
+
+
+    @classmethod
+    def _write_seqs_from_fasta(cls, fasta_in, seq_names, fasta_out):
+        '''Writes the sequences in the set seq_names from fasta_in to fasta_out.
+           Uses the faidx index of fasta_in if there is one'''
+        f_out = pyfastaq.utils.open_file_write(fasta_out)
+
+        if os.path.exists(fasta_in + '.fai'):
+            fasta_file = pysam.FastaFile(fasta_in)
+            for name in sorted(seq_names):
+                print(pyfastaq.sequences.Fasta(name, fasta_file.fetch(name)), file=f_out)
+            fasta_file.close()
+        else:
+            for seq in pyfastaq.sequences.file_reader(fasta_in):
+                if seq.id in seq_names:
+                    print(seq, file=f_out)
+
+        pyfastaq.utils.close(f_out)
+
+
+    def _write_refs_matching_fasta(self, qry_fasta, outfile):
+        '''Writes fasta file of the refs that match the sequences in qry_fasta using
+           the minimap index of all refs. Always includes the closest ref within the cluster.
+           Returns True if the file was written. If minimap finds no refs outside the
+           cluster, the file is not written and returns False. minimap can miss matches
+           that nucmer finds, so then the caller should use all the refs instead'''
+        got, ref_scores = minimap_ariba.map_sequences(self.all_refs_index, qry_fasta)
+        if got != 0:
+            raise Error('Error mapping to minimap index ' + self.all_refs_index + '. Cannot continue')
+
+        cluster_names = {x.id for x in pyfastaq.sequences.file_reader(self.cluster_fasta)}
+        if len(set(ref_scores).difference(cluster_names)) == 0:
+            print('No ref sequences outside the cluster found matching assembly using minimap index', self.all_refs_index, 'so using all refs', file=self.log_fh)
+            return False
+
+        ref_names = set(ref_scores)
+        ref_names.add(self.closest_ref_within_cluster)
+        print('Found', len(ref_names), 'ref sequences matching assembly using minimap index', self.all_refs_index, file=self.log_fh)
+        RefSeqChooser._write_seqs_from_fasta(self.all_refs_fasta, ref_names, outfile)
+        return True
+
+
     def run(self):
+        if self.ref_scores is None or self.max_cluster_refs <= 0:
+            self._run(self.cluster_fasta, self.all_refs_fasta, self.all_refs_index is not None)
+            return
+
+        tmpdir = tempfile.mkdtemp(prefix='tmp.choose_ref_candidates.', dir=os.getcwd())
+        cluster_fasta, all_refs_fasta = self._write_candidate_fastas(tmpdir)
+        if cluster_fasta is None:
+            self._run(self.cluster_fasta, self.all_refs_fasta, self.all_refs_index is not None)
+        else:
+            self._run(cluster_fasta, all_refs_fasta, False)
+        common.rmtree(tmpdir)
+
+
+    def _run(self, cluster_fasta, all_refs_fasta, use_all_refs_index):
         print('Looking for closest match from sequences within cluster', file=self.log_fh)
-        best_hit_from_cluster, nucmer_matches = RefSeqChooser._closest_nucmer_match_between_fastas(self.cluster_fasta, self.assembly_fasta_in, self.log_fh, self.nucmer_min_id, self.nucmer_min_len, self.nucmer_breaklen, False, True)
+        best_hit_from_cluster, nucmer_matches = RefSeqChooser._closest_nucmer_match_between_fastas(cluster_fasta, self.assembly_fasta_in, self.log_fh, self.nucmer_min_id, self.nucmer_min_len, self.nucmer_breaklen, False, True, aligner=self.aligner)
         if best_hit_from_cluster is None:
             return
 
@@ -171,7 +295,12 @@ class RefSeqChooser:
         RefSeqChooser._make_matching_contig_pieces_fasta(self.assembly_fasta_in, pieces_coords, pieces_fasta_file)
 
         print('Checking for a better match to a ref sequence outside the cluster', file=self.log_fh)
-        best_hit_from_all_seqs, not_needed = RefSeqChooser._closest_nucmer_match_between_fastas(self.all_refs_fasta, pieces_fasta_file, self.log_fh, self.nucmer_min_id, self.nucmer_min_len, self.nucmer_breaklen, True, False)
+        if use_all_refs_index:
+            refs_matching_fasta = os.path.join(tmpdir, 'refs_matching_pieces.fa')
+            if self._write_refs_matching_fasta(pieces_fasta_file, refs_matching_fasta):
+                all_refs_fasta = refs_matching_fasta
+
+        best_hit_from_all_seqs, not_needed = RefSeqChooser._closest_nucmer_match_between_fastas(all_refs_fasta, pieces_fasta_file, self.log_fh, self.nucmer_min_id, self.nucmer_min_len, self.nucmer_breaklen, True, False, aligner=self.aligner)
         common.rmtree(tmpdir)
         self.closest_ref_from_all_refs = best_hit_from_all_seqs.ref_name
         if self.closest_ref_from_all_refs is None:
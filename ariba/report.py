@@ -102,7 +102,7 @@ def _samtools_depths_at_known_snps_all_wild(sequence_meta, contig_name, cluster,
     contig_positions = []
 
     for ref_position in range(ref_nuc_range[0], ref_nuc_range[1]+1, 1):
-        nucmer_match = cluster.assembly_compare.nucmer_hit_containing_reference_position(cluster.assembly_compare.nucmer_hits, cluster.ref_sequence.id, ref_position, qry_name=contig_name)
+        nucmer_match = cluster.assembly_compare.nucmer_hit_containing_reference_position(cluster.assembly_compare.nucmer_hits, cluster.ref_sequence.id, ref_position, qry_name=contig_name, ref_index=cluster.assembly_compare.nucmer_hits_ref_idx)
 
         if nucmer_match is not None:
             # work out contig position. Needs indels variants to correct the position
@@ -205,13 +205,9 @@ def _report_lines_for_one_contig(cluster, contig_name, ref_cov_per_contig, pymum
                 else:
                     ref_start_pos = 3 * position if cluster.is_gene == '1' else position
                     assert contig_name in cluster.assembly_compare.nucmer_hits
-                    ref_start_hit = None
-                    for hit in cluster.assembly_compare.nucmer_hits[contig_name]:
-                        if hit.ref_name == cluster.ref_sequence.id and hit.ref_coords().distance_to_point(ref_start_pos) == 0:
-                            ref_start_hit = copy.copy(hit)
-                            break
-
+                    ref_start_hit = cluster.assembly_compare.nucmer_hit_containing_reference_position(cluster.assembly_compare.nucmer_hits, cluster.ref_sequence.id, ref_start_pos, qry_name=contig_name, ref_index=cluster.assembly_compare.nucmer_hits_ref_idx)
                     assert ref_start_hit is not None
+                    ref_start_hit = copy.copy(ref_start_hit)
                     ctg_start_pos, ctg_start_in_indel = ref_start_hit.qry_coords_from_ref_coord(ref_start_pos, pymummer_variants)
 
                     if known_var_change not in  ['.', 'unknown']:
@@ -318,11 +314,10 @@ def _report_lines_for_one_contig(cluster, contig_name, ref_cov_per_contig, pymum
 
             if depths_tuple is not None:
                 ref_coord, in_indel = None, None
-                if contig_name in cluster.assembly_compare.nucmer_hits:
-                    for hit in cluster.assembly_compare.nucmer_hits[contig_name]:
-                        if hit.qry_coords().distance_to_point(var_position) == 0:
-                            ref_coord, in_indel = hit.ref_coords_from_qry_coord(var_position, pymummer_variants)
-                            break
+                if contig_name in cluster.assembly_compare.nucmer_hits_qry_idx:
+                    hits = cluster.assembly_compare.nucmer_hits_qry_idx[contig_name].containing(var_position)
+                    if len(hits):
+                        ref_coord, in_indel = hits[0].ref_coords_from_qry_coord(var_position, pymummer_variants)
 
                 if ref_coord is None:
                     ref_coord = '.'
@@ -1,11 +1,91 @@
 import os
 import sys
+from array import array
 import pysam
 import pyfastaq
 import vcfcall_ariba
+from ariba import interval_index
 
 class Error (Exception): pass
 
+pileup_engines = ['mpileup', 'pysam']
+
+
+class DepthIndex:
+    '''Read depths at every position of each contig, from a read depths file made by
+       vcfcall_ariba or the pysam pileup. Loaded once, so that depths can be looked up
+       without opening the tabix file for each position. Total, reference and alternative
+       depths are kept in one array per contig. Positions where the alleles are more
+       than one reference base (ie alternative alleles or indels) also have their alleles
+       and depths strings in a dictionary'''
+    def __init__(self):
+        self.total_depths = {}
+        self.ref_depths = {}
+        self.alt_depths = {}
+        self.ref_bases = {}
+        self.alleles = {}
+
+
+    @classmethod
+    def from_file(cls, filename):
+        '''Returns a DepthIndex of the read depths file filename (can be gzipped). Lines
+           for the same position are resolved in the same way as SamtoolsVariants._get_read_depths'''
+        depth_index = cls()
+        rows = {}
+        f = pyfastaq.utils.open_file_read(filename)
+        for line in f:
+            fields = line.rstrip().split()
+            rows.setdefault(fields[0], {}).setdefault(int(fields[1]) - 1, []).append(fields)
+        pyfastaq.utils.close(f)
+
+        for contig, position_rows in rows.items():
+            length = max(position_rows) + 1
+            total_depths = array('L', [0]) * length
+            ref_depths = array('L', [0]) * length
+            alt_depths = array('L', [0]) * length
+            ref_bases = bytearray(length)
+            alleles = {}
+
+            for position, fields_list in position_rows.items():
+                if len(fields_list) > 1: # which happens with indels, mutiple lines for same base of reference
+                    test_rows = [x for x in fields_list if x[3] != '.']
+                    fields_list = test_rows if len(test_rows) == 1 else [fields_list[-1]]
+
+                r, p, ref_base, alt_base, total_depth, allele_depths = fields_list[0]
+                allele_depths_list = [int(x) for x in allele_depths.split(',')]
+                total_depths[position] = int(total_depth)
+                ref_depths[position] = allele_depths_list[0]
+                alt_depths[position] = sum(allele_depths_list[1:])
+                if alt_base == '.' and len(ref_base) == 1 and allele_depths == str(allele_depths_list[0]):
+                    ref_bases[position] = ord(ref_base)
+                else:
+                    # ref_bases stays zero at this position, so look in alleles
+                    alleles[position] = (ref_base if alt_base == '.' else ref_base + ',' + alt_base, allele_depths)
+
+            depth_index.total_depths[contig] = total_depths
+            depth_index.ref_depths[contig] = ref_depths
+            depth_index.alt_depths[contig] = alt_depths
+            depth_index.ref_bases[contig] = ref_bases
+            depth_index.alleles[contig] = alleles
+
+        return depth_index
+
+
+    def depths(self, contig, position):
+        '''Returns same as SamtoolsVariants._get_read_depths: tuple of alleles, total depth
+           and allele depths string. Returns None if there are no depths at the position'''
+        if contig not in self.total_depths or not 0 <= position < len(self.total_depths[contig]):
+            return None
+
+        ref_base = self.ref_bases[contig][position]
+        if ref_base != 0:
+            return chr(ref_base), self.total_depths[contig][position], str(self.ref_depths[contig][position])
+        elif position in self.alleles[contig]:
+            bases, allele_depths = self.alleles[contig][position]
+            return bases, self.total_depths[contig][position], allele_depths
+        else:
+            return None
+
 
 class SamtoolsVariants:
     def __init__(self,
@@ -15,8 +95,13 @@ class SamtoolsVariants:
       log_fh=sys.stdout,
       min_var_read_depth=4,
       min_second_var_read_depth=2,
-      max_allele_freq=0.90
+      max_allele_freq=0.90,
+      pileup='mpileup',
+      make_read_depths_file=True,
     ):
+        if pileup not in pileup_engines:
+            raise Error('Pileup engine "' + str(pileup) + '" not recognised. Must be one of: ' + ','.join(pileup_engines) + '. Cannot continue')
+
         self.ref_fa = os.path.abspath(ref_fa)
         self.bam = os.path.abspath(bam)
         self.outprefix = os.path.abspath(outprefix)
@@ -24,13 +109,19 @@ class SamtoolsVariants:
         self.min_var_read_depth = min_var_read_depth
         self.min_second_var_read_depth = min_second_var_read_depth
         self.max_allele_freq = max_allele_freq
+        self.pileup = pileup
+        # The read depths are looked up from depth_index. The tabix-indexed
+        # read depths file is only made if make_read_depths_file is True
+        self.make_read_depths_file = make_read_depths_file
+        self.depth_index = None
 
         self.vcf_file = self.outprefix + '.vcf'
         self.read_depths_file = self.outprefix + '.read_depths.gz'
         self.contig_depths_file = self.outprefix + '.contig_depths'
 
 
-    def _make_vcf_and_read_depths_files(self):
+    def _run_mpileup_and_vcfcall(self):
+        '''Makes the vcf, read depths and contig depths files using samtools mpileup and vcfcall_ariba'''
         if not os.path.exists(self.ref_fa + '.fai'):
             pysam.faidx(self.ref_fa)
 
@@ -50,12 +141,202 @@ class SamtoolsVariants:
         if got != 0:
             raise Error('Error parsing vcf file. Cannot contine')
 
-        pysam.tabix_compress(self.outprefix + '.read_depths', self.read_depths_file)
-        pysam.tabix_index(self.read_depths_file, seq_col=0, start_col=1, end_col=1)
-        os.unlink(self.outprefix + '.read_depths')
         os.unlink(tmp_vcf)
 
 
+    @staticmethod
+    def _depths_pass(adf, adr, min_total_depth, min_second_depth, max_allele_freq):
+        '''Same test as adStringsPass in vcfcall_ariba, of whether a position is called as a variant.
+           adf and adr are lists of the depths of each allele (reference allele first) on
+           the forward and reverse strand'''
+        if len(adf) == 1:
+            return True
+
+        adf_total = sum(adf)
+        adr_total = sum(adr)
+        if adf_total < min_total_depth or adr_total < min_total_depth:
+            return False
+
+        # If more of the reads disagree with the reference than agree with it,
+        # then it's not het, but we still want it
+        if max(adf) != adf[0] and max(adr) != adr[0]:
+            return True
+
+        def depth_ok(total, depth):
+            if total == 0:
+                return False
+            freq = depth / total
+            return depth >= min_second_depth and 1 - max_allele_freq <= freq <= max_allele_freq
+
+        number_good = 0
+        for fwd, rev in zip(adf, adr):
+            if depth_ok(adf_total, fwd) and depth_ok(adr_total, rev):
+                number_good += 1
+                if number_good > 1:
+                    return True
+        return False
+
+
+    @staticmethod
+    def _read_is_counted(read):
+        '''Returns True iff read would be used by samtools mpileup -A (which skips
+           unmapped, secondary, QC fail and duplicate reads)'''
+        return not (read.is_unmapped or read.is_secondary or read.is_qcfail or read.is_duplicate)
+
+
+    @staticmethod
+    def _pileup_contig(sam_reader, contig, contig_length, min_base_qual=13):
+        '''Walks the reads mapped to one contig. Returns a tuple (forward depths, reverse depths, indels).
+           The depths are lists of four arrays: the depth of A, C, G and T at each position of the
+           contig, counting bases with quality at least min_base_qual. indels is a dictionary of
+           position of base before the indel => {indel => [forward depth, reverse depth]}, where
+           indel is ('I', inserted sequence) or ('D', deletion length)'''
+        fwd_depths = sam_reader.count_coverage(contig, 0, contig_length, quality_threshold=min_base_qual, read_callback=lambda r: SamtoolsVariants._read_is_counted(r) and not r.is_reverse)
+        rev_depths = sam_reader.count_coverage(contig, 0, contig_length, quality_threshold=min_base_qual, read_callback=lambda r: SamtoolsVariants._read_is_counted(r) and r.is_reverse)
+        indels = {}
+
+        for read in sam_reader.fetch(contig):
+            if not SamtoolsVariants._read_is_counted(read):
+                continue
+
+            strand = 1 if read.is_reverse else 0
+            ref_pos = read.reference_start
+            qry_pos = 0
+            for operation, length in read.cigartuples:
+                if operation in {0, 7, 8}: # M, =, X
+                    ref_pos += length
+                    qry_pos += length
+                elif operation == 1: # I
+                    if ref_pos > read.reference_start:
+                        indel = ('I', read.query_sequence[qry_pos:qry_pos + length].upper())
+                        indels.setdefault(ref_pos - 1, {}).setdefault(indel, [0, 0])[strand] += 1
+                    qry_pos += length
+                elif operation == 2: # D
+                    if ref_pos > read.reference_start:
+                        indels.setdefault(ref_pos - 1, {}).setdefault(('D', length), [0, 0])[strand] += 1
+                    ref_pos += length
+                elif operation == 3: # N
+                    ref_pos += length
+                elif operation == 4: # S
+                    qry_pos += length
+
+        return fwd_depths, rev_depths, indels
+
+
+    @staticmethod
+    def _indel_alleles(ref_seq, position, indels):
+        '''Returns the reference allele and list of (alt allele, indel) at position, where indels
+           is as made by _pileup_contig. As in a vcf file, the alleles start with the base at position,
+           and the reference allele is long enough to hold the longest deletion'''
+        max_deletion = max([x[1] for x in indels if x[0] == 'D'], default=0)
+        ref_allele = ref_seq[position:position + max_deletion + 1]
+        alts = []
+        for indel in indels:
+            if indel[0] == 'D':
+                alt = ref_seq[position] + ref_seq[position + indel[1] + 1:position + max_deletion + 1]
+            else:
+                alt = ref_seq[position] + indel[1] + ref_seq[position + 1:position + max_deletion + 1]
+            alts.append((alt, indel))
+        return ref_allele, alts
+
+
+    def _run_pysam_pileup(self):
+        '''Makes the vcf, read depths and contig depths files by walking the BAM once per contig
+           with pysam, keeping allele depths in arrays instead of running samtools mpileup and
+           parsing its vcf output. The same filters as vcfcall_ariba are used to call variants.
+           Depths are the number of bases with quality at least 13. There is no BAQ, and indels
+           are where the read mapper put them, so results can differ slightly from mpileup'''
+        ref_seqs = {}
+        pyfastaq.tasks.file_to_dict(self.ref_fa, ref_seqs)
+        if os.path.exists(self.bam + '.bai'):
+            tmp_index = None
+            sam_reader = pysam.AlignmentFile(self.bam, 'rb')
+        else:
+            tmp_index = self.outprefix + '.tmp.bai'
+            pysam.index(self.bam, tmp_index)
+            sam_reader = pysam.AlignmentFile(self.bam, 'rb', index_filename=tmp_index)
+        contig_depths = {}
+        bases = 'ACGT'
+
+        def info_string(adf, adr, indel=False):
+            info = 'INDEL;' if indel else ''
+            return info + 'DP=' + str(sum(adf) + sum(adr)) + ';ADF=' + ','.join([str(x) for x in adf]) \
+                + ';ADR=' + ','.join([str(x) for x in adr]) + ';AD=' + ','.join([str(f + r) for f, r in zip(adf, adr)])
+
+        f_depths = open(self.outprefix + '.read_depths', 'w')
+        f_vcf = open(self.vcf_file, 'w')
+        print('##fileformat=VCFv4.2', file=f_vcf)
+        print('##source=ariba', file=f_vcf)
+        for contig, length in zip(sam_reader.references, sam_reader.lengths):
+            print('##contig=<ID=', contig, ',length=', length, '>', sep='', file=f_vcf)
+        print('##INFO=<ID=INDEL,Number=0,Type=Flag,Description="Indicates that the variant is an INDEL.">', file=f_vcf)
+        print('##INFO=<ID=DP,Number=1,Type=Integer,Description="Total depth">', file=f_vcf)
+        print('##INFO=<ID=ADF,Number=R,Type=Integer,Description="Allelic depths on the forward strand">', file=f_vcf)
+        print('##INFO=<ID=ADR,Number=R,Type=Integer,Description="Allelic depths on the reverse strand">', file=f_vcf)
+        print('##INFO=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">', file=f_vcf)
+        print('#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', sep='\t', file=f_vcf)
+
+        for contig in sam_reader.references:
+            if contig not in ref_seqs:
+                raise Error('Sequence ' + contig + ' in BAM file ' + self.bam + ' not found in ' + self.ref_fa + '. Cannot continue')
+            ref_seq = ref_seqs[contig].seq.upper()
+            fwd_depths, rev_depths, indels = self._pileup_contig(sam_reader, contig, len(ref_seq))
+
+            for position in range(len(ref_seq)):
+                fwd = [fwd_depths[i][position] for i in range(4)]
+                rev = [rev_depths[i][position] for i in range(4)]
+                depth = sum(fwd) + sum(rev)
+                ref_base = ref_seq[position]
+
+                if depth > 0:
+                    contig_depths[contig] = contig_depths.get(contig, 0) + depth
+                    ref_index = bases.find(ref_base)
+                    alt_indexes = sorted([i for i in range(4) if i != ref_index and fwd[i] + rev[i] > 0], key=lambda i: -(fwd[i] + rev[i]))
+                    adf = [0 if ref_index == -1 else fwd[ref_index]] + [fwd[i] for i in alt_indexes]
+                    adr = [0 if ref_index == -1 else rev[ref_index]] + [rev[i] for i in alt_indexes]
+                    alt_string = ','.join([bases[i] for i in alt_indexes]) if len(alt_indexes) else '.'
+                    ad_string = ','.join([str(f + r) for f, r in zip(adf, adr)])
+                    print(contig, position + 1, ref_base, alt_string, depth, ad_string, sep='\t', file=f_depths)
+
+                    if len(alt_indexes) and self._depths_pass(adf, adr, self.min_var_read_depth, self.min_second_var_read_depth, self.max_allele_freq):
+                        print(contig, position + 1, '.', ref_base, alt_string, '.', '.', info_string(adf, adr), sep='\t', file=f_vcf)
+
+                if position in indels:
+                    ref_allele, alts = self._indel_alleles(ref_seq, position, indels[position])
+                    alts.sort(key=lambda x: -sum(indels[position][x[1]]))
+                    adf = [max(0, sum(fwd) - sum([x[0] for x in indels[position].values()]))] + [indels[position][x[1]][0] for x in alts]
+                    adr = [max(0, sum(rev) - sum([x[1] for x in indels[position].values()]))] + [indels[position][x[1]][1] for x in alts]
+                    alt_string = ','.join([x[0] for x in alts])
+                    ad_string = ','.join([str(f + r) for f, r in zip(adf, adr)])
+                    print(contig, position + 1, ref_allele, alt_string, depth, ad_string, sep='\t', file=f_depths)
+
+                    if self._depths_pass(adf, adr, self.min_var_read_depth, self.min_second_var_read_depth, self.max_allele_freq):
+                        print(contig, position + 1, '.', ref_allele, alt_string, '.', '.', info_string(adf, adr, indel=True), sep='\t', file=f_vcf)
+
+        sam_reader.close()
+        if tmp_index is not None:
+            os.unlink(tmp_index)
+        f_depths.close()
+        f_vcf.close()
+
+        with open(self.contig_depths_file, 'w') as f:
+            for contig in sorted(contig_depths):
+                print(contig, contig_depths[contig], sep='\t', file=f)
+
+
+    def _make_vcf_and_read_depths_files(self):
+        if self.pileup == 'mpileup':
+            self._run_mpileup_and_vcfcall()
+        else:
+            self._run_pysam_pileup()
+
+        self.depth_index = DepthIndex.from_file(self.outprefix + '.read_depths')
+        if self.make_read_depths_file:
+            pysam.tabix_compress(self.outprefix + '.read_depths', self.read_depths_file)
+            pysam.tabix_index(self.read_depths_file, seq_col=0, start_col=1, end_col=1)
+        os.unlink(self.outprefix + '.read_depths')
+
+
     @classmethod
     def _get_read_depths(cls, read_depths_file, sequence_name, position):
         '''Returns total read depth and depth of reads supporting alternative (if present)'''
@@ -136,6 +417,7 @@ class SamtoolsVariants:
         '''nucmer_matches = made by assembly_compare.assembly_match_coords().
            Returns number of variants that lie in nucmer_matches'''
         found_variants = {}
+        indexes = {scaff: interval_index.IntervalIndex([(x.start, x.end, None) for x in nucmer_matches[scaff]]) for scaff in nucmer_matches}
         f = pyfastaq.utils.open_file_read(vcf_file)
         for line in f:
             if line.startswith('#'):
@@ -144,11 +426,9 @@ class SamtoolsVariants:
             data = line.rstrip().split('\t')
             scaff = data[0]
 
-            if scaff in nucmer_matches:
+            if scaff in indexes:
                 position = int(data[1]) - 1
-                i = pyfastaq.intervals.Interval(position, position)
-                intersects = len([x for x in nucmer_matches[scaff] if x.intersects(i)]) > 0
-                if intersects:
+                if indexes[scaff].contains(position):
                     if scaff not in found_variants:
                         found_variants[scaff] = set()
                     found_variants[scaff].add(position)
@@ -158,11 +438,17 @@ class SamtoolsVariants:
 
 
     def get_depths_at_position(self, seq_name, position):
-        d = self._get_variants(self.vcf_file, self.read_depths_file, [(seq_name, position)])
-        if seq_name in d and position in d[seq_name]:
-            return d[seq_name][position]
-        else:
+        if self.depth_index is None:
+            if os.path.exists(self.read_depths_file):
+                self.depth_index = DepthIndex.from_file(self.read_depths_file)
+            else:
+                self.depth_index = DepthIndex()
+
+        depths = self.depth_index.depths(seq_name, position)
+        if depths is None:
             return 'ND', 'ND', 'ND'
+        else:
+            return depths
 
 
     def run(self):
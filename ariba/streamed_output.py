@@ -0,0 +1,66 @@
+import os
+import re
+import pyfastaq
+
+class Error (Exception): pass
+
+
+class StreamedOutput:
+    '''Output file that is written as chunks of text, one chunk per key (eg
+       one per cluster), which can arrive in any order. Each chunk is appended
+       to an uncompressed unsorted file as soon as it is added, so that file
+       can be looked at while the rest are still being made. finish() then
+       writes the final file, with the chunks sorted by key, by copying them
+       from the unsorted file. Only the chunk offsets are kept in memory'''
+    def __init__(self, outfile, header=None, unsorted_file=None):
+        self.outfile = os.path.abspath(outfile)
+        self.header = header
+        if unsorted_file is None:
+            self.unsorted_file = re.sub(r'\.gz$', '', self.outfile) + '.unsorted'
+        else:
+            self.unsorted_file = os.path.abspath(unsorted_file)
+        self.offsets = {} # key -> (start, length) of chunk in unsorted file, in bytes
+        self.fh = open(self.unsorted_file, 'wb')
+        if self.header is not None:
+            self.fh.write((self.header + '\n').encode())
+            self.fh.flush()
+
+
+    def add(self, key, text):
+        if self.fh is None:
+            raise Error('Cannot add "' + str(key) + '" to ' + self.outfile + ' because it is already finished')
+        if key in self.offsets:
+            raise Error('Cannot add "' + str(key) + '" to ' + self.outfile + ' more than once')
+
+        data = text.encode()
+        self.offsets[key] = (self.fh.tell(), len(data))
+        self.fh.write(data)
+        self.fh.flush()
+
+
+    def finish(self):
+        '''Writes the final sorted file and deletes the unsorted file'''
+        self.fh.close()
+        self.fh = None
+        f_out = pyfastaq.utils.open_file_write(self.outfile)
+        if self.header is not None:
+            print(self.header, file=f_out)
+
+        with open(self.unsorted_file, 'rb') as f_in:
+            for key in sorted(self.offsets):
+                start, length = self.offsets[key]
+                f_in.seek(start)
+                print(f_in.read(length).decode(), end='', file=f_out)
+
+        pyfastaq.utils.close(f_out)
+        os.unlink(self.unsorted_file)
+
+
+    def remove(self):
+        '''Deletes the unsorted file without writing the final file,
+           for when the run failed and the output would be incomplete'''
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        if os.path.exists(self.unsorted_file):
+            os.unlink(self.unsorted_file)
@@ -24,6 +24,10 @@ def run(options):
         print('Same file provided for forwards and reverse reads. Cannot continue', file=sys.stderr)
         sys.exit(1)
 
+    if 0 < options.max_reads_cov < options.assembly_cov:
+        print('--max_reads_cov must be 0 or at least --assembly_cov. Cannot continue', file=sys.stderr)
+        sys.exit(1)
+
     if not os.path.exists(options.prepareref_dir):
         print('Input directory', options.prepareref_dir, 'not found. Cannot continue', file=sys.stderr)
         sys.exit(1)
@@ -47,13 +51,20 @@ def run(options):
           extern_progs,
           version_report_lines=version_report_lines,
           assembly_coverage=options.assembly_cov,
+          max_reads_cov=options.max_reads_cov,
+          max_cluster_refs=options.max_cluster_refs,
           assembler=options.assembler,
+          fermilite_grid_mode=options.fermilite_grid,
           threads=options.threads,
+          cluster_timings=options.cluster_timings,
           verbose=options.verbose,
           min_scaff_depth=options.min_scaff_depth,
           nucmer_min_id=options.nucmer_min_id,
           nucmer_min_len=options.nucmer_min_len,
           nucmer_breaklen=options.nucmer_breaklen,
+          aligner=options.aligner,
+          read_mapper=options.read_mapper,
+          pileup=options.pileup,
           assembled_threshold=options.assembled_threshold,
           unique_threshold=options.unique_threshold,
           max_gene_nt_extend=options.gene_nt_extend,
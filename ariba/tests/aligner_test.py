@@ -0,0 +1,69 @@
+import unittest
+import os
+import pymummer
+from ariba import aligner
+
+modules_dir = os.path.dirname(os.path.abspath(aligner.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestAligner(unittest.TestCase):
+    def test_init_bad_aligner(self):
+        '''test __init__ with unknown aligner'''
+        with self.assertRaises(aligner.Error):
+            aligner.Runner('ref.fa', 'qry.fa', 'out', aligner='not_an_aligner')
+
+
+    def test_coords_line(self):
+        '''test _coords_line'''
+        hit = (51, 550, 500, 1, 500, 500, 99.4012, 600, 500, -1, 'ref', 'qry', [])
+        expected = '51\t550\t500\t1\t500\t500\t99.40\t600\t500\t1\t-1\tref\tqry'
+        self.assertEqual(expected, aligner.Runner._coords_line(hit))
+        got = pymummer.alignment.Alignment(expected)
+        self.assertEqual(50, got.ref_start)
+        self.assertEqual(499, got.qry_start)
+        self.assertFalse(got.on_same_strand())
+
+
+    def test_snp_lines(self):
+        '''test _snp_lines'''
+        hit = (51, 550, 1, 500, 500, 500, 99.4, 600, 500, 1, 'ref', 'qry', [(151, 'C', 'A', 101, 100, 100), (251, 'C', '.', 200, 100, 199)])
+        expected = [
+            ('ref', 151, 'qry', '151\tC\tA\t101\t100\t100\t600\t500\t1\t1\tref\tqry'),
+            ('ref', 251, 'qry', '251\tC\t.\t200\t100\t199\t600\t500\t1\t1\tref\tqry'),
+        ]
+        self.assertEqual(expected, aligner.Runner._snp_lines(hit, show_snps_C=True))
+        expected = [
+            ('ref', 151, 'qry', '151\tC\tA\t101\t100\t100\t0\t0\t600\t500\t1\t1\tref\tqry'),
+            ('ref', 251, 'qry', '251\tC\t.\t200\t100\t199\t0\t0\t600\t500\t1\t1\tref\tqry'),
+        ]
+        got = aligner.Runner._snp_lines(hit, show_snps_C=False)
+        self.assertEqual(expected, got)
+        snp = pymummer.snp.Snp(got[0][3])
+        self.assertEqual(150, snp.ref_pos)
+        self.assertEqual(100, snp.qry_pos)
+        self.assertFalse(snp.reverse)
+
+
+    def test_run_minimap(self):
+        '''test run with minimap aligner'''
+        ref_fa = os.path.join(data_dir, 'aligner_test_run_minimap.ref.fa')
+        qry_fa = os.path.join(data_dir, 'aligner_test_run_minimap.qry.fa')
+        expected_coords = os.path.join(data_dir, 'aligner_test_run_minimap.expected.coords')
+        tmp_coords = 'tmp.aligner_test_run_minimap.coords'
+        runner = aligner.Runner(ref_fa, qry_fa, tmp_coords, min_id=90, min_length=20, maxmatch=True, show_snps=True, show_snps_C=False, aligner='minimap')
+        runner.run()
+        expected = list(pymummer.coords_file.reader(expected_coords))
+        got = list(pymummer.coords_file.reader(tmp_coords))
+        self.assertEqual(expected, got)
+        expected = list(pymummer.snp_file.reader(expected_coords + '.snps'))
+        got = list(pymummer.snp_file.reader(tmp_coords + '.snps'))
+        self.assertEqual(expected, got)
+        os.unlink(tmp_coords)
+        os.unlink(tmp_coords + '.snps')
+
+        runner = aligner.Runner(ref_fa, qry_fa, tmp_coords, min_id=99.5, min_length=20, aligner='minimap')
+        runner.run()
+        self.assertEqual([], list(pymummer.coords_file.reader(tmp_coords)))
+        self.assertFalse(os.path.exists(tmp_coords + '.snps'))
+        os.unlink(tmp_coords)
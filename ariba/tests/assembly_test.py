@@ -2,6 +2,7 @@ import unittest
 import os
 import filecmp
 import pyfastaq
+import pymummer
 from ariba import assembly, common
 from ariba import external_progs
 
@@ -25,6 +26,73 @@ class TestAssembly(unittest.TestCase):
         os.unlink(tmp_log)
 
 
+    def test_run_fermilite_threads(self):
+        '''test _run_fermilite with more than one thread'''
+        reads = os.path.join(data_dir, 'assembly_run_fermilite.reads.fq')
+        tmp_fa = 'tmp.test_run_fermilite_threads.fa'
+        tmp_log = 'tmp.test_run_fermilite_threads.log'
+        expected_fa = os.path.join(data_dir, 'assembly_run_fermilite.expected.fa')
+        expected_log = os.path.join(data_dir, 'assembly_run_fermilite.expected.log')
+        got = assembly.Assembly._run_fermilite(reads, tmp_fa, tmp_log, 'contig', threads=3)
+        self.assertEqual(0, got)
+        self.assertTrue(filecmp.cmp(expected_fa, tmp_fa, shallow=False))
+        self.assertTrue(filecmp.cmp(expected_log, tmp_log, shallow=False))
+        os.unlink(tmp_fa)
+        os.unlink(tmp_log)
+
+
+    def test_run_fermilite_grid(self):
+        '''test _run_fermilite with a subset of the grid'''
+        reads = os.path.join(data_dir, 'assembly_run_fermilite.reads.fq')
+        tmp_fa = 'tmp.test_run_fermilite_grid.fa'
+        tmp_log = 'tmp.test_run_fermilite_grid.log'
+        got = assembly.Assembly._run_fermilite(reads, tmp_fa, tmp_log, 'contig', grid=[(15, 17), (6, 4)])
+        self.assertEqual(0, got)
+        expected = {}
+        pyfastaq.tasks.file_to_dict(os.path.join(data_dir, 'assembly_run_fermilite.expected.fa'), expected)
+        got_seqs = {}
+        pyfastaq.tasks.file_to_dict(tmp_fa, got_seqs)
+        self.assertEqual({x: expected[x] for x in expected if '.l15.c17.' in x or '.l6.c4.' in x}, got_seqs)
+        with open(tmp_log) as f:
+            got_log = [line.split('\t')[:2] for line in f][2:]
+        self.assertEqual([['15', '17'], ['6', '4']], got_log)
+        os.unlink(tmp_fa)
+        os.unlink(tmp_log)
+
+
+    def test_run_fermilite_packed_reads(self):
+        '''test _run_fermilite with reads as bytes instead of a file'''
+        reads = os.path.join(data_dir, 'assembly_run_fermilite.reads.fq')
+        tmp_fa = 'tmp.test_run_fermilite_packed_reads.fa'
+        tmp_log = 'tmp.test_run_fermilite_packed_reads.log'
+        expected_fa = os.path.join(data_dir, 'assembly_run_fermilite.expected.fa')
+        expected_log = os.path.join(data_dir, 'assembly_run_fermilite.expected.log')
+        seqs = [x.seq + '\t' + x.qual for x in pyfastaq.sequences.file_reader(reads)]
+        packed = ''.join([seqs[i] + '\t' + seqs[i+1] + '\n' for i in range(0, len(seqs), 2)]).encode()
+        got = assembly.Assembly._run_fermilite(packed, tmp_fa, tmp_log, 'contig')
+        self.assertEqual(0, got)
+        self.assertTrue(filecmp.cmp(expected_fa, tmp_fa, shallow=False))
+        self.assertTrue(filecmp.cmp(expected_log, tmp_log, shallow=False))
+        os.unlink(tmp_fa)
+        os.unlink(tmp_log)
+
+        got = assembly.Assembly._run_fermilite(b'ACGT\tIIII\tACGT\n', tmp_fa, tmp_log, 'contig')
+        self.assertEqual(1, got)
+        self.assertFalse(os.path.exists(tmp_fa))
+        os.unlink(tmp_log)
+
+
+    def test_packed_reads(self):
+        '''test _packed_reads'''
+        reads1 = os.path.join(data_dir, 'assembly_packed_reads_1.fq')
+        reads2 = os.path.join(data_dir, 'assembly_packed_reads_2.fq')
+        expected = b'ACGT\tIIII\tTTGCA\tIIIII\nGGCA\tHHHH\tCCA\tGGG\n'
+        self.assertEqual(expected, assembly.Assembly._packed_reads(reads1, reads2))
+        reads2 = os.path.join(data_dir, 'assembly_packed_reads_2.short.fq')
+        with self.assertRaises(assembly.Error):
+            assembly.Assembly._packed_reads(reads1, reads2)
+
+
     def test_run_fermilite_fails(self):
         '''test _run_fermilite when it fails'''
         reads = os.path.join(data_dir, 'assembly_run_fermilite_fail.reads.fq')
@@ -58,6 +126,57 @@ class TestAssembly(unittest.TestCase):
         os.unlink(tmp_log)
 
 
+    def test_assemble_with_fermilite_adaptive(self):
+        '''test _assemble_with_fermilite with adaptive grid'''
+        reads1 = os.path.join(data_dir, 'assembly_assemble_with_fermilite.reads_1.fq')
+        reads2 = os.path.join(data_dir, 'assembly_assemble_with_fermilite.reads_2.fq')
+        refs_fa = os.path.join(data_dir, 'assembly_assemble_with_fermilite_adaptive.refs.fa')
+        expected_log = os.path.join(data_dir, 'assembly_assemble_with_fermilite_adaptive.expected.log')
+        expected_fa = os.path.join(data_dir, 'assembly_assemble_with_fermilite_adaptive.expected.fa')
+        tmp_dir = 'tmp.test_assemble_with_fermilite_adaptive'
+        tmp_log = 'tmp.test_assemble_with_fermilite_adaptive.log'
+        tmp_log_fh = open(tmp_log, 'w')
+        print('First line', file=tmp_log_fh)
+        a = assembly.Assembly(reads1, reads2, 'not needed', refs_fa, tmp_dir, 'not_needed_for_this_test.fa', 'not_needed_for_this_test.bam', tmp_log_fh, 'not needed', fermilite_grid_mode='adaptive', fermilite_grid_wins={(15, 17): 2})
+        a._assemble_with_fermilite()
+        self.assertTrue(a.assembled_ok)
+        tmp_log_fh.close()
+        self.assertTrue(filecmp.cmp(expected_log, tmp_log, shallow=False))
+        self.assertTrue(filecmp.cmp(expected_fa, os.path.join(tmp_dir, 'debug_all_contigs.fa'), shallow=False))
+        common.rmtree(tmp_dir)
+        os.unlink(tmp_log)
+
+
+    def test_fermilite_grid_order(self):
+        '''test _fermilite_grid_order'''
+        self.assertEqual(assembly.fermilite_grid, assembly.Assembly._fermilite_grid_order(None))
+        self.assertEqual(assembly.fermilite_grid, assembly.Assembly._fermilite_grid_order({}))
+        expected = [(15, 17), (6, 30), (6, 4), (6, 17), (15, 4), (15, 30)]
+        self.assertEqual(expected, assembly.Assembly._fermilite_grid_order({(15, 17): 2, (6, 30): 1}))
+
+
+    def test_ref_proportion_covered_by_kmers(self):
+        '''test _ref_proportion_covered_by_kmers'''
+        self.assertEqual(0, assembly.Assembly._ref_proportion_covered_by_kmers('', {'ACG'}, 3))
+        self.assertEqual(0, assembly.Assembly._ref_proportion_covered_by_kmers('ACGTA', {'TTT'}, 3))
+        self.assertEqual(0.6, assembly.Assembly._ref_proportion_covered_by_kmers('ACGTA', {'ACG'}, 3))
+        self.assertEqual(0.8, assembly.Assembly._ref_proportion_covered_by_kmers('ACGTA', {'ACG', 'CGT'}, 3))
+        self.assertEqual(1, assembly.Assembly._ref_proportion_covered_by_kmers('ACGTA', {'ACG', 'GTA'}, 3))
+
+
+    def test_assembly_covers_a_ref(self):
+        '''test _assembly_covers_a_ref'''
+        ref = 'ACGTTAGCCATGACTGGATCCATAGGCTAACGTGACC'
+        ref_revcomp = pyfastaq.sequences.Fasta('x', ref)
+        ref_revcomp.revcomp()
+        self.assertFalse(assembly.Assembly._assembly_covers_a_ref([], [ref], 0.95, kmer_length=5))
+        self.assertFalse(assembly.Assembly._assembly_covers_a_ref([ref, ref], [ref], 0.95, kmer_length=5))
+        self.assertTrue(assembly.Assembly._assembly_covers_a_ref([ref], ['AAAAAAAAAA', ref], 0.95, kmer_length=5))
+        self.assertTrue(assembly.Assembly._assembly_covers_a_ref([ref_revcomp.seq.lower()], [ref], 0.95, kmer_length=5))
+        self.assertFalse(assembly.Assembly._assembly_covers_a_ref([ref[:30]], [ref], 0.95, kmer_length=5))
+        self.assertTrue(assembly.Assembly._assembly_covers_a_ref([ref[:30]], [ref], 0.8, kmer_length=5))
+
+
     def test_assemble_with_fermilite_fails(self):
         '''test _assemble_with_fermilite fails'''
         reads1 = os.path.join(data_dir, 'assembly_assemble_with_fermilite_fails.reads_1.fq')
@@ -90,6 +209,67 @@ class TestAssembly(unittest.TestCase):
         os.unlink(tmp_out)
 
 
+    def test_fix_contig_orientation_with_nucmer_outfile(self):
+        '''test _fix_contig_orientation with nucmer_outfile'''
+        scaffs_in = os.path.join(data_dir, 'assembly_test_fix_contig_orientation.in.fa')
+        expected_out = os.path.join(data_dir, 'assembly_test_fix_contig_orientation.out.fa')
+        ref_fa = os.path.join(data_dir, 'assembly_test_fix_contig_orientation.ref.fa')
+        tmp_out = 'tmp.assembly_test_fix_contig_orientation.out.fa'
+        tmp_coords = 'tmp.assembly_test_fix_contig_orientation.coords'
+        got = assembly.Assembly._fix_contig_orientation(scaffs_in, ref_fa, tmp_out, nucmer_outfile=tmp_coords)
+        expected = {'match_both_strands'}
+        self.assertTrue(filecmp.cmp(expected_out, tmp_out, shallow=False))
+        self.assertEqual(expected, got)
+        hits = list(pymummer.coords_file.reader(tmp_coords))
+        self.assertTrue(len(hits) > 0)
+        for hit in hits:
+            if hit.qry_name not in expected:
+                self.assertTrue(hit.on_same_strand())
+        for snp in pymummer.snp_file.reader(tmp_coords + '.snps'):
+            if snp.qry_name not in expected:
+                self.assertFalse(snp.reverse)
+        os.unlink(tmp_out)
+        os.unlink(tmp_coords)
+        os.unlink(tmp_coords + '.snps')
+
+
+    def test_fix_contig_orientation_minimap_aligner(self):
+        '''test _fix_contig_orientation with minimap aligner'''
+        scaffs_in = os.path.join(data_dir, 'assembly_test_fix_contig_orientation.in.fa')
+        expected_out = os.path.join(data_dir, 'assembly_test_fix_contig_orientation.out.fa')
+        ref_fa = os.path.join(data_dir, 'assembly_test_fix_contig_orientation.ref.fa')
+        tmp_out = 'tmp.assembly_test_fix_contig_orientation.out.fa'
+        got = assembly.Assembly._fix_contig_orientation(scaffs_in, ref_fa, tmp_out, aligner='minimap')
+        expected = {'match_both_strands'}
+        self.assertTrue(filecmp.cmp(expected_out, tmp_out, shallow=False))
+        self.assertEqual(expected, got)
+        os.unlink(tmp_out)
+
+
+    def test_reverse_queries_in_nucmer_files(self):
+        '''test _reverse_queries_in_nucmer_files'''
+        coords_in = os.path.join(data_dir, 'assembly_test_reverse_queries_in_nucmer_files.in.coords')
+        expected = os.path.join(data_dir, 'assembly_test_reverse_queries_in_nucmer_files.out.coords')
+        tmp_out = 'tmp.assembly_test_reverse_queries_in_nucmer_files.coords'
+        assembly.Assembly._reverse_queries_in_nucmer_files(coords_in, tmp_out, {'ctg1'})
+        self.assertTrue(filecmp.cmp(expected, tmp_out, shallow=False))
+        self.assertTrue(filecmp.cmp(expected + '.snps', tmp_out + '.snps', shallow=False))
+        os.unlink(tmp_out)
+        os.unlink(tmp_out + '.snps')
+
+
+    def test_reverse_queries_in_nucmer_line_snps(self):
+        '''test _reverse_queries_in_nucmer_line on show-snps lines with and without [R] [Q] columns'''
+        tests = [
+            ('10\tA\tG\t191\t5\t10\t0\t0\t100\t250\t1\t-1\tref\tctg1\n', '10\tA\tG\t60\t5\t10\t0\t0\t100\t250\t1\t1\tref\tctg1\n'),
+            ('10\tA\tG\t191\t5\t10\t100\t250\t1\t-1\tref\tctg1\n', '10\tA\tG\t60\t5\t10\t100\t250\t1\t1\tref\tctg1\n'),
+            ('40\t.\tT\t40\t10\t11\t0\t0\t100\t60\t1\t1\tref\tctg2\n', '40\t.\tT\t40\t10\t11\t0\t0\t100\t60\t1\t1\tref\tctg2\n'),
+        ]
+        for line, expected in tests:
+            got = assembly.Assembly._reverse_queries_in_nucmer_line(line, {'ctg1'}, -1, -5, [3], -3)
+            self.assertEqual(expected, got)
+
+
     def test_parse_bam(self):
         '''test _parse_bam'''
         bam = os.path.join(data_dir, 'assembly_test_parse_assembly_bam.bam')
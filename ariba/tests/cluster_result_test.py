@@ -0,0 +1,83 @@
+import unittest
+import pyfastaq
+from ariba import cluster_result, flag
+
+
+class TestClusterResult(unittest.TestCase):
+    def test_from_cluster_not_run(self):
+        '''test from_cluster when cluster was not run'''
+        class FakeCluster:
+            def __init__(self):
+                self.name = 'cluster1'
+                self.status_flag = flag.Flag()
+                self.assembly_compare = None
+                self.ref_sequence = None
+                self.total_reads = 10
+                self.total_reads_bases = 1000
+                self.stored_reads = 8
+                self.stored_reads_bases = 800
+
+        got = cluster_result.ClusterResult.from_cluster(FakeCluster())
+        expected = cluster_result.ClusterResult('cluster1', stats={
+            'ref_name': None,
+            'total_reads': 10,
+            'total_reads_bases': 1000,
+            'stored_reads': 8,
+            'stored_reads_bases': 800,
+        })
+        self.assertEqual(expected, got)
+
+
+    def test_from_cluster_run(self):
+        '''test from_cluster when cluster was run'''
+        ref = pyfastaq.sequences.Fasta('ref1', 'ACGTACGT')
+        ctg = pyfastaq.sequences.Fasta('ctg1', 'ACGTACGTA')
+        assembled = pyfastaq.sequences.Fasta('ctg1.1.9', 'ACGTACGTA')
+        gene = pyfastaq.sequences.Fasta('ctg1', 'ACGTACGT')
+
+        class FakeAssembly:
+            def __init__(self):
+                self.sequences = {'ctg1': ctg}
+
+        class FakeAssemblyCompare:
+            def __init__(self):
+                self.assembled_reference_sequences = {'ctg1.1.9': assembled}
+                self.gene_matching_ref = gene
+                self.gene_matching_ref_type = 'GENE_FOUND'
+                self.gene_start_bases_added = 0
+                self.gene_end_bases_added = 1
+
+        class FakeCluster:
+            def __init__(self):
+                self.name = 'cluster1'
+                self.status_flag = flag.Flag(27)
+                self.assembly = FakeAssembly()
+                self.assembly_compare = FakeAssemblyCompare()
+                self.ref_sequence = ref
+                self.report_lines = ['line1', 'line2']
+                self.total_reads = 10
+                self.total_reads_bases = 1000
+                self.stored_reads = 10
+                self.stored_reads_bases = 1000
+
+        got = cluster_result.ClusterResult.from_cluster(FakeCluster())
+        self.assertEqual('cluster1', got.name)
+        self.assertEqual(['line1', 'line2'], got.report_lines)
+        self.assertEqual({'ctg1': ctg}, got.assembly_sequences)
+        self.assertEqual({'ctg1.1.9': assembled}, got.assembled_reference_sequences)
+        self.assertEqual(gene, got.gene_matching_ref)
+        self.assertEqual('GENE_FOUND', got.gene_matching_ref_type)
+        self.assertEqual(0, got.gene_start_bases_added)
+        self.assertEqual(1, got.gene_end_bases_added)
+        self.assertEqual(flag.Flag(27), got.status_flag)
+        self.assertEqual('ref1', got.stats['ref_name'])
+        self.assertFalse(hasattr(got, 'assembly_compare'))
+
+
+    def test_check_version(self):
+        '''test check_version'''
+        result = cluster_result.ClusterResult('cluster1')
+        result.check_version()
+        result.result_version = cluster_result.ClusterResult.version - 1
+        with self.assertRaises(cluster_result.Error):
+            result.check_version()
@@ -0,0 +1,61 @@
+import unittest
+import os
+from ariba import cluster_scheduler
+
+modules_dir = os.path.dirname(os.path.abspath(cluster_scheduler.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestClusterScheduler(unittest.TestCase):
+    def test_write_and_load_timings_file(self):
+        '''test write_timings_file and load_timings_file'''
+        timings = {
+            'cluster2': (10, 1000, 500, 2.5),
+            'cluster1': (20, 3000, 1500, 42.0),
+        }
+        tmp_file = 'tmp.cluster_scheduler_test_timings.tsv'
+        cluster_scheduler.ClusterScheduler.write_timings_file(timings, tmp_file)
+        got = cluster_scheduler.ClusterScheduler.load_timings_file(tmp_file)
+        self.assertEqual(timings, got)
+        os.unlink(tmp_file)
+
+
+    def test_load_timings_file_bad(self):
+        '''test load_timings_file with bad lines'''
+        tmp_file = 'tmp.cluster_scheduler_test_timings_bad.tsv'
+        for bad_line in ['cluster1\t1\t2\t3', 'cluster1\t1\t2\tx\t4']:
+            with open(tmp_file, 'w') as f:
+                print('#' + '\t'.join(cluster_scheduler.timings_columns), file=f)
+                print(bad_line, file=f)
+
+            with self.assertRaises(cluster_scheduler.Error):
+                cluster_scheduler.ClusterScheduler.load_timings_file(tmp_file)
+
+        os.unlink(tmp_file)
+
+
+    def test_order_no_timings(self):
+        '''test order without timings'''
+        scheduler = cluster_scheduler.ClusterScheduler()
+        clusters = [
+            ('cluster1', 10, 1000, 500),
+            ('cluster2', 50, 5000, 500),
+            ('cluster3', 10, 1000, 900),
+            ('cluster4', 20, 2000, 100),
+        ]
+        self.assertEqual(['cluster2', 'cluster4', 'cluster3', 'cluster1'], scheduler.order(clusters))
+
+
+    def test_order_with_timings(self):
+        '''test order with timings file'''
+        timings_file = os.path.join(data_dir, 'cluster_scheduler_test_order_with_timings.tsv')
+        scheduler = cluster_scheduler.ClusterScheduler(timings_file=timings_file)
+        self.assertEqual(0.01, scheduler.seconds_per_base)
+        self.assertEqual((200.0, 500), scheduler.cost('cluster1', 20, 2000, 500))
+        self.assertEqual((5.0, 600), scheduler.cost('cluster_not_in_file', 50, 500, 600))
+        clusters = [
+            ('cluster1', 10, 1000, 500),
+            ('cluster2', 50, 5000, 500),
+            ('cluster3', 1, 100, 500),
+        ]
+        self.assertEqual(['cluster1', 'cluster3', 'cluster2'], scheduler.order(clusters))
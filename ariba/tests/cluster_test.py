@@ -2,7 +2,7 @@ import unittest
 import os
 import shutil
 import filecmp
-from ariba import cluster, common, reference_data
+from ariba import assembly, cluster, common, reference_data, thread_tokens
 
 modules_dir = os.path.dirname(os.path.abspath(cluster.__file__))
 data_dir = os.path.join(modules_dir, 'tests', 'data')
@@ -50,6 +50,49 @@ class TestCluster(unittest.TestCase):
             common.rmtree(tmpdir)
 
 
+    def test_take_and_give_back_threads(self):
+        '''test _take_threads and _give_back_threads'''
+        refdata_fa = os.path.join(data_dir, 'cluster_test_init_refdata.fa')
+        meatadata_tsv = os.path.join(data_dir, 'cluster_test_init_refdata.tsv')
+        refdata = reference_data.ReferenceData([refdata_fa], [meatadata_tsv])
+        c = cluster.Cluster('tmp.cluster_test_take_and_give_back_threads', 'name', refdata=refdata, total_reads=42, total_reads_bases=4242, threads_total=4)
+        tokens = thread_tokens.ThreadTokens(4)
+        c.thread_tokens = tokens
+        c.held_thread_tokens = tokens.acquire(1)
+        self.assertEqual(1, tokens.acquire(1)) # another cluster running
+        c._take_threads('test')
+        self.assertEqual(3, c.threads)
+        self.assertEqual(0, tokens.acquire(1, block=False))
+        c._give_back_threads()
+        self.assertEqual(1, c.threads)
+        self.assertEqual(2, tokens.acquire(2, block=False))
+        tokens.release(3)
+        c._report_completion()
+        self.assertEqual(0, c.held_thread_tokens)
+        self.assertEqual(4, tokens.acquire(5, block=False))
+        tokens.release(4)
+
+        # step that can only use 2 threads
+        c.thread_tokens = tokens
+        c.held_thread_tokens = tokens.acquire(1)
+        c._take_threads('test', max_threads=2)
+        self.assertEqual(2, c.threads)
+        self.assertEqual(2, tokens.acquire(3, block=False))
+        tokens.release(2)
+        c._report_completion()
+
+        # no extra threads while other clusters are waiting to start
+        tokens = thread_tokens.ThreadTokens(4, waiting=2)
+        c.thread_tokens = tokens
+        c.held_thread_tokens = tokens.start_cluster()
+        c._take_threads('test')
+        self.assertEqual(1, c.threads)
+        tokens.skip_cluster()
+        c._take_threads('test')
+        self.assertEqual(4, c.threads)
+        c._report_completion()
+
+
     def test_number_of_reads_for_assembly(self):
         '''Test _number_of_reads_for_assembly'''
         tests = [
@@ -72,13 +115,29 @@ class TestCluster(unittest.TestCase):
         reads_out1 = 'tmp.test_make_reads_for_assembly.reads.out1.fq'
         reads_out2 = 'tmp.test_make_reads_for_assembly.reads.out2.fq'
         reads_written = cluster.Cluster._make_reads_for_assembly(10, 20, reads_in1, reads_in2, reads_out1, reads_out2, random_seed=42)
-        self.assertEqual(14, reads_written)
+        self.assertEqual(10, reads_written)
         self.assertTrue(filecmp.cmp(expected_out1, reads_out1, shallow=False))
         self.assertTrue(filecmp.cmp(expected_out2, reads_out2, shallow=False))
         os.unlink(reads_out1)
         os.unlink(reads_out2)
 
 
+    def test_make_reads_for_assembly_packed_reads(self):
+        '''Test _make_reads_for_assembly also making packed reads'''
+        reads_in1 = os.path.join(data_dir, 'cluster_test_make_reads_for_assembly.in1.fq')
+        reads_in2 = os.path.join(data_dir, 'cluster_test_make_reads_for_assembly.in2.fq')
+        reads_out1 = 'tmp.test_make_reads_for_assembly.reads.out1.fq'
+        reads_out2 = 'tmp.test_make_reads_for_assembly.reads.out2.fq'
+
+        for wanted_reads in 10, 20:
+            packed_reads = []
+            cluster.Cluster._make_reads_for_assembly(wanted_reads, 20, reads_in1, reads_in2, reads_out1, reads_out2, random_seed=42, packed_reads=packed_reads)
+            expected = assembly.Assembly._packed_reads(reads_out1, reads_out2)
+            self.assertEqual(expected, ''.join(packed_reads).encode())
+            os.unlink(reads_out1)
+            os.unlink(reads_out2)
+
+
     def test_make_reads_for_assembly_symlinks(self):
         '''Test _make_reads_for_assembly when just makes symlinks'''
         reads_in1 = os.path.join(data_dir, 'cluster_test_make_reads_for_assembly.in1.fq')
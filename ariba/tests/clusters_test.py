@@ -4,7 +4,8 @@ import os
 import pickle
 import pyfastaq
 import filecmp
-from ariba import clusters, common, external_progs, histogram, sequence_metadata
+import minimap_ariba
+from ariba import cluster_result, clusters, common, external_progs, histogram, read_store, sequence_metadata
 
 modules_dir = os.path.dirname(os.path.abspath(clusters.__file__))
 data_dir = os.path.join(modules_dir, 'tests', 'data')
@@ -90,6 +91,26 @@ class TestClusters(unittest.TestCase):
         self.assertEqual(expected_clusters, got_clusters)
 
 
+    def test_mean_read_length(self):
+        '''test _mean_read_length'''
+        tmp_reads = 'tmp.clusters_test_mean_read_length.fq'
+        with open(tmp_reads, 'w') as f:
+            print('@1', 'ACGT', '+', 'IIII', '@2', 'ACGTACGT', '+', 'IIIIIIII', '@3', 'AC', '+', 'II', sep='\n', file=f)
+        self.assertEqual(14 / 3, clusters.Clusters._mean_read_length(tmp_reads))
+        self.assertEqual(6, clusters.Clusters._mean_read_length(tmp_reads, max_reads=2))
+        os.unlink(tmp_reads)
+
+
+    def test_cluster_max_read_pairs(self):
+        '''test _cluster_max_read_pairs'''
+        indir = os.path.join(data_dir, 'clusters_load_ref_data_from_dir')
+        refdata, cluster_ids = clusters.Clusters._load_reference_data_from_dir(indir)
+        expected = {'0': 53, '1': 38, '2': 25}
+        self.assertEqual(expected, clusters.Clusters._cluster_max_read_pairs(cluster_ids, refdata, 10, 10, 5))
+        expected = {'0': 18, '1': 13, '2': 9}
+        self.assertEqual(expected, clusters.Clusters._cluster_max_read_pairs(cluster_ids, refdata, 10, 10, 15))
+
+
     def test_minimap_reads_to_all_ref_seqs(self):
         '''test test_minimap_reads_to_all_ref_seqs'''
         clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
@@ -97,24 +118,137 @@ class TestClusters(unittest.TestCase):
         reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
         reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
         tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs'
-        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix)
+        got = clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix, write_summary_files=True)
         expected_cluster2rep = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr2rep')
         expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
         expected_proper_pairs = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.pairs')
         expected_insert_hist = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.hist')
 
-        # not sure that the reads order is preserved, so just check read store file exists
-        self.assertTrue(os.path.exists(os.path.join(tmp_outprefix + '.reads')))
+        # not sure that the reads order is preserved, so just check read store files exist
+        for suffix in read_store.block_store_suffixes:
+            self.assertTrue(os.path.exists(tmp_outprefix + '.reads' + suffix))
 
         self.assertTrue(filecmp.cmp(expected_cluster2rep, tmp_outprefix + '.cluster2representative', shallow=False))
         self.assertTrue(filecmp.cmp(expected_cluster_counts, tmp_outprefix + '.clusterCounts', shallow=False))
         self.assertTrue(filecmp.cmp(expected_proper_pairs, tmp_outprefix + '.properPairs', shallow=False))
         self.assertTrue(filecmp.cmp(expected_insert_hist, tmp_outprefix + '.insertHistogram', shallow=False))
+
+        # returned results should be the same as the files
+        self.assertEqual(clusters.Clusters._load_minimap_files(tmp_outprefix, 10), clusters.Clusters._load_minimap_results(got, 10))
+        self.assertEqual({'ref1', 'ref2', 'ref3', 'ref7'}, set(got['refname_to_score']))
+        self.assertEqual(got['refname_to_score']['ref2'], max(got['refname_to_score'][x] for x in ['ref2', 'ref3', 'ref7']))
         os.unlink(tmp_outprefix + '.cluster2representative')
         os.unlink(tmp_outprefix + '.clusterCounts')
         os.unlink(tmp_outprefix + '.properPairs')
         os.unlink(tmp_outprefix + '.insertHistogram')
-        os.unlink(tmp_outprefix + '.reads')
+        for suffix in read_store.block_store_suffixes:
+            os.unlink(tmp_outprefix + '.reads' + suffix)
+
+
+    def test_minimap_reads_to_all_ref_seqs_threads(self):
+        '''test test_minimap_reads_to_all_ref_seqs with more than one thread'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_outprefix_1 = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_threads.1'
+        tmp_outprefix_3 = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_threads.3'
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix_1, threads=1, write_summary_files=True)
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix_3, threads=3, write_summary_files=True)
+        expected_cluster2rep = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr2rep')
+        expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
+        expected_proper_pairs = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.pairs')
+        expected_insert_hist = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.hist')
+
+        # reads are written in input order, so should not depend on the number of threads
+        for suffix in read_store.block_store_suffixes:
+            self.assertTrue(filecmp.cmp(tmp_outprefix_1 + '.reads' + suffix, tmp_outprefix_3 + '.reads' + suffix, shallow=False))
+
+        self.assertTrue(filecmp.cmp(expected_cluster2rep, tmp_outprefix_3 + '.cluster2representative', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_cluster_counts, tmp_outprefix_3 + '.clusterCounts', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_proper_pairs, tmp_outprefix_3 + '.properPairs', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_insert_hist, tmp_outprefix_3 + '.insertHistogram', shallow=False))
+
+        for prefix in tmp_outprefix_1, tmp_outprefix_3:
+            for suffix in ['cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram', 'reads.blocks', 'reads.blocks.index', 'reads.pairs', 'reads.pairs.index']:
+                os.unlink(prefix + '.' + suffix)
+
+
+    def test_minimap_reads_to_all_ref_seqs_with_index_file(self):
+        '''test test_minimap_reads_to_all_ref_seqs using an index file'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_with_index_file'
+        tmp_index = tmp_outprefix + '.mmi'
+        self.assertEqual(0, minimap_ariba.build_index(ref_fasta, tmp_index))
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix, index_file=tmp_index, write_summary_files=True)
+        expected_cluster2rep = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr2rep')
+        expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
+        expected_proper_pairs = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.pairs')
+        expected_insert_hist = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.hist')
+        self.assertTrue(filecmp.cmp(expected_cluster2rep, tmp_outprefix + '.cluster2representative', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_cluster_counts, tmp_outprefix + '.clusterCounts', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_proper_pairs, tmp_outprefix + '.properPairs', shallow=False))
+        self.assertTrue(filecmp.cmp(expected_insert_hist, tmp_outprefix + '.insertHistogram', shallow=False))
+
+        for suffix in ['cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram', 'reads.blocks', 'reads.blocks.index', 'reads.pairs', 'reads.pairs.index', 'mmi']:
+            os.unlink(tmp_outprefix + '.' + suffix)
+
+
+    def test_minimap_reads_to_all_ref_seqs_max_read_pairs(self):
+        '''test test_minimap_reads_to_all_ref_seqs with maximum number of read pairs'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_outprefix_1 = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_max_read_pairs.1'
+        tmp_outprefix_3 = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_max_read_pairs.3'
+        max_read_pairs = {'cluster1': 10, 'cluster3': 10}
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix_1, threads=1, max_read_pairs=max_read_pairs, write_summary_files=True)
+        clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix_3, threads=3, max_read_pairs=max_read_pairs, write_summary_files=True)
+
+        # counts are of all the reads, not just the sampled reads
+        expected_cluster_counts = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.out.clstr_count')
+        self.assertTrue(filecmp.cmp(expected_cluster_counts, tmp_outprefix_1 + '.clusterCounts', shallow=False))
+
+        # the sample should not depend on the number of threads
+        for suffix in read_store.block_store_suffixes:
+            self.assertTrue(filecmp.cmp(tmp_outprefix_1 + '.reads' + suffix, tmp_outprefix_3 + '.reads' + suffix, shallow=False))
+
+        rstore = read_store.ReadStore(tmp_outprefix_1 + '.reads', tmp_outprefix_1 + '.read_store', blocks=True)
+        tmp_reads_1 = tmp_outprefix_1 + '.reads_1.fq'
+        tmp_reads_2 = tmp_outprefix_1 + '.reads_2.fq'
+        self.assertEqual((20, 1520), rstore.get_reads('cluster1', tmp_reads_1, out2=tmp_reads_2))
+        self.assertEqual((1946, 147896), rstore.get_reads('cluster2', tmp_reads_1, out2=tmp_reads_2))
+        rstore.clean()
+        os.unlink(tmp_reads_1)
+        os.unlink(tmp_reads_2)
+
+        for suffix in ['cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+            os.unlink(tmp_outprefix_1 + '.' + suffix)
+        for suffix in ['cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram', 'reads.blocks', 'reads.blocks.index', 'reads.pairs', 'reads.pairs.index']:
+            os.unlink(tmp_outprefix_3 + '.' + suffix)
+
+
+    def test_minimap_reads_to_all_ref_seqs_no_summary_files(self):
+        '''test test_minimap_reads_to_all_ref_seqs does not write summary files by default'''
+        clusters_tsv = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.clstrs.tsv')
+        ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        reads_1 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_1.fq')
+        reads_2 = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.reads_2.fq')
+        tmp_outprefix = 'tmp.clusters_test_minimap_reads_to_all_ref_seqs_no_summary_files'
+        got = clusters.Clusters._minimap_reads_to_all_ref_seqs(clusters_tsv, ref_fasta, reads_1, reads_2, tmp_outprefix)
+        self.assertEqual({'cluster1': 'ref1', 'cluster2': 'ref2'}, got['cluster2representative'])
+        self.assertEqual({'cluster1': 1624, 'cluster2': 1946}, got['cluster_read_counts'])
+        self.assertEqual({'cluster1': 123424, 'cluster2': 147896}, got['cluster_base_counts'])
+        self.assertEqual(1471, got['proper_pairs'])
+
+        for suffix in ['cluster2representative', 'clusterCounts', 'properPairs', 'insertHistogram']:
+            self.assertFalse(os.path.exists(tmp_outprefix + '.' + suffix))
+        for suffix in read_store.block_store_suffixes:
+            os.unlink(tmp_outprefix + '.reads' + suffix)
 
 
     def test_load_minimap_out_cluster2representative(self):
@@ -175,6 +309,23 @@ class TestClusters(unittest.TestCase):
         self.assertEqual(expected_proper_pairs, got_proper_pairs)
 
 
+    def test_load_minimap_results(self):
+        '''test _load_minimap_results'''
+        results = {
+            'cluster2representative': {'1': 'ref2', '2': 'ref42'},
+            'refname_to_score': {'ref1': 10, 'ref2': 11, 'ref42': 1},
+            'cluster_read_counts': {'1': 42, '2': 43},
+            'cluster_base_counts': {'1': 4242, '2': 4343},
+            'insert_histogram': {85: 1, 86: 2, 90: 4, 91: 6, 97: 10, 100: 7, 111: 3},
+            'proper_pairs': 42424242,
+        }
+        bin_size = 10
+        inprefix = os.path.join(data_dir, 'clusters_test_load_minimap_files')
+        expected = clusters.Clusters._load_minimap_files(inprefix, bin_size)
+        got = clusters.Clusters._load_minimap_results(results, bin_size)
+        self.assertEqual(expected, got)
+
+
     def test_set_insert_size_data(self):
         '''test _set_insert_size_data'''
         self.clusters.insert_hist.bins = {
@@ -196,101 +347,72 @@ class TestClusters(unittest.TestCase):
         self.assertEqual(self.clusters.insert_sspace_sd, 0.91)
 
 
-    def test_write_report(self):
-        class FakeCluster:
-            def __init__(self, lines):
-                self.report_lines = lines
+    def _add_results_and_finish(self, results, output_name, outfile):
+        setattr(self.clusters, outfile, 'tmp.test_clusters_streamed_output')
+        self.clusters._open_streamed_outputs()
+        for result in results:
+            self.clusters._add_cluster_result(result, len(results))
+        self.clusters.streamed_outputs[output_name].finish()
+        self.assertEqual(sorted([x.name for x in results]), sorted(self.clusters.clusters))
+        return 'tmp.test_clusters_streamed_output'
 
-        clusters_dict = {
-            'gene1': FakeCluster(['gene1\tline1']),
-            'gene2': FakeCluster(['gene2\tline2'])
-        }
-
-        tmp_tsv = 'tmp.test_write_report.tsv'
-        clusters.Clusters._write_report(clusters_dict, tmp_tsv)
 
+    def test_write_report(self):
+        '''test report is written from cluster results'''
+        results = [
+            cluster_result.ClusterResult('gene2', report_lines=['gene2\tline2']),
+            cluster_result.ClusterResult('gene3'),
+            cluster_result.ClusterResult('gene1', report_lines=['gene1\tline1']),
+        ]
+        tmp_tsv = self._add_results_and_finish(results, 'report', 'report_file_all_tsv')
         expected = os.path.join(data_dir, 'clusters_test_write_report.tsv')
         self.assertTrue(filecmp.cmp(expected, tmp_tsv, shallow=False))
         os.unlink(tmp_tsv)
+        self.assertTrue(all([x.report_lines is None for x in self.clusters.clusters.values()]))
 
 
     def test_write_catted_assemblies_fasta(self):
-        '''test _write_catted_assemblies_fasta'''
+        '''test catted assemblies fasta is written from cluster results'''
         seq1 = pyfastaq.sequences.Fasta('seq1', 'ACGT')
         seq2 = pyfastaq.sequences.Fasta('seq2', 'TTTT')
         seq3 = pyfastaq.sequences.Fasta('seq3', 'AAAA')
-        class FakeAssembly:
-            def __init__(self, seqs):
-                if seqs is not None:
-                    self.sequences = {x.id: x for x in seqs}
-
-        class FakeCluster:
-            def __init__(self, seqs):
-                self.assembly = FakeAssembly(seqs)
-
-        self.clusters.clusters = {
-            'cluster1': FakeCluster([seq1, seq2]),
-            'cluster2': FakeCluster([seq3]),
-            'cluster3': FakeCluster(None),
-        }
-
-        tmp_file = 'tmp.test_write_catted_assemblies_fasta.fa'
-        self.clusters._write_catted_assemblies_fasta(tmp_file)
+        results = [
+            cluster_result.ClusterResult('cluster3'),
+            cluster_result.ClusterResult('cluster2', assembly_sequences={seq3.id: seq3}),
+            cluster_result.ClusterResult('cluster1', assembly_sequences={x.id: x for x in [seq2, seq1]}),
+        ]
+        tmp_file = self._add_results_and_finish(results, 'assemblies', 'catted_assemblies_fasta')
         expected = os.path.join(data_dir, 'clusters_test_write_catted_assemblies_fasta.expected.out.fa')
         self.assertTrue(filecmp.cmp(expected, tmp_file, shallow=False))
         os.unlink(tmp_file)
 
 
     def test_write_catted_assembled_seqs_fasta(self):
-        '''test _write_catted_assembled_seqs_fasta'''
+        '''test catted assembled seqs fasta is written from cluster results'''
         seq1 = pyfastaq.sequences.Fasta('seq1', 'ACGT')
         seq2 = pyfastaq.sequences.Fasta('seq2', 'TTTT')
         seq3 = pyfastaq.sequences.Fasta('seq3', 'AAAA')
-        class FakeAssemblyCompare:
-            def __init__(self, assembled_seqs):
-                if assembled_seqs is not None:
-                    self.assembled_reference_sequences = {x.id: x for x in assembled_seqs}
-
-        class FakeCluster:
-            def __init__(self, assembled_seqs):
-                self.assembly_compare = FakeAssemblyCompare(assembled_seqs)
-
-        self.clusters.clusters = {
-            'gene1': FakeCluster([seq1, seq2]),
-            'gene2': FakeCluster([seq3]),
-            'gene3': FakeCluster(None),
-        }
-
-        tmp_file = 'tmp.test_write_catted_assembled_seqs_fasta.fa'
-        self.clusters._write_catted_assembled_seqs_fasta(tmp_file)
+        results = [
+            cluster_result.ClusterResult('gene2', assembled_reference_sequences={seq3.id: seq3}),
+            cluster_result.ClusterResult('gene1', assembled_reference_sequences={x.id: x for x in [seq1, seq2]}),
+            cluster_result.ClusterResult('gene3'),
+        ]
+        tmp_file = self._add_results_and_finish(results, 'assembled_seqs', 'catted_assembled_seqs_fasta')
         expected = os.path.join(data_dir, 'clusters_test_write_catted_assembled_genes_fasta.expected.out.fa')
         self.assertTrue(filecmp.cmp(expected, tmp_file, shallow=False))
         os.unlink(tmp_file)
 
 
     def test_cat_genes_match_ref(self):
-        '''test _write_catted_genes_matching_refs_fasta'''
+        '''test catted genes matching refs fasta is written from cluster results'''
         seq1 = pyfastaq.sequences.Fasta('seq1', 'ACGT')
         seq3 = pyfastaq.sequences.Fasta('seq3', 'AAAA')
-        class FakeAssemblyCompare:
-            def __init__(self, seq, seq_type, start, end):
-                self.gene_matching_ref = seq
-                self.gene_matching_ref_type = seq_type
-                self.gene_start_bases_added = start
-                self.gene_end_bases_added = end
-
-        class FakeCluster:
-            def __init__(self, seq, seq_type, start, end):
-                self.assembly_compare = FakeAssemblyCompare(seq, seq_type, start, end)
-
-        self.clusters.clusters = {
-            'gene1': FakeCluster(seq1, 'TYPE1', 1, 3),
-            'gene2': FakeCluster(None, None, None, None),
-            'gene3': FakeCluster(seq3, 'TYPE3', 4, 5),
-        }
-
-        tmp_file = 'tmp.test_write_catted_genes_matching_refs_fasta.fa'
-        self.clusters._write_catted_genes_matching_refs_fasta(tmp_file)
+        results = [
+            cluster_result.ClusterResult('gene3', gene_matching_ref=seq3, gene_matching_ref_type='TYPE3', gene_start_bases_added=4, gene_end_bases_added=5),
+            cluster_result.ClusterResult('gene2'),
+            cluster_result.ClusterResult('gene1', gene_matching_ref=seq1, gene_matching_ref_type='TYPE1', gene_start_bases_added=1, gene_end_bases_added=3),
+        ]
+        tmp_file = self._add_results_and_finish(results, 'genes_matching_refs', 'catted_genes_matching_refs_fasta')
         expected = os.path.join(data_dir, 'clusters_cat_genes_match_ref.fa')
         self.assertTrue(filecmp.cmp(expected, tmp_file, shallow=False))
         os.unlink(tmp_file)
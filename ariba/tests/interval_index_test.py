@@ -0,0 +1,50 @@
+import unittest
+from ariba import interval_index
+
+
+class TestIntervalIndex(unittest.TestCase):
+    def test_init_bad_interval(self):
+        '''test __init__ with end < start'''
+        with self.assertRaises(interval_index.Error):
+            interval_index.IntervalIndex([(1, 10, 'a'), (5, 4, 'b')])
+
+
+    def test_overlapping(self):
+        '''test overlapping'''
+        index = interval_index.IntervalIndex([(10, 20, 'a'), (1, 100, 'b'), (15, 16, 'c'), (30, 40, 'd')])
+        self.assertEqual(4, len(index))
+        self.assertEqual(['b'], index.overlapping(0, 9))
+        self.assertEqual(['a', 'b'], index.overlapping(0, 10))
+        self.assertEqual(['a', 'b', 'c'], index.overlapping(16, 16))
+        self.assertEqual(['a', 'b', 'c', 'd'], index.overlapping(14, 35))
+        self.assertEqual(['b', 'd'], index.overlapping(21, 30))
+        self.assertEqual([], index.overlapping(101, 200))
+        self.assertEqual([], interval_index.IntervalIndex().overlapping(1, 2))
+
+
+    def test_containing(self):
+        '''test containing'''
+        index = interval_index.IntervalIndex([(10, 20, 'a'), (5, 10, 'b'), (30, 40, 'c')])
+        self.assertEqual([], index.containing(4))
+        self.assertEqual(['b'], index.containing(5))
+        self.assertEqual(['a', 'b'], index.containing(10))
+        self.assertEqual(['a'], index.containing(20))
+        self.assertEqual([], index.containing(21))
+        self.assertEqual(['c'], index.containing(40))
+
+
+    def test_contains(self):
+        '''test contains'''
+        index = interval_index.IntervalIndex([(1, 100, None), (10, 20, None), (200, 210, None)])
+        tests = [(0, False), (1, True), (50, True), (100, True), (101, False), (199, False), (200, True), (210, True), (211, False)]
+        for position, expected in tests:
+            self.assertEqual(expected, index.contains(position))
+
+
+    def test_bases_with_depth_at_least(self):
+        '''test bases_with_depth_at_least'''
+        index = interval_index.IntervalIndex([(1, 10, None), (5, 14, None), (8, 9, None), (20, 20, None)])
+        self.assertEqual(15, index.bases_with_depth_at_least(1))
+        self.assertEqual(6, index.bases_with_depth_at_least(2))
+        self.assertEqual(2, index.bases_with_depth_at_least(3))
+        self.assertEqual(0, index.bases_with_depth_at_least(4))
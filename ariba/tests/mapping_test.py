@@ -1,5 +1,8 @@
 import unittest
+import io
+import contextlib
 import os
+import shutil
 import pysam
 import pyfastaq
 from ariba import mapping, external_progs
@@ -42,6 +45,71 @@ class TestMapping(unittest.TestCase):
         os.unlink(tmp_ref)
 
 
+    def test_bowtie2_index_cache_prefix(self):
+        '''test bowtie2_index_cache_prefix'''
+        tmp_ref1 = 'tmp.test_bowtie2_index_cache_prefix.1.fa'
+        tmp_ref2 = 'tmp.test_bowtie2_index_cache_prefix.2.fa'
+        with open(tmp_ref1, 'w') as f:
+            print('>seq', 'ACGTACGTACGT', sep='\n', file=f)
+        with open(tmp_ref2, 'w') as f:
+            print('>seq', 'ACGTACGTACGT', sep='\n', file=f)
+        got1 = mapping.bowtie2_index_cache_prefix(tmp_ref1, 'cache')
+        got2 = mapping.bowtie2_index_cache_prefix(tmp_ref2, 'cache')
+        self.assertEqual(got1, got2)
+        self.assertTrue(got1.startswith(os.path.join('cache', 'bowtie2_index.')))
+
+        with open(tmp_ref2, 'w') as f:
+            print('>seq', 'ACGTACGTACGA', sep='\n', file=f)
+        got2 = mapping.bowtie2_index_cache_prefix(tmp_ref2, 'cache')
+        self.assertNotEqual(got1, got2)
+        os.unlink(tmp_ref1)
+        os.unlink(tmp_ref2)
+
+
+    def test_run_bowtie2_index_cache_dir(self):
+        '''Test run_bowtie2 with index_cache_dir'''
+        ref = os.path.join(data_dir, 'mapping_test_bowtie2_ref.fa')
+        reads1 = os.path.join(data_dir, 'mapping_test_bowtie2_reads_1.fq')
+        reads2 = os.path.join(data_dir, 'mapping_test_bowtie2_reads_2.fq')
+        out_prefix = 'tmp.out.bowtie2_index_cache_dir'
+        cache_dir = 'tmp.out.bowtie2_index_cache_dir.cache'
+        index_prefix = mapping.bowtie2_index_cache_prefix(ref, cache_dir)
+        expected = get_sam_columns(os.path.join(data_dir, 'mapping_test_bowtie2_unsorted.bam'))
+
+        for i in range(2):
+            mapping.run_bowtie2(
+                reads1,
+                reads2,
+                ref,
+                out_prefix,
+                bowtie2=extern_progs.exe('bowtie2'),
+                bowtie2_version=extern_progs.version('bowtie2'),
+                index_cache_dir=cache_dir,
+            )
+            got = get_sam_columns(out_prefix + '.bam')
+            self.assertListEqual(expected, got)
+            for ext in mapping.bowtie2_index_extensions:
+                self.assertTrue(os.path.exists(index_prefix + '.' + ext))
+            self.assertFalse(os.path.exists(out_prefix + '.map_index.1.bt2'))
+            os.unlink(out_prefix + '.bam')
+
+        shutil.rmtree(cache_dir)
+
+
+    def test_sam_coordinate_sort_key(self):
+        '''test _sam_coordinate_sort_key'''
+        sams = []
+        for ref_id, pos, reverse in [(-1, -1, False), (1, 10, False), (0, 42, True), (0, 42, False), (0, 3, False)]:
+            sam = pysam.AlignedSegment()
+            sam.reference_id = ref_id
+            sam.reference_start = pos
+            sam.is_reverse = reverse
+            sams.append(sam)
+        got = [(x.reference_id, x.reference_start, x.is_reverse) for x in sorted(sams, key=mapping._sam_coordinate_sort_key)]
+        expected = [(0, 3, False), (0, 42, False), (0, 42, True), (1, 10, False), (-1, -1, False)]
+        self.assertEqual(expected, got)
+
+
     def test_run_bowtie2(self):
         '''Test run_bowtie2 unsorted'''
         self.maxDiff = None
@@ -107,6 +175,114 @@ class TestMapping(unittest.TestCase):
         os.unlink(out_prefix + '.bam.bai')
 
 
+    def test_run_bowtie2_fails(self):
+        '''Test run_bowtie2 when bowtie2 fails'''
+        tmp_dir = 'tmp.run_bowtie2_fails'
+        os.mkdir(tmp_dir)
+        ref = os.path.join(tmp_dir, 'ref.fa')
+        shutil.copyfile(os.path.join(data_dir, 'mapping_test_bowtie2_ref.fa'), ref)
+        for ext in mapping.bowtie2_index_extensions:
+            open(ref + '.' + ext, 'w').close()
+        fake_bowtie2 = os.path.join(tmp_dir, 'bowtie2')
+        with open(fake_bowtie2, 'w') as f:
+            print('#!/bin/sh', file=f)
+            print('echo "fake bowtie2 error" >&2', file=f)
+            print('exit 1', file=f)
+        os.chmod(fake_bowtie2, 0o755)
+
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            with self.assertRaises(SystemExit):
+                mapping.run_bowtie2(
+                    os.path.join(data_dir, 'mapping_test_bowtie2_reads_1.fq'),
+                    os.path.join(data_dir, 'mapping_test_bowtie2_reads_2.fq'),
+                    ref,
+                    os.path.join(tmp_dir, 'out'),
+                    bowtie2=fake_bowtie2,
+                    bowtie2_version='2.3.4',
+                )
+
+        self.assertIn('fake bowtie2 error', stderr.getvalue())
+        shutil.rmtree(tmp_dir)
+
+
+    def test_run_minimap(self):
+        '''Test run_minimap unsorted'''
+        ref = os.path.join(data_dir, 'mapping_test_bowtie2_ref.fa')
+        reads1 = os.path.join(data_dir, 'mapping_test_bowtie2_reads_1.fq')
+        reads2 = os.path.join(data_dir, 'mapping_test_bowtie2_reads_2.fq')
+        out_prefix = 'tmp.out.minimap'
+        mapping.run_minimap(reads1, reads2, ref, out_prefix)
+        expected = get_sam_columns(os.path.join(data_dir, 'mapping_test_bowtie2_unsorted.bam'))
+        got = get_sam_columns(out_prefix + '.bam')
+        self.assertListEqual(expected, got)
+        self.assertFalse(os.path.exists(out_prefix + '.unsorted.sam'))
+        os.unlink(out_prefix + '.bam')
+
+
+    def test_run_minimap_remove_both_unmapped(self):
+        '''Test run_minimap unsorted remove both unmapped'''
+        ref = os.path.join(data_dir, 'mapping_test_bowtie2_ref.fa')
+        reads1 = os.path.join(data_dir, 'mapping_test_bowtie2_remove_both_unmapped_reads_1.fq')
+        reads2 = os.path.join(data_dir, 'mapping_test_bowtie2_remove_both_unmapped_reads_2.fq')
+        out_prefix = 'tmp.out.minimap_remove_both_unmapped'
+        mapping.run_minimap(reads1, reads2, ref, out_prefix, remove_both_unmapped=True)
+        # bowtie2 writes the mapped read of a pair first, so only compare the reads, not their order
+        expected = get_sam_columns(os.path.join(data_dir, 'mapping_test_bowtie2_remove_both_unmapped_reads.bam'))
+        got = get_sam_columns(out_prefix + '.bam')
+        self.assertEqual(sorted(expected, key=str), sorted(got, key=str))
+        os.unlink(out_prefix + '.bam')
+
+
+    def test_run_minimap_and_sort(self):
+        '''Test run_minimap sorted'''
+        ref = os.path.join(data_dir, 'mapping_test_bowtie2_ref.fa')
+        reads1 = os.path.join(data_dir, 'mapping_test_bowtie2_reads_1.fq')
+        reads2 = os.path.join(data_dir, 'mapping_test_bowtie2_reads_2.fq')
+        out_prefix = 'tmp.out.minimap'
+        mapping.run_minimap(reads1, reads2, ref, out_prefix, sort=True)
+        expected = get_sam_columns(os.path.join(data_dir, 'mapping_test_bowtie2_sorted.bam'))
+        got = get_sam_columns(out_prefix + '.bam')
+        self.assertListEqual(expected, got)
+        os.unlink(out_prefix + '.bam')
+        os.unlink(out_prefix + '.bam.bai')
+
+
+    def test_read_mapper_concordance(self):
+        '''Test read_mapper_concordance'''
+        bam = os.path.join(data_dir, 'mapping_test_bowtie2_unsorted.bam')
+        got = mapping.read_mapper_concordance(bam, bam)
+        expected = {'reads': 14, 'mapped1': 11, 'mapped2': 11, 'both_mapped': 11, 'same_position': 11, 'same_proper_pair': 11}
+        self.assertEqual(expected, got)
+
+
+    def test_minimap_concordance_with_bowtie2(self):
+        '''Benchmark of run_minimap against run_bowtie2 very-sensitive-local, using the test run data'''
+        test_run_data_dir = os.path.join(modules_dir, 'test_run_data')
+        ref = os.path.join(test_run_data_dir, 'ref_fasta_to_make_reads_from.fa')
+        reads1 = os.path.join(test_run_data_dir, 'reads_1.fq')
+        reads2 = os.path.join(test_run_data_dir, 'reads_2.fq')
+        bowtie2_prefix = 'tmp.minimap_concordance_with_bowtie2.bowtie2'
+        minimap_prefix = 'tmp.minimap_concordance_with_bowtie2.minimap'
+        mapping.run_bowtie2(
+            reads1,
+            reads2,
+            ref,
+            bowtie2_prefix,
+            bowtie2=extern_progs.exe('bowtie2'),
+            bowtie2_preset='very-sensitive-local',
+            bowtie2_version=extern_progs.version('bowtie2'),
+        )
+        mapping.run_minimap(reads1, reads2, ref, minimap_prefix)
+        got = mapping.read_mapper_concordance(bowtie2_prefix + '.bam', minimap_prefix + '.bam')
+        self.assertEqual(2092, got['reads'])
+        self.assertGreaterEqual(got['mapped2'], 0.99 * got['mapped1'])
+        self.assertGreaterEqual(got['same_position'], 0.99 * got['both_mapped'])
+        self.assertGreaterEqual(got['same_proper_pair'], 0.99 * got['both_mapped'])
+        os.unlink(bowtie2_prefix + '.bam')
+        os.unlink(minimap_prefix + '.bam')
+
+
     def test_get_total_alignment_score(self):
         '''Test get_total_alignment_score'''
         bam = os.path.join(data_dir, 'mapping_test_get_total_alignment_score.bam')
@@ -17,6 +17,20 @@ def file_to_list(infile):
 
 
 class TestReadStore(unittest.TestCase):
+    def test_pair_is_in_sample(self):
+        '''test pair_is_in_sample'''
+        pairs = range(1, 10001)
+        self.assertEqual([], [x for x in pairs if read_store.ReadStore.pair_is_in_sample(x, 0, random_seed=42)])
+        self.assertEqual(list(pairs), [x for x in pairs if read_store.ReadStore.pair_is_in_sample(x, 1, random_seed=42)])
+        sample1 = [x for x in pairs if read_store.ReadStore.pair_is_in_sample(x, 0.3, random_seed=42)]
+        sample2 = [x for x in pairs if read_store.ReadStore.pair_is_in_sample(x, 0.3, random_seed=42)]
+        sample3 = [x for x in pairs if read_store.ReadStore.pair_is_in_sample(x, 0.3, random_seed=43)]
+        self.assertEqual(sample1, sample2)
+        self.assertNotEqual(sample1, sample3)
+        self.assertTrue(2800 < len(sample1) < 3200)
+        self.assertTrue(2800 < len(sample3) < 3200)
+
+
     def test_sort_file(self):
         '''test _sort_file'''
         infile = os.path.join(data_dir, 'read_store_test_sort_file.in')
@@ -136,3 +150,90 @@ class TestReadStore(unittest.TestCase):
         self.assertFalse(os.path.exists(outprefix))
         self.assertFalse(os.path.exists(outprefix + '.gz'))
         self.assertFalse(os.path.exists(outprefix + '.gz.tbi'))
+
+
+    def test_load_blocks_index(self):
+        '''test _load_blocks_index'''
+        infile = os.path.join(data_dir, 'read_store_test_get_reads_blocks.in.blocks.index')
+        expected = {
+            'cluster1': [(0, 25, 20, 1, 0)],
+            'cluster2': [(25, 25, 20, 1, 0), (87, 26, 20, 1, 1)],
+            'cluster3': [(50, 37, 40, 2, 0)],
+        }
+        self.assertEqual(expected, read_store.ReadStore._load_blocks_index(infile))
+
+
+    def test_get_reads_blocks_fq_pair(self):
+        '''Test get_reads fastq pair from blocks files'''
+        tmp_inprefix = 'tmp.read_store_test_get_reads_blocks.in'
+        for suffix in read_store.block_store_suffixes:
+            shutil.copyfile(os.path.join(data_dir, 'read_store_test_get_reads_blocks.in' + suffix), tmp_inprefix + suffix)
+        expected1 = os.path.join(data_dir, 'read_store_test_get_reads_blocks.expected.reads_1.fq')
+        expected2 = os.path.join(data_dir, 'read_store_test_get_reads_blocks.expected.reads_2.fq')
+        outprefix = 'tmp.read_store_test_get_reads_blocks'
+        reads1 = outprefix + '.reads_1.fq'
+        reads2 = outprefix + '.reads_2.fq'
+        rstore = read_store.ReadStore(tmp_inprefix, outprefix, blocks=True)
+        for suffix in read_store.block_store_suffixes:
+            self.assertFalse(os.path.exists(tmp_inprefix + suffix))
+        got_reads, got_bases = rstore.get_reads('cluster2', reads1, out2=reads2)
+        self.assertEqual(6, got_reads)
+        self.assertEqual(24, got_bases)
+        self.assertTrue(filecmp.cmp(expected1, reads1))
+        self.assertTrue(filecmp.cmp(expected2, reads2))
+        got_reads, got_bases = rstore.get_reads('cluster3', reads1, out2=reads2)
+        self.assertEqual(6, got_reads)
+        self.assertEqual(24, got_bases)
+        got_reads, got_bases = rstore.get_reads('not_a_cluster', reads1, out2=reads2)
+        self.assertEqual(0, got_reads)
+        self.assertEqual(0, got_bases)
+        rstore.clean()
+        for suffix in read_store.block_store_suffixes:
+            self.assertFalse(os.path.exists(outprefix + suffix))
+        os.unlink(reads1)
+        os.unlink(reads2)
+
+
+    def test_get_reads_blocks_subset(self):
+        '''Test get_reads subset from blocks files'''
+        tmp_inprefix = 'tmp.read_store_test_get_reads_blocks.in'
+        for suffix in read_store.block_store_suffixes:
+            shutil.copyfile(os.path.join(data_dir, 'read_store_test_get_reads_blocks.in' + suffix), tmp_inprefix + suffix)
+        expected1 = os.path.join(data_dir, 'read_store_test_get_reads_blocks.expected.reads_subset.1.fq')
+        expected2 = os.path.join(data_dir, 'read_store_test_get_reads_blocks.expected.reads_subset.2.fq')
+        wanted_ids = {1, 5}
+        outprefix = 'tmp.read_store_test_get_reads_blocks'
+        reads1 = outprefix + '.reads_1.fq'
+        reads2 = outprefix + '.reads_2.fq'
+        rstore = read_store.ReadStore(tmp_inprefix, outprefix, blocks=True)
+        got_reads, got_bases = rstore.get_reads('cluster2', reads1, out2=reads2, wanted_ids=wanted_ids)
+        self.assertEqual(4, got_reads)
+        self.assertEqual(16, got_bases)
+        self.assertTrue(filecmp.cmp(expected1, reads1))
+        self.assertTrue(filecmp.cmp(expected2, reads2))
+        rstore.clean()
+        os.unlink(reads1)
+        os.unlink(reads2)
+
+
+    def test_get_reads_blocks_sample(self):
+        '''Test get_reads random sample from blocks files'''
+        tmp_inprefix = 'tmp.read_store_test_get_reads_blocks.in'
+        for suffix in read_store.block_store_suffixes:
+            shutil.copyfile(os.path.join(data_dir, 'read_store_test_get_reads_blocks.in' + suffix), tmp_inprefix + suffix)
+        expected1 = os.path.join(data_dir, 'read_store_test_get_reads_blocks.expected.reads_subset.1.fq')
+        expected2 = os.path.join(data_dir, 'read_store_test_get_reads_blocks.expected.reads_subset.2.fq')
+        outprefix = 'tmp.read_store_test_get_reads_blocks'
+        reads1 = outprefix + '.reads_1.fq'
+        reads2 = outprefix + '.reads_2.fq'
+        rstore = read_store.ReadStore(tmp_inprefix, outprefix, blocks=True)
+        # with this seed, the sample is pairs 1 and 3, which are reads 1/2 and 5/6
+        self.assertEqual([1, 3], [x for x in range(1, 4) if rstore.pair_is_in_sample(x, 0.5, random_seed=4)])
+        got_reads, got_bases = rstore.get_reads('cluster2', reads1, out2=reads2, sample_fraction=0.5, random_seed=4)
+        self.assertEqual(4, got_reads)
+        self.assertEqual(16, got_bases)
+        self.assertTrue(filecmp.cmp(expected1, reads1))
+        self.assertTrue(filecmp.cmp(expected2, reads2))
+        rstore.clean()
+        os.unlink(reads1)
+        os.unlink(reads2)
@@ -131,6 +131,8 @@ class TestRefPreparer(unittest.TestCase):
             got = os.path.join(tmp_out, filename)
             self.assertTrue(filecmp.cmp(expected, got, shallow=False))
 
+        self.assertTrue(os.path.exists(os.path.join(tmp_out, '02.cdhit.all.mmi')))
+        self.assertTrue(os.path.exists(os.path.join(tmp_out, '02.cdhit.all.fa.fai')))
         common.rmtree(tmp_out)
 
 
@@ -166,6 +168,8 @@ class TestRefPreparer(unittest.TestCase):
             got = os.path.join(tmp_out, filename)
             self.assertTrue(filecmp.cmp(expected, got, shallow=False))
 
+        self.assertTrue(os.path.exists(os.path.join(tmp_out, '02.cdhit.all.mmi')))
+        self.assertTrue(os.path.exists(os.path.join(tmp_out, '02.cdhit.all.fa.fai')))
         common.rmtree(tmp_out)
 
 
@@ -2,7 +2,11 @@ import unittest
 import sys
 import os
 import filecmp
+import shutil
+import pyfastaq
 import pymummer
+import pysam
+import minimap_ariba
 from ariba import ref_seq_chooser
 
 modules_dir = os.path.dirname(os.path.abspath(ref_seq_chooser.__file__))
@@ -29,6 +33,94 @@ class TestRefSeqChooser(unittest.TestCase):
         self.assertTrue(ref_seq_chooser.RefSeqChooser._sequence_is_in_fasta_file('contig42', fasta))
 
 
+    def test_candidate_ref_names(self):
+        '''test _candidate_ref_names'''
+        cluster_names = {'ref1', 'ref2', 'ref3', 'ref4'}
+        ref_scores = {'ref1': 100, 'ref2': 90, 'ref3': 50, 'ref5': 85, 'ref6': 40, 'ref7': 100}
+        got = ref_seq_chooser.RefSeqChooser._candidate_ref_names(cluster_names, ref_scores, 2, 0.9)
+        self.assertEqual(({'ref1', 'ref2'}, {'ref5', 'ref7'}), got)
+        got = ref_seq_chooser.RefSeqChooser._candidate_ref_names(cluster_names, ref_scores, 1, 0.9)
+        self.assertEqual(({'ref1'}, {'ref7'}), got)
+        got = ref_seq_chooser.RefSeqChooser._candidate_ref_names(cluster_names, ref_scores, 10, 0.5)
+        self.assertEqual(({'ref1', 'ref2', 'ref3'}, {'ref5', 'ref6', 'ref7'}), got)
+        got = ref_seq_chooser.RefSeqChooser._candidate_ref_names({'ref4'}, ref_scores, 2, 0.9)
+        self.assertEqual((None, None), got)
+
+
+    def test_write_candidate_fastas(self):
+        '''test _write_candidate_fastas'''
+        all_ref_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_not_in_cluster.allrefs.fa')
+        cluster_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_not_in_cluster.clusterrefs.fa')
+        contig_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_not_in_cluster.contigs.fa')
+        tmpdir = 'tmp.ref_seq_chooser_write_candidate_fastas'
+        os.mkdir(tmpdir)
+        ref_scores = {'ref1': 50, 'ref2': 60, 'ref3': 10}
+        refchooser = ref_seq_chooser.RefSeqChooser(cluster_fasta, all_ref_fasta, contig_fasta, 'tmp.out.fa', sys.stdout, ref_scores=ref_scores, max_cluster_refs=1)
+        got_cluster_fasta, got_all_fasta = refchooser._write_candidate_fastas(tmpdir)
+        self.assertEqual(['ref1'], [x.id for x in pyfastaq.sequences.file_reader(got_cluster_fasta)])
+        self.assertEqual(['ref1', 'ref2'], [x.id for x in pyfastaq.sequences.file_reader(got_all_fasta)])
+        refchooser.ref_scores = {'ref2': 60}
+        self.assertEqual((None, None), refchooser._write_candidate_fastas(tmpdir))
+        shutil.rmtree(tmpdir)
+
+
+    def test_write_seqs_from_fasta(self):
+        '''test _write_seqs_from_fasta'''
+        tmp_fasta = 'tmp.ref_seq_chooser_write_seqs_from_fasta.in.fa'
+        tmp_out = 'tmp.ref_seq_chooser_write_seqs_from_fasta.out.fa'
+        shutil.copyfile(os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_not_in_cluster.allrefs.fa'), tmp_fasta)
+        expected = {}
+        pyfastaq.tasks.file_to_dict(tmp_fasta, expected)
+        expected = {x: expected[x] for x in ['ref2', 'ref4']}
+        ref_seq_chooser.RefSeqChooser._write_seqs_from_fasta(tmp_fasta, {'ref2', 'ref4'}, tmp_out)
+        got = {}
+        pyfastaq.tasks.file_to_dict(tmp_out, got)
+        self.assertEqual(expected, got)
+
+        pysam.faidx(tmp_fasta)
+        ref_seq_chooser.RefSeqChooser._write_seqs_from_fasta(tmp_fasta, {'ref2', 'ref4'}, tmp_out)
+        got = {}
+        pyfastaq.tasks.file_to_dict(tmp_out, got)
+        self.assertEqual(expected, got)
+        os.unlink(tmp_fasta)
+        os.unlink(tmp_fasta + '.fai')
+        os.unlink(tmp_out)
+
+
+    def test_write_refs_matching_fasta(self):
+        '''test _write_refs_matching_fasta'''
+        all_ref_fasta = os.path.join(data_dir, 'clusters_minimap_reads_to_all_refs.ref.fa')
+        tmp_index = 'tmp.ref_seq_chooser_write_refs_matching_fasta.mmi'
+        tmp_qry = 'tmp.ref_seq_chooser_write_refs_matching_fasta.qry.fa'
+        tmp_out = 'tmp.ref_seq_chooser_write_refs_matching_fasta.out.fa'
+        tmp_cluster = 'tmp.ref_seq_chooser_write_refs_matching_fasta.cluster.fa'
+        self.assertEqual(0, minimap_ariba.build_index(all_ref_fasta, tmp_index))
+        ref_seqs = {}
+        pyfastaq.tasks.file_to_dict(all_ref_fasta, ref_seqs)
+        with open(tmp_qry, 'w') as f:
+            print(pyfastaq.sequences.Fasta('qry', ref_seqs['ref2'].seq[100:600]), file=f)
+        with open(tmp_cluster, 'w') as f:
+            print(ref_seqs['ref3'], file=f)
+
+        refchooser = ref_seq_chooser.RefSeqChooser(tmp_cluster, all_ref_fasta, tmp_qry, 'tmp.out.fa', sys.stdout, all_refs_index=tmp_index)
+        refchooser.closest_ref_within_cluster = 'ref3'
+        self.assertTrue(refchooser._write_refs_matching_fasta(tmp_qry, tmp_out))
+        self.assertEqual(['ref2', 'ref3', 'ref7'], [x.id for x in pyfastaq.sequences.file_reader(tmp_out)])
+        os.unlink(tmp_out)
+
+        # minimap only finds refs in the cluster, so file should not be written
+        with open(tmp_cluster, 'w') as f:
+            for name in ['ref2', 'ref3', 'ref7']:
+                print(ref_seqs[name], file=f)
+        refchooser = ref_seq_chooser.RefSeqChooser(tmp_cluster, all_ref_fasta, tmp_qry, 'tmp.out.fa', sys.stdout, all_refs_index=tmp_index)
+        refchooser.closest_ref_within_cluster = 'ref3'
+        self.assertFalse(refchooser._write_refs_matching_fasta(tmp_qry, tmp_out))
+        self.assertFalse(os.path.exists(tmp_out))
+        os.unlink(tmp_index)
+        os.unlink(tmp_qry)
+        os.unlink(tmp_cluster)
+
+
     def test_run_no_match_in_cluster(self):
         '''Test full run when nearest match is not in the cluster'''
         all_ref_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_not_in_cluster.allrefs.fa')
@@ -68,6 +160,24 @@ class TestRefSeqChooser(unittest.TestCase):
         self.assertFalse(os.path.exists(tmp_out))
 
 
+    def test_run_best_match_not_in_cluster_missed_by_minimap(self):
+        '''Test full run where better match to seq not in cluster, which the minimap index does not find'''
+        all_ref_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_not_in_cluster.allrefs.fa')
+        cluster_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_not_in_cluster.clusterrefs.fa')
+        contig_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_not_in_cluster.contigs.fa')
+        tmp_out = 'tmp.ref_seq_chooser_full_run_best_match_not_in_cluster_missed_by_minimap.fa'
+        tmp_index = 'tmp.ref_seq_chooser_full_run_best_match_not_in_cluster_missed_by_minimap.mmi'
+        # Index made from just the cluster refs, so that minimap cannot find ref2.
+        # The check outside the cluster should then use all refs and find it
+        self.assertEqual(0, minimap_ariba.build_index(cluster_fasta, tmp_index))
+        refchooser = ref_seq_chooser.RefSeqChooser(cluster_fasta, all_ref_fasta, contig_fasta, tmp_out, sys.stdout, all_refs_index=tmp_index)
+        refchooser.run()
+        self.assertEqual('ref2', refchooser.closest_ref_from_all_refs)
+        self.assertFalse(refchooser.closest_ref_is_in_cluster)
+        self.assertFalse(os.path.exists(tmp_out))
+        os.unlink(tmp_index)
+
+
     def test_run_best_match_is_in_cluster(self):
         '''Test full run where the best match is in the cluster'''
         all_ref_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_is_in_cluster.allrefs.fa')
@@ -82,6 +192,35 @@ class TestRefSeqChooser(unittest.TestCase):
         os.unlink(tmp_out)
 
 
+    def test_run_best_match_not_in_cluster_with_ref_scores(self):
+        '''Test full run where better match to seq not in cluster, using minimap scores to choose refs'''
+        all_ref_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_not_in_cluster.allrefs.fa')
+        cluster_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_not_in_cluster.clusterrefs.fa')
+        contig_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_not_in_cluster.contigs.fa')
+        tmp_out = 'tmp.ref_seq_chooser_full_run_best_match_not_in_cluster_with_ref_scores.fa'
+        ref_scores = {'ref1': 50, 'ref2': 60, 'ref3': 10}
+        refchooser = ref_seq_chooser.RefSeqChooser(cluster_fasta, all_ref_fasta, contig_fasta, tmp_out, sys.stdout, ref_scores=ref_scores, max_cluster_refs=1)
+        refchooser.run()
+        self.assertEqual('ref2', refchooser.closest_ref_from_all_refs)
+        self.assertFalse(refchooser.closest_ref_is_in_cluster)
+        self.assertFalse(os.path.exists(tmp_out))
+
+
+    def test_run_best_match_is_in_cluster_with_ref_scores(self):
+        '''Test full run where the best match is in the cluster, using minimap scores to choose refs'''
+        all_ref_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_is_in_cluster.allrefs.fa')
+        cluster_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_is_in_cluster.clusterrefs.fa')
+        contig_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_best_match_is_in_cluster.contigs.fa')
+        tmp_out = 'tmp.ref_seq_chooser_full_run_best_match_is_in_cluster_with_ref_scores.fa'
+        ref_scores = {'ref1': 100, 'ref3': 20}
+        refchooser = ref_seq_chooser.RefSeqChooser(cluster_fasta, all_ref_fasta, contig_fasta, tmp_out, sys.stdout, ref_scores=ref_scores, max_cluster_refs=1)
+        refchooser.run()
+        self.assertEqual('ref1', refchooser.closest_ref_from_all_refs)
+        self.assertTrue(refchooser.closest_ref_is_in_cluster)
+        self.assertTrue(os.path.exists(tmp_out))
+        os.unlink(tmp_out)
+
+
     def test_run_contained_ref_seq(self):
         '''Test full run where ref seq completely contains another seq outside cluster'''
         all_ref_fasta = os.path.join(data_dir, 'ref_seq_chooser_full_run_contained_ref_seq.all_refs.fa')
@@ -71,6 +71,58 @@ class TestSamtoolsVariants(unittest.TestCase):
         os.unlink(tmp_prefix + '.contig_depths')
 
 
+    def test_make_vcf_and_depths_files_pysam(self):
+        '''test _make_vcf_and_read_depths_files with pysam pileup'''
+        ref = os.path.join(data_dir, 'samtools_variants_make_vcf_and_depths_files.asmbly.fa')
+        bam = os.path.join(data_dir, 'samtools_variants_make_vcf_and_depths_files.bam')
+        expected_vcf = os.path.join(data_dir, 'samtools_variants_make_vcf_and_depths_files.expect.vcf')
+        expected_coverage = os.path.join(data_dir, 'samtools_variants_make_vcf_and_depths_files.expect.cov')
+        tmp_prefix = 'tmp.test_make_vcf_and_depths_files_pysam'
+        sv = samtools_variants.SamtoolsVariants(
+            ref,
+            bam,
+            tmp_prefix,
+            pileup='pysam',
+        )
+        sv._make_vcf_and_read_depths_files()
+
+        # no BAQ and indels not realigned, so only check the same positions
+        # are called as mpileup, and the depths at a SNP
+        expected = samtools_variants.SamtoolsVariants._get_variant_positions_from_vcf(expected_vcf)
+        got = samtools_variants.SamtoolsVariants._get_variant_positions_from_vcf(sv.vcf_file)
+        self.assertEqual(expected, got)
+        self.assertEqual(('C,G', 190, '0,190'), sv.get_depths_at_position('ref1', 200))
+        self.assertTrue(filecmp.cmp(expected_coverage, sv.contig_depths_file, shallow=False))
+        self.assertFalse(os.path.exists(tmp_prefix + '.tmp.bai'))
+        os.unlink(sv.vcf_file)
+        os.unlink(sv.read_depths_file)
+        os.unlink(sv.read_depths_file + '.tbi')
+        os.unlink(sv.contig_depths_file)
+
+
+    def test_depths_pass(self):
+        '''test _depths_pass'''
+        tests = [
+            ([10], [10], True),
+            ([10, 2], [10, 3], True),
+            ([10, 0], [10, 3], False),
+            ([2, 1], [10, 3], False),
+            ([1, 10], [1, 10], True),
+            ([100, 2], [100, 2], False),
+        ]
+        for adf, adr, expected in tests:
+            self.assertEqual(expected, samtools_variants.SamtoolsVariants._depths_pass(adf, adr, 4, 2, 0.90))
+
+
+    def test_indel_alleles(self):
+        '''test _indel_alleles'''
+        ref_seq = 'ACGTACGT'
+        indels = {('I', 'TT'): [1, 1], ('D', 2): [2, 1], ('D', 1): [1, 0]}
+        ref_allele, alts = samtools_variants.SamtoolsVariants._indel_alleles(ref_seq, 1, indels)
+        self.assertEqual('CGT', ref_allele)
+        self.assertEqual({('CTTGT', ('I', 'TT')), ('C', ('D', 2)), ('CT', ('D', 1))}, set(alts))
+
+
     def test_get_read_depths(self):
         '''test _get_read_depths'''
         read_depths_file = os.path.join(data_dir, 'samtools_variants_test_get_read_depths.gz')
@@ -88,6 +140,29 @@ class TestSamtoolsVariants(unittest.TestCase):
             self.assertEqual(expected, samtools_variants.SamtoolsVariants._get_read_depths(read_depths_file, name, position))
 
 
+    def test_depth_index(self):
+        '''test DepthIndex'''
+        read_depths_file = os.path.join(data_dir, 'samtools_variants_test_get_read_depths.gz')
+        depth_index = samtools_variants.DepthIndex.from_file(read_depths_file)
+
+        tests = [
+            ( ('ref1', 42), None ),
+            ( ('ref1', -1), None ),
+            ( ('ref2', 1), None ),
+            ( ('ref1', 0), ('G', 1, '1') ),
+            ( ('ref1', 2), ('T,A', 3, '2,1') ),
+            ( ('ref1', 3), ('C,A,G', 42, '21,11,10') ),
+            ( ('ref1', 4), ('C,AC', 41, '0,42') )
+        ]
+
+        for (name, position), expected in tests:
+            self.assertEqual(expected, depth_index.depths(name, position))
+
+        self.assertEqual(42, depth_index.total_depths['ref1'][3])
+        self.assertEqual(21, depth_index.ref_depths['ref1'][3])
+        self.assertEqual(21, depth_index.alt_depths['ref1'][3])
+
+
     def test_get_variant_positions_from_vcf(self):
         '''test _get_variant_positions_from_vcf'''
         vcf_file = os.path.join(data_dir, 'samtools_variants_test_get_variant_positions_from_vcf.vcf')
@@ -171,3 +246,23 @@ class TestSamtoolsVariants(unittest.TestCase):
         os.unlink(samtools_vars.read_depths_file)
         os.unlink(samtools_vars.read_depths_file + '.tbi')
         os.unlink(samtools_vars.contig_depths_file)
+
+
+    def test_get_depths_at_position_pysam(self):
+        '''test get_depths_at_position with pysam pileup'''
+        bam = os.path.join(data_dir, 'samtools_variants_test_get_depths_at_position.bam')
+        ref_fa = os.path.join(data_dir, 'samtools_variants_test_get_depths_at_position.ref.fa')
+        tmp_prefix = 'tmp.test_get_depths_at_position_pysam'
+        samtools_vars = samtools_variants.SamtoolsVariants(
+            ref_fa,
+            bam,
+            tmp_prefix,
+            pileup='pysam',
+            make_read_depths_file=False,
+        )
+        samtools_vars.run()
+        self.assertFalse(os.path.exists(samtools_vars.read_depths_file))
+        self.assertEqual(('C,T', 31, '18,13'), samtools_vars.get_depths_at_position('ref', 425))
+        self.assertEqual(('ND', 'ND', 'ND'), samtools_vars.get_depths_at_position('not_a_ref', 10))
+        os.unlink(samtools_vars.vcf_file)
+        os.unlink(samtools_vars.contig_depths_file)
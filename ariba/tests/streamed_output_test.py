@@ -0,0 +1,48 @@
+import unittest
+import os
+import pyfastaq
+from ariba import streamed_output
+
+
+class TestStreamedOutput(unittest.TestCase):
+    def test_add_and_finish(self):
+        '''test add and finish'''
+        outfile = 'tmp.streamed_output.gz'
+        output = streamed_output.StreamedOutput(outfile, header='#header')
+        unsorted_file = os.path.abspath('tmp.streamed_output.unsorted')
+        self.assertEqual(unsorted_file, output.unsorted_file)
+        output.add('b', 'b1\nb2\n')
+        output.add('c', '')
+        output.add('a', 'a1\n')
+
+        with open(unsorted_file) as f:
+            self.assertEqual('#header\nb1\nb2\na1\n', f.read())
+
+        with self.assertRaises(streamed_output.Error):
+            output.add('a', 'a2\n')
+
+        output.finish()
+        self.assertFalse(os.path.exists(unsorted_file))
+        f = pyfastaq.utils.open_file_read(outfile)
+        got = f.read()
+        pyfastaq.utils.close(f)
+        self.assertEqual('#header\na1\nb1\nb2\n', got)
+        os.unlink(outfile)
+
+        with self.assertRaises(streamed_output.Error):
+            output.add('d', 'd1\n')
+
+
+    def test_remove(self):
+        '''test remove'''
+        outfile = 'tmp.streamed_output.remove'
+        output = streamed_output.StreamedOutput(outfile)
+        output.add('a', 'a1\n')
+        self.assertTrue(os.path.exists(output.unsorted_file))
+        output.remove()
+        self.assertFalse(os.path.exists(output.unsorted_file))
+        self.assertFalse(os.path.exists(outfile))
+        output.remove()
+
+        with self.assertRaises(streamed_output.Error):
+            output.add('b', 'b1\n')
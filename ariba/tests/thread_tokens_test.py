@@ -0,0 +1,60 @@
+import unittest
+import multiprocessing
+from ariba import thread_tokens
+
+
+def _take_tokens(wanted):
+    return _tokens.acquire(wanted, block=False)
+
+
+def _init_tokens(tokens):
+    global _tokens
+    _tokens = tokens
+
+
+class TestThreadTokens(unittest.TestCase):
+    def test_init_bad_total(self):
+        '''test __init__ with bad total'''
+        with self.assertRaises(thread_tokens.Error):
+            thread_tokens.ThreadTokens(0)
+
+
+    def test_acquire_and_release(self):
+        '''test acquire and release'''
+        tokens = thread_tokens.ThreadTokens(3)
+        self.assertEqual(0, tokens.acquire(0))
+        self.assertEqual(2, tokens.acquire(2))
+        self.assertEqual(1, tokens.acquire(5, block=False))
+        self.assertEqual(0, tokens.acquire(1, block=False))
+        tokens.release(2)
+        self.assertEqual(2, tokens.acquire(3, block=False))
+        tokens.release(3)
+        with self.assertRaises(ValueError):
+            tokens.release(1)
+
+
+    def test_start_and_skip_cluster(self):
+        '''test start_cluster, skip_cluster and clusters_waiting'''
+        tokens = thread_tokens.ThreadTokens(2, waiting=3)
+        self.assertTrue(tokens.clusters_waiting())
+        self.assertEqual(1, tokens.start_cluster())
+        self.assertTrue(tokens.clusters_waiting())
+        tokens.skip_cluster()
+        self.assertTrue(tokens.clusters_waiting())
+        self.assertEqual(1, tokens.start_cluster())
+        self.assertFalse(tokens.clusters_waiting())
+        self.assertEqual(0, tokens.acquire(1, block=False))
+        tokens.skip_cluster()
+        self.assertFalse(tokens.clusters_waiting())
+
+
+    def test_shared_between_processes(self):
+        '''test tokens are shared by pool workers'''
+        tokens = thread_tokens.ThreadTokens(4)
+        self.assertEqual(3, tokens.acquire(3))
+        pool = multiprocessing.Pool(1, initializer=_init_tokens, initargs=(tokens,))
+        got = pool.map(_take_tokens, [2])
+        pool.close()
+        pool.join()
+        self.assertEqual([1], got)
+        self.assertEqual(0, tokens.acquire(1, block=False))
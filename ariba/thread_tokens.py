@@ -0,0 +1,79 @@
+import multiprocessing
+import multiprocessing.synchronize
+
+class Error (Exception): pass
+
+
+class ThreadTokens:
+    '''Budget of threads shared by the clusters running in parallel. There
+       is one token per thread. A running cluster holds one token, and takes
+       more before a multithreaded step (eg spades, bowtie2) if any are free,
+       giving them back when the step is done. So the total number of threads
+       in use is never more than the number of tokens.
+
+       A cluster that is waiting for its first token must not be starved by
+       running clusters taking every token that is given back. So the number
+       of clusters that have not started yet is also kept (waiting), and extra
+       tokens are only handed out when it is zero (see clusters_waiting).
+
+       Uses multiprocessing semaphores, which do not need a Manager process
+       or temporary files. Like all multiprocessing locks, they can only be given
+       to other processes when they are made (eg in a Pool initializer), not
+       pickled with the tasks'''
+    def __init__(self, total, waiting=0):
+        if total < 1:
+            raise Error('Number of thread tokens must be at least 1, but got ' + str(total) + '. Cannot continue')
+        self.total = total
+        self.semaphore = multiprocessing.BoundedSemaphore(total)
+        # The maximum value of a semaphore can be small (eg 32767 on OS X).
+        # With more clusters than that, extra tokens are handed out a little
+        # before the last clusters start, which is harmless
+        self.waiting = multiprocessing.Semaphore(min(waiting, multiprocessing.synchronize.SEM_VALUE_MAX))
+        # clusters_waiting looks at the count by taking one and giving it back.
+        # Without this lock, a cluster starting at the same time could fail
+        # to take its own one, and then the count would never get to zero
+        self.waiting_lock = multiprocessing.Lock()
+
+
+    def acquire(self, wanted, block=True):
+        '''Takes up to wanted tokens and returns the number taken. If block
+           is True, waits until the first token is free. The others are only
+           taken if they are already free'''
+        if wanted < 1:
+            return 0
+
+        if not self.semaphore.acquire(block=block):
+            return 0
+
+        got = 1
+        while got < wanted and self.semaphore.acquire(block=False):
+            got += 1
+        return got
+
+
+    def release(self, number):
+        for i in range(number):
+            self.semaphore.release()
+
+
+    def start_cluster(self):
+        '''Waits for one token for a cluster that is starting, and then
+           stops counting that cluster as waiting. Returns 1'''
+        got = self.acquire(1)
+        self.skip_cluster()
+        return got
+
+
+    def skip_cluster(self):
+        '''Stops counting a cluster as waiting, when it will not be run'''
+        with self.waiting_lock:
+            self.waiting.acquire(block=False)
+
+
+    def clusters_waiting(self):
+        '''Returns True if any clusters have not started yet'''
+        with self.waiting_lock:
+            if self.waiting.acquire(block=False):
+                self.waiting.release()
+                return True
+            return False